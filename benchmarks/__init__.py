@@ -0,0 +1,13 @@
+#!/usr/bin/env python
+"""
+Intercheck benchmarks
+
+Measures how Intercheck scales with the size of its SpeedTest log.  Synthetic
+histories (see :mod:`benchmarks.generate`) are written to a temporary
+``~/.intercheck`` for each storage engine and size, and the storage, summary
+and graph functions, as well as the web routes (through the Flask test client),
+are timed against them (see :mod:`benchmarks.run`).  The results are written to
+a JSON report so that two versions of Intercheck can be compared::
+
+    python -m benchmarks --records 10000 100000 --storage sqlite jsonl
+"""
@@ -0,0 +1,7 @@
+#!/usr/bin/env python
+from __future__ import absolute_import, division, print_function
+from benchmarks import run
+
+
+if __name__ == '__main__':
+    run.main()
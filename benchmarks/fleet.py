@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""
+Intercheck fleet load test
+
+Runs a fleet on this machine: an aggregator (``--fleet``) in its own process,
+serving on ``port``, and ``agents`` agents pushing synthetic histories (see
+:mod:`benchmarks.generate`) to it from a pool of ``processes`` processes, each
+through its own spool and :class:`intercheck.fleet.Pusher`.  Every process has
+its own temporary ``~/.intercheck``.  Once all agents are done, the test checks
+that the aggregator stored every SpeedTest exactly once and times the fleet
+views::
+
+    python -m benchmarks.fleet --agents 50 --records 2000
+"""
+from __future__ import absolute_import, division, print_function
+# Benchmarks
+from benchmarks import generate, run
+# Python built-in
+import multiprocessing
+import simplejson
+import argparse
+import tempfile
+import logging
+import shutil
+import time
+import sys
+import os
+
+
+# Configure the logger
+print = logging.warning
+
+
+def serve(home_path, port, workers):
+    """ Run the aggregator, blocking. """
+    import tornado.httpserver
+    import tornado.ioloop
+    from intercheck import routes, server, utils
+    run.isolate(home_path)
+    settings_dict = utils.load_settings(quiet=True)
+    settings_dict['fleet'] = True
+    utils.save_settings(settings_dict, quiet=True)
+    application = server.make_application(routes.APP, workers=workers)
+    http_server = tornado.httpserver.HTTPServer(application)
+    http_server.listen(port)
+    tornado.ioloop.IOLoop.instance().start()
+
+
+def push(args):
+    """ Push the synthetic history of one agent, returns the seconds it took. """
+    url, agent, home_path, records, batch_size, seed = args
+    from intercheck import fleet
+    run.isolate(home_path)
+    spool = fleet.Spool(os.path.join(home_path, 'spool.jsonl'))
+    pusher = fleet.Pusher(url, agent, spool, batch_size=batch_size)
+    spool.put(list(generate.generate_records(records, seed=seed)))
+    start = time.time()
+    while not pusher.flush():
+        time.sleep(1.0)
+    return time.time() - start
+
+
+def request(url, repeat=5):
+    import requests
+    duration_list = []
+    for index in range(repeat):
+        start = time.time()
+        response = requests.get(url)
+        response.raise_for_status()
+        duration_list.append(time.time() - start)
+    return response.json(), min(duration_list)
+
+
+def configure_argparser():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.fleet')
+    parser.add_argument('-a', '--agents', type=int, default=20,
+                        help='the number of agents')
+    parser.add_argument('-r', '--records', type=int, default=1000,
+                        help='the SpeedTests pushed by each agent')
+    parser.add_argument('-b', '--batch-size', type=int, default=500,
+                        help='the SpeedTests per push')
+    parser.add_argument('-j', '--processes', type=int, default=8,
+                        help='how many agents push at the same time')
+    parser.add_argument('-w', '--workers', type=int, default=8,
+                        help='the aggregator\'s web server threads')
+    parser.add_argument('-p', '--port', type=int, default=5099,
+                        help='the aggregator\'s port')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='the random seed for the synthetic histories')
+    return parser.parse_args()
+
+
+def main():
+    import requests
+    args = configure_argparser()
+    url = 'http://127.0.0.1:%d' % (args.port, )
+    temp_path = tempfile.mkdtemp(prefix='intercheck-fleet-')
+    aggregator_path = os.path.join(temp_path, 'aggregator')
+    os.makedirs(aggregator_path)
+    aggregator = multiprocessing.Process(target=serve, args=(aggregator_path, args.port,
+                                                             args.workers, ))
+    aggregator.start()
+    try:
+        # Wait for the aggregator to listen
+        deadline = time.time() + 30.0
+        while True:
+            try:
+                requests.get('%s/fleet/agents/' % (url, )).raise_for_status()
+                break
+            except requests.RequestException:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.1)
+        push_list = []
+        for index in range(args.agents):
+            agent = 'agent-%04d' % (index, )
+            agent_path = os.path.join(temp_path, agent)
+            os.makedirs(agent_path)
+            push_list.append((url, agent, agent_path, args.records, args.batch_size,
+                              args.seed + index, ))
+        start = time.time()
+        pool = multiprocessing.Pool(args.processes)
+        duration_list = pool.map(push, push_list)
+        pool.close()
+        pool.join()
+        duration = time.time() - start
+        total = args.agents * args.records
+        print('Pushed %d SpeedTests from %d agents in %0.03f sec. (%0.01f per sec.)' %
+              (total, args.agents, duration, total / duration, ))
+        print('Slowest agent: %0.03f sec.' % (max(duration_list), ))
+        # Every SpeedTest arrived, exactly once
+        agent_dict, _ = request('%s/fleet/agents/' % (url, ), repeat=1)
+        failed = [
+            agent_dict_ for agent_dict_ in agent_dict['agents']
+            if agent_dict_['records'] != args.records
+        ]
+        if len(agent_dict['agents']) != args.agents or len(failed) > 0:
+            print('Missing SpeedTests: %r' % (failed, ))
+            sys.exit(1)
+        for route in ['/fleet/summary/', '/fleet/points/',
+                      '/summary/?agent=agent-0000', '/points/?agent=agent-0000']:
+            response_dict, duration = request('%s%s' % (url, route, ))
+            print('%s: %0.06f sec.' % (route, duration, ))
+        print(simplejson.dumps(request('%s/fleet/summary/' % (url, ), repeat=1)[0]['stats']))
+    finally:
+        aggregator.terminate()
+        aggregator.join()
+        shutil.rmtree(temp_path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
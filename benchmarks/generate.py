@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+Synthetic SpeedTest histories
+
+:func:`generate_records` yields a realistic, reproducible history of SpeedTest
+records ending now: one record every ``interval`` seconds (with some jitter),
+bandwidth that dips during the evening, occasional partial failures (a single
+``None`` value) and outages, runs of consecutive failed SpeedTests whose length
+is drawn from an exponential distribution.
+"""
+from __future__ import absolute_import, division, print_function
+# Intercheck
+from intercheck import storage
+# Python built-in
+import simplejson
+import logging
+import random
+import math
+import time
+
+
+# Configure the logger
+print = logging.warning
+
+
+def generate_records(count, interval=60 * 5, end=None, jitter=5.0,
+                     download=100.0, upload=10.0, ping=20.0,
+                     outage_rate=0.002, outage_length=6, failure_rate=0.01,
+                     seed=0):
+    """ Yield ``count`` synthetic SpeedTest records, in order of ``start``.
+
+    Args:
+        count (int): the number of records
+        interval (float): the seconds between two SpeedTests
+        end (float): the time of the last record, defaults to now
+        jitter (float): the maximum random delay added to each record
+        download (float): the typical download speed, in Mb/s
+        upload (float): the typical upload speed, in Mb/s
+        ping (float): the typical ping, in ms
+        outage_rate (float): the probability that an outage starts at any record
+        outage_length (float): the mean number of failed SpeedTests per outage
+        failure_rate (float): the probability that a single value is missing
+        seed (int): the random seed, the same seed yields the same history
+
+    Yields:
+        dict: a record keyed by :data:`intercheck.storage.KEY_LIST`
+    """
+    rng = random.Random(seed)
+    end = time.time() if end is None else end
+    first = end - (count - 1) * interval - jitter
+    outage_remaining = 0
+    for index in range(count):
+        start = first + index * interval + rng.uniform(0.0, jitter)
+        if outage_remaining == 0 and rng.random() < outage_rate:
+            outage_remaining = 1 + int(rng.expovariate(1.0 / outage_length))
+        if outage_remaining > 0:
+            outage_remaining -= 1
+            yield {
+                'start'    : start,
+                'duration' : rng.uniform(1.0, 5.0),
+                'ping'     : None,
+                'download' : None,
+                'upload'   : None,
+            }
+            continue
+        # The network is busiest (slowest) around 9 PM
+        hour = (start % (60 * 60 * 24)) / (60 * 60)
+        load = 0.5 + 0.5 * math.cos(2.0 * math.pi * (hour - 21.0) / 24.0)
+        record = {
+            'start'    : start,
+            'duration' : max(5.0, rng.gauss(25.0, 3.0)),
+            'ping'     : ping * (1.0 + load) * rng.lognormvariate(0.0, 0.2),
+            'download' : download * (1.0 - 0.4 * load) * rng.lognormvariate(0.0, 0.1),
+            'upload'   : upload * (1.0 - 0.2 * load) * rng.lognormvariate(0.0, 0.1),
+        }
+        if rng.random() < failure_rate:
+            record[rng.choice(['ping', 'download', 'upload'])] = None
+        yield record
+
+
+def write_legacy_log(json_log_filepath, csv_log_filepath, record_iter,
+                     key_list=storage.KEY_LIST):
+    """ Write a legacy JSON and CSV log in one pass.
+
+    :func:`intercheck.storage.write_json_log` re-reads and rewrites the whole
+    JSON log for every record, which is far too slow for millions of records.
+    """
+    with open(json_log_filepath, 'w') as json_log:
+        with open(csv_log_filepath, 'w') as csv_log:
+            json_log.write('{"log": [')
+            csv_log.write('%s\n' % (','.join(key_list), ))
+            for index, record in enumerate(record_iter):
+                args = { key : record.get(key, None) for key in key_list }
+                if index > 0:
+                    json_log.write(', ')
+                json_log.write(simplejson.dumps(args))
+                args = [ record.get(key, None) for key in key_list ]
+                args = [ '' if arg is None else '%s' % (arg, ) for arg in args ]
+                csv_log.write('%s\n' % (','.join(args), ))
+            json_log.write(']}')
+
+
+def populate(storage_, record_iter, batch_size=10000):
+    """ Write all of the records in ``record_iter`` to ``storage_``. """
+    if isinstance(storage_, storage.JSONStorage):
+        args = (storage_.json_log_filepath, storage_.csv_log_filepath, )
+        write_legacy_log(*args, record_iter=record_iter)
+        return
+    batch_list = []
+    for record in record_iter:
+        batch_list.append(record)
+        if len(batch_list) >= batch_size:
+            storage_.write_many(batch_list)
+            batch_list = []
+    if len(batch_list) > 0:
+        storage_.write_many(batch_list)
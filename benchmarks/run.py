@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""
+Intercheck benchmark runner
+
+For every storage engine and history size, a fresh ``~/.intercheck`` is created
+in a temporary directory (by pointing ``HOME`` at it) and filled with a
+synthetic history.  Each benchmark is then run ``repeat`` times; the first run
+is reported separately as ``cold`` since most of Intercheck caches its views.
+The write benchmark runs last, as every write invalidates those caches.
+"""
+from __future__ import absolute_import, division, print_function
+# Benchmarks
+from benchmarks import generate
+# Python built-in
+import simplejson
+import argparse
+import platform
+import tempfile
+import logging
+import shutil
+import time
+import sys
+import os
+
+
+# Configure the logger
+print = logging.warning
+
+
+def isolate(home_path):
+    """ Point Intercheck at a new ``~/.intercheck`` inside ``home_path``. """
+    from intercheck import aggregate, columnar, utils
+    os.environ['HOME'] = home_path
+    utils.INTERNAL_PATH_DICT.clear()
+    utils.SETTINGS_SERVICE_DICT.clear()
+    utils.STORAGE_DICT.clear()
+    utils.OUTAGE_INDEX_DICT.clear()
+    utils.RESPONSE_CACHE_DICT.clear()
+    aggregate.AGGREGATOR_DICT.clear()
+    aggregate.QUANTILE_AGGREGATOR_DICT.clear()
+    columnar.COLUMNAR_DICT.clear()
+
+
+def measure(func, repeat=5):
+    """ Time ``func()``, returns a dict of the cold and the warm timings. """
+    duration_list = []
+    for index in range(repeat):
+        start = time.time()
+        func()
+        duration_list.append(time.time() - start)
+    cold = duration_list[0]
+    warm_list = sorted(duration_list[1:]) or [cold]
+    result_dict = {
+        'repeat' : repeat,
+        'cold'   : cold,
+        'min'    : warm_list[0],
+        'median' : warm_list[len(warm_list) // 2],
+        'mean'   : sum(warm_list) / len(warm_list),
+        'max'    : warm_list[-1],
+    }
+    return result_dict
+
+
+def check_columnar():
+    """ Raise AssertionError unless the columnar engine (see
+    :mod:`intercheck.columnar`) returns the same statistics as the pure-Python
+    path, for a window that slides as well.
+    """
+    from intercheck import columnar, utils
+    if not columnar.available():
+        print('NumPy is not installed, skipping the columnar check')
+        return
+    now = time.time()
+    for now_ in [now, now + 60 * 60, now + 60 * 60 * 24 * 2]:
+        for latest in [None, now - 60 * 60 * 12]:
+            for func in [utils.get_stats, utils.get_summary_averages]:
+                expected = func(latest=latest, vectorized=False, now=now_)
+                result = func(latest=latest, vectorized=True, now=now_)
+                assert result == expected, (func.__name__, now_, latest, )
+
+
+def get_route(client, url, headers=None):
+    def route():
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200, (url, response.status_code, )
+        # Consume streamed responses completely
+        return len(response.get_data())
+    return route
+
+
+def benchmark(backend, records, repeat=5, writes=100, seed=0):
+    """ Run every benchmark against one storage engine and history size.
+
+    Returns:
+        list of dict: one result per benchmark
+    """
+    from intercheck import aggregate, routes, utils
+    home_path = tempfile.mkdtemp(prefix='intercheck-benchmark-')
+    try:
+        isolate(home_path)
+        settings_dict = utils.load_settings(quiet=True)
+        settings_dict['storage'] = backend
+        utils.save_settings(settings_dict, quiet=True)
+        storage_ = utils.get_storage()
+        # Populate the log
+        record_iter = generate.generate_records(records, seed=seed)
+        start = time.time()
+        generate.populate(storage_, record_iter)
+        populate_duration = time.time() - start
+        check_columnar()
+        client = routes.APP.test_client()
+        gzip_headers = {'Accept-Encoding': 'gzip'}
+        benchmark_list = [
+            ('get_stats',            utils.get_stats),
+            ('get_stats_vectorized', lambda: utils.get_stats(vectorized=True)),
+            ('get_summary_averages', utils.get_summary_averages),
+            ('get_summary_averages_vectorized',
+             lambda: utils.get_summary_averages(vectorized=True)),
+            ('get_summary',          aggregate.get_summary),
+            ('get_percentiles',      aggregate.get_percentiles),
+            ('get_points',           utils.get_points),
+            ('get_points_raw',       lambda: utils.get_points(resolution='raw')),
+            ('route_summary',        get_route(client, '/summary/')),
+            ('route_summary_gzip',   get_route(client, '/summary/', gzip_headers)),
+            ('route_points',         get_route(client, '/points/')),
+            ('route_outages',        get_route(client, '/outages/')),
+            ('route_download_csv',   get_route(client, '/download/log.csv?gzip=false')),
+            ('route_download_json',  get_route(client, '/download/log.json?gzip=false')),
+            ('route_download_gzip',  get_route(client, '/download/log.csv', gzip_headers)),
+        ]
+        result_list = [{
+            'name'   : 'populate',
+            'repeat' : 1,
+            'cold'   : populate_duration,
+            'min'    : populate_duration,
+            'median' : populate_duration,
+            'mean'   : populate_duration,
+            'max'    : populate_duration,
+        }]
+        for name, func in benchmark_list:
+            result_list.append(dict(measure(func, repeat=repeat), name=name))
+            args = (backend, records, name, result_list[-1]['median'], )
+            print('%s, %d records, %s: %0.06f sec.' % args)
+        # Append new SpeedTests after the history
+        end = time.time() + writes
+        record_iter = generate.generate_records(writes, interval=1.0, end=end,
+                                                seed=seed + 1)
+
+        def write():
+            utils.write_to_logs(**next(record_iter))
+        result_list.append(dict(measure(write, repeat=writes), name='write_to_logs'))
+        args = (backend, records, 'write_to_logs', result_list[-1]['median'], )
+        print('%s, %d records, %s: %0.06f sec.' % args)
+        # The columns appended to by the writes still match
+        check_columnar()
+        for result_dict in result_list:
+            result_dict['storage'] = backend
+            result_dict['records'] = records
+        return result_list
+    finally:
+        shutil.rmtree(home_path, ignore_errors=True)
+
+
+def configure_argparser():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    parser.add_argument('-r', '--records', type=int, nargs='+',
+                        default=[10000, 100000],
+                        help='the history sizes to benchmark (10k to 5M)')
+    parser.add_argument('-s', '--storage', type=str, nargs='+',
+                        default=['sqlite'],
+                        help='the storage engines to benchmark')
+    parser.add_argument('-n', '--repeat', type=int, default=5,
+                        help='how many times to run each benchmark')
+    parser.add_argument('-w', '--writes', type=int, default=100,
+                        help='how many SpeedTests to write')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='the random seed for the synthetic histories')
+    parser.add_argument('-o', '--output', type=str, default=None,
+                        help='the JSON report file (default benchmark-<time>.json)')
+    return parser.parse_args()
+
+
+def main():
+    args = configure_argparser()
+    from intercheck import utils
+    original_home = os.environ.get('HOME', None)
+    result_list = []
+    try:
+        for backend in args.storage:
+            for records in args.records:
+                result_list += benchmark(backend, records, repeat=args.repeat,
+                                         writes=args.writes, seed=args.seed)
+    finally:
+        if original_home is not None:
+            os.environ['HOME'] = original_home
+    report_dict = {
+        'version'  : utils.__version__,
+        'python'   : sys.version,
+        'platform' : platform.platform(),
+        'created'  : time.time(),
+        'seed'     : args.seed,
+        'results'  : result_list,
+    }
+    output_filepath = args.output
+    if output_filepath is None:
+        output_filepath = 'benchmark-%d.json' % (time.time(), )
+    with open(output_filepath, 'w') as output_file:
+        simplejson.dump(report_dict, output_file, indent=4, sort_keys=True)
+    print('Wrote benchmark report: %s' % (output_filepath, ))
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+Intercheck startup benchmark
+
+Times ``intercheck`` from the start of its process to its first SpeedTest (the
+``Performing SpeedTest...`` line), with the web interface and with
+``--headless``.  Every run has its own temporary ``~/.intercheck``, a free
+port, no connectivity probes and ``BROWSER=true`` (so no browser window opens),
+and is stopped as soon as the SpeedTest starts::
+
+    python -m benchmarks.startup --repeat 10
+"""
+from __future__ import absolute_import, division, print_function
+# Python built-in
+import subprocess
+import argparse
+import tempfile
+import logging
+import shutil
+import socket
+import time
+import sys
+import os
+
+
+# Configure the logger
+print = logging.warning
+
+
+MODE_DICT = {
+    'web'      : [],
+    'headless' : ['--headless'],
+}
+
+
+def free_port():
+    sock = socket.socket()
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+def startup(arg_list, timeout=60.0):
+    """ Return the seconds from starting ``intercheck`` to its first SpeedTest. """
+    home_path = tempfile.mkdtemp(prefix='intercheck-startup-')
+    env = dict(os.environ, HOME=home_path, BROWSER='true')
+    command = [sys.executable, '-c', 'import intercheck; intercheck.start()',
+               '--port', str(free_port()), '--probe-interval', '0'] + arg_list
+    start = time.time()
+    process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    try:
+        for line in iter(process.stdout.readline, b''):
+            if b'Performing SpeedTest' in line:
+                return time.time() - start
+            if time.time() - start > timeout:
+                break
+        raise RuntimeError('intercheck did not start a SpeedTest: %r' % (command, ))
+    finally:
+        process.kill()
+        process.wait()
+        shutil.rmtree(home_path, ignore_errors=True)
+
+
+def configure_argparser():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.startup')
+    parser.add_argument('-n', '--repeat', type=int, default=5,
+                        help='how many times to start each mode')
+    return parser.parse_args()
+
+
+def main():
+    args = configure_argparser()
+    median_dict = {}
+    for mode in sorted(MODE_DICT.keys(), reverse=True):
+        duration_list = sorted(startup(MODE_DICT[mode]) for index in range(args.repeat))
+        median_dict[mode] = duration_list[len(duration_list) // 2]
+        args_ = (mode, duration_list[0], median_dict[mode], duration_list[-1], )
+        print('%s: min %0.03f, median %0.03f, max %0.03f sec.' % args_)
+    speedup = median_dict['web'] / median_dict['headless']
+    print('Headless starts %0.02fx faster' % (speedup, ))
+
+
+if __name__ == '__main__':
+    main()
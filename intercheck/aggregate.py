@@ -0,0 +1,498 @@
+#!/usr/bin/env python
+"""
+Intercheck running summary aggregates
+
+The summary shown on the dashboard (the 1-day and 30-day averages and the
+downtime) is maintained incrementally: every record written by
+:func:`intercheck.utils.write_to_logs` is folded into a per-minute bucket, and
+each summary window keeps running totals over the buckets it covers.  Buckets
+that slide out of a window are subtracted again (the records of the bucket at
+its edge one at a time), so answering ``/summary/`` is constant time regardless
+of how long the history is.
+
+Percentiles cannot be maintained by subtraction, so :class:`QuantileAggregator`
+keeps a mergeable quantile sketch (see :mod:`intercheck.sketch`) per day
+instead, and answers each window by merging the days it covers.
+"""
+from __future__ import absolute_import, division, print_function
+# Intercheck
+from . import probe
+from . import sketch
+from . import utils
+# Python built-in
+import collections
+import threading
+import logging
+import math
+import time
+
+
+# Configure the logger
+print = logging.warning
+
+
+DAY_SECONDS = 60 * 60 * 24
+BUCKET_SECONDS = 60
+DAY_LIST = [1, 30]
+METRIC_LIST = ['ping', 'download', 'upload', 'duration']
+AGGREGATOR_DICT = {}
+QUANTILE_DAY_LIST = [1, 7, 30, 365]
+QUANTILE_METRIC_LIST = ['ping', 'download', 'upload']
+PERCENTILE_LIST = [5, 50, 95, 99]
+QUANTILE_AGGREGATOR_DICT = {}
+
+
+class Bucket(object):
+    """ The running totals of all of the records within a single minute.
+
+    The ``(start, value_dict)`` of each record is kept as well, so a window can
+    expire the records of the bucket at its edge one at a time.
+    """
+    __slots__ = ('index', 'count', 'total', 'records', 'entry_list')
+
+    def __init__(self, index):
+        self.index = index
+        self.count = collections.defaultdict(int)
+        self.total = collections.defaultdict(float)
+        self.records = 0
+        self.entry_list = []
+
+    @property
+    def end(self):
+        return (self.index + 1) * BUCKET_SECONDS
+
+
+class Window(object):
+    """ Running totals over the records of the last ``day`` days.
+
+    Whole buckets are subtracted once they are out of the window, and the
+    records of the first bucket one at a time (``offset`` of them so far), so
+    the averages match :func:`intercheck.utils.get_stats` exactly.
+    """
+    def __init__(self, day):
+        self.day = day
+        self.span = day * DAY_SECONDS
+        self.bucket_deque = collections.deque()
+        self.offset = 0
+        self.count = collections.defaultdict(int)
+        self.total = collections.defaultdict(float)
+        self.records = 0
+        # The records merged from other windows, see merge
+        self.merged_list = []
+        self.deviation_dict = None
+
+    def add(self, value_dict):
+        for key, value in value_dict.items():
+            self.count[key] += 1
+            self.total[key] += value
+        self.records += 1
+        self.deviation_dict = None
+
+    def subtract(self, value_dict):
+        for key, value in value_dict.items():
+            self.count[key] -= 1
+            self.total[key] -= value
+        self.records -= 1
+        self.deviation_dict = None
+
+    def expire(self, now):
+        thresh = now - self.span
+        while len(self.bucket_deque) > 0:
+            bucket = self.bucket_deque[0]
+            if bucket.end <= thresh and self.offset == 0:
+                # Out of the window at once, subtract the bucket totals
+                for key in bucket.count:
+                    self.count[key] -= bucket.count[key]
+                    self.total[key] -= bucket.total[key]
+                self.records -= bucket.records
+                self.deviation_dict = None
+                self.bucket_deque.popleft()
+                continue
+            # The edge of the window, subtract the records before it
+            for start, value_dict in bucket.entry_list[self.offset:]:
+                if start >= thresh:
+                    break
+                self.subtract(value_dict)
+                self.offset += 1
+            if bucket.end > thresh:
+                break
+            self.bucket_deque.popleft()
+            self.offset = 0
+
+    def merge(self, other):
+        """ Add the records of ``other`` (e.g. from another agent) to this window. """
+        for key in other.count:
+            self.count[key] += other.count[key]
+            self.total[key] += other.total[key]
+        self.records += other.records
+        self.merged_list.extend(other.iter_entries())
+        self.deviation_dict = None
+
+    def iter_entries(self):
+        """ Yield the ``(start, value_dict)`` of every record in the window. """
+        offset = self.offset
+        for bucket in self.bucket_deque:
+            for entry in bucket.entry_list[offset:]:
+                yield entry
+            offset = 0
+        for entry in self.merged_list:
+            yield entry
+
+    def deviations(self):
+        """ Return the mean absolute deviation of each metric, as in
+        :func:`intercheck.utils.get_summary_averages`.
+
+        Unlike the averages, it cannot be maintained by subtraction, so it is
+        computed from the records once every time the window changes.
+        """
+        if self.deviation_dict is None:
+            total_dict = collections.defaultdict(float)
+            for start, value_dict in self.iter_entries():
+                for key, value in value_dict.items():
+                    value_avg = self.total[key] / self.count[key]
+                    total_dict[key] += abs(value - value_avg)
+            self.deviation_dict = {
+                key : total / self.count[key]
+                for key, total in total_dict.items()
+            }
+        return self.deviation_dict
+
+    @property
+    def earliest(self):
+        offset = self.offset
+        for bucket in self.bucket_deque:
+            if offset < len(bucket.entry_list):
+                return bucket.entry_list[offset][0]
+            offset = 0
+        return None
+
+
+class SummaryAggregator(object):
+    """ Incrementally maintained summary statistics for one storage engine.
+
+    The aggregator is primed once from the storage engine and then kept up to
+    date by :func:`intercheck.utils.write_to_logs`.  The downtime is not part of
+    it, see :func:`get_summary`.
+    """
+    def __init__(self, storage, day_list=DAY_LIST):
+        self.storage = storage
+        self.day_list = sorted(day_list)
+        self.lock = threading.Lock()
+        self.dirty = True
+
+    def reset(self):
+        self.window_list = [ Window(day) for day in self.day_list ]
+        self.bucket = None
+        self.latest = None
+        self.dirty = False
+
+    def rebuild(self, now=None):
+        now = time.time() if now is None else now
+        self.reset()
+        thresh = now - self.window_list[-1].span
+        for record in self.storage.iter_records(start=thresh):
+            self._add(record)
+        self._expire(now)
+
+    def add(self, record):
+        with self.lock:
+            if self.dirty:
+                # Will be primed from storage, which already has this record
+                return
+            start = record.get('start', None)
+            if start is None or self.latest is None or start > self.latest:
+                self._add(record)
+            elif start < self.latest:
+                # Out of order, rebuild lazily on the next summary
+                self.dirty = True
+
+    def _add(self, record):
+        start = record.get('start', None)
+        if start is None:
+            return
+        # Find the bucket for this record
+        index = int(start // BUCKET_SECONDS)
+        if self.bucket is None or self.bucket.index != index:
+            self.bucket = Bucket(index)
+            for window in self.window_list:
+                window.bucket_deque.append(self.bucket)
+        bucket = self.bucket
+        # Get values
+        value_dict = {}
+        for key in METRIC_LIST:
+            value = record.get(key, None)
+            if value is None:
+                continue
+            value_dict[key] = value
+        # Update the bucket and every window
+        for key, value in value_dict.items():
+            bucket.count[key] += 1
+            bucket.total[key] += value
+        bucket.records += 1
+        bucket.entry_list.append((start, value_dict, ))
+        for window in self.window_list:
+            window.add(value_dict)
+        self.latest = start
+
+    def _expire(self, now):
+        for window in self.window_list:
+            window.expire(now)
+
+    def merge_into(self, window_list, now=None):
+        """ Add the windows of this aggregator to ``window_list`` (with the
+        same days), returns the earliest record within the largest window.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            if self.dirty:
+                self.rebuild(now=now)
+            self._expire(now)
+            for window, window_ in zip(window_list, self.window_list):
+                window.merge(window_)
+            return self.window_list[-1].earliest
+
+    def summary(self, round_values=False, now=None):
+        """ Return ``(stat_dict, record_interval)``, like
+        :func:`intercheck.utils.get_summary_averages()` without the downtime.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            if self.dirty:
+                self.rebuild(now=now)
+            self._expire(now)
+            stat_dict = {}
+            for window in self.window_list:
+                stat_dict[window.day] = self._window_stats(window, round_values)
+            earliest = self.window_list[-1].earliest
+        if earliest is None:
+            earliest = now
+        record_interval = now - earliest
+        return stat_dict, record_interval
+
+    @staticmethod
+    def _window_stats(window, round_values):
+        value_dict = {}
+        if window.records > 0:
+            value_dict['start'] = (0.0, 0.0, )
+        deviation_dict = window.deviations()
+        for key in METRIC_LIST:
+            count = window.count[key]
+            if count <= 0:
+                continue
+            value_avg = window.total[key] / count
+            value_dict[key] = (value_avg, deviation_dict[key], )
+        if round_values:
+            for key in value_dict:
+                value_avg, value_var = value_dict[key]
+                value_avg = float('%0.02f' % (value_avg, ))
+                value_var = float('%0.02f' % (value_var, ))
+                value_dict[key] = (value_avg, value_var, )
+        return value_dict
+
+
+class QuantileAggregator(object):
+    """ Percentiles of the ping, download and upload over sliding windows.
+
+    Like :class:`SummaryAggregator`, the aggregator is primed once from the
+    storage engine and then kept up to date by
+    :func:`intercheck.utils.write_to_logs`, but it keeps one
+    :class:`intercheck.sketch.DDSketch` per metric and (UTC) day.  A window is
+    the merge of the days entirely within it plus the records of its first,
+    partial day, which are read from storage, so the window boundaries are exact
+    and only the percentiles themselves are approximate.
+    """
+    def __init__(self, storage, day_list=QUANTILE_DAY_LIST, relative_accuracy=0.01):
+        self.storage = storage
+        self.day_list = sorted(day_list)
+        self.relative_accuracy = relative_accuracy
+        self.lock = threading.Lock()
+        self.dirty = True
+
+    def reset(self):
+        self.sketch_dict = {}
+        self.latest = None
+        self.dirty = False
+
+    def new_sketch_dict(self):
+        return {
+            key : sketch.DDSketch(self.relative_accuracy)
+            for key in QUANTILE_METRIC_LIST
+        }
+
+    def rebuild(self, now=None):
+        now = time.time() if now is None else now
+        self.reset()
+        thresh = now - self.day_list[-1] * DAY_SECONDS
+        for record in self.storage.iter_records(start=thresh):
+            self._add(record)
+
+    def add(self, record):
+        with self.lock:
+            if self.dirty:
+                # Will be primed from storage, which already has this record
+                return
+            start = record.get('start', None)
+            if start is None or self.latest is None or start > self.latest:
+                self._add(record)
+            elif start < self.latest:
+                # Out of order, rebuild lazily on the next query
+                self.dirty = True
+
+    def _add(self, record):
+        start = record.get('start', None)
+        if start is None:
+            return
+        day = int(start // DAY_SECONDS) * DAY_SECONDS
+        if day not in self.sketch_dict:
+            self.sketch_dict[day] = self.new_sketch_dict()
+        sketch_dict = self.sketch_dict[day]
+        for key in QUANTILE_METRIC_LIST:
+            value = record.get(key, None)
+            if value is not None:
+                sketch_dict[key].add(value)
+        self.latest = start
+
+    def _expire(self, now):
+        thresh = now - self.day_list[-1] * DAY_SECONDS - DAY_SECONDS
+        for day in list(self.sketch_dict):
+            if day < thresh:
+                self.sketch_dict.pop(day)
+
+    def window(self, day, now=None):
+        """ Return ``{key: sketch}`` over the last ``day`` days. """
+        now = time.time() if now is None else now
+        thresh = now - day * DAY_SECONDS
+        first_day = int(math.ceil(thresh / DAY_SECONDS)) * DAY_SECONDS
+        window_dict = self.new_sketch_dict()
+        for day_, sketch_dict in self.sketch_dict.items():
+            if day_ >= first_day:
+                for key in QUANTILE_METRIC_LIST:
+                    window_dict[key].merge(sketch_dict[key])
+        for record in self.storage.iter_records(start=thresh, end=first_day):
+            for key in QUANTILE_METRIC_LIST:
+                value = record.get(key, None)
+                if value is not None:
+                    window_dict[key].add(value)
+        return window_dict
+
+    def percentiles(self, round_values=False, now=None):
+        """ Return ``{day: {key: {'p<percentile>': value}}}``.
+
+        Every percentile in :data:`PERCENTILE_LIST` is reported for every
+        metric, e.g. ``p95`` and ``p99`` of the ping and ``p5`` of the
+        download; a metric without any value in a window is omitted.
+        """
+        now = time.time() if now is None else now
+        percentile_dict = {}
+        with self.lock:
+            if self.dirty:
+                self.rebuild(now=now)
+            self._expire(now)
+            for day in self.day_list:
+                window_dict = self.window(day, now=now)
+                percentile_dict[day] = {}
+                for key, sketch_ in window_dict.items():
+                    if sketch_.count == 0:
+                        continue
+                    value_dict = {}
+                    for percentile in PERCENTILE_LIST:
+                        value = sketch_.quantile(percentile / 100)
+                        if round_values:
+                            value = float('%0.02f' % (value, ))
+                        value_dict['p%d' % (percentile, )] = value
+                    value_dict['count'] = sketch_.count
+                    percentile_dict[day][key] = value_dict
+        return percentile_dict
+
+
+def get_aggregator(**kwargs):
+    storage = utils.get_storage(**kwargs)
+    if storage not in AGGREGATOR_DICT:
+        AGGREGATOR_DICT[storage] = SummaryAggregator(storage)
+    return AGGREGATOR_DICT[storage]
+
+
+def get_summary(round_values=False, **kwargs):
+    """ Return the running summary, see :meth:`SummaryAggregator.summary`.
+
+    The downtime comes from the outage index (see :mod:`intercheck.outage`),
+    or, while the connectivity probes run, from their outages (see
+    :mod:`intercheck.probe`), which are accurate to the probe interval.
+    """
+    aggregator = get_aggregator(**kwargs)
+    stat_dict, record_interval = aggregator.summary(round_values=round_values)
+    prober = probe.get_prober()
+    if kwargs.get('agent', None) is not None or kwargs.get('target', None) is not None:
+        # The probes only cover the (default) connection of this instance
+        prober = None
+    outage_index = utils.get_outage_index(**kwargs)
+    now = time.time()
+    for day in stat_dict:
+        if prober is not None:
+            downtime = prober.store.downtime(now - day * DAY_SECONDS, now) / 60
+        else:
+            downtime = outage_index.downtime(now - day * DAY_SECONDS) / 60
+        if round_values:
+            downtime = float('%0.02f' % (downtime, ))
+        stat_dict[day]['downtime'] = (downtime, 0.0, )
+    return stat_dict, record_interval
+
+
+def get_fleet_summary(round_values=False, **kwargs):
+    """ Return the summary of every fleet agent combined, see :func:`get_summary`.
+
+    The averages and deviations are over the SpeedTests of all of the agents,
+    and the downtime is the sum of the downtime of each agent (from its outage
+    index).
+
+    Returns:
+        tuple: ``(stat_dict, record_interval, agent_list)``
+    """
+    now = time.time()
+    window_list = [ Window(day) for day in DAY_LIST ]
+    earliest = None
+    agent_list = utils.get_agent_list(**kwargs)
+    for agent in agent_list:
+        aggregator = get_aggregator(agent=agent, **kwargs)
+        earliest_ = aggregator.merge_into(window_list, now=now)
+        if earliest_ is not None and (earliest is None or earliest_ < earliest):
+            earliest = earliest_
+    stat_dict = {}
+    for window in window_list:
+        value_dict = SummaryAggregator._window_stats(window, round_values)
+        stat_dict[window.day] = value_dict
+        downtime = 0.0
+        for agent in agent_list:
+            outage_index = utils.get_outage_index(agent=agent, **kwargs)
+            downtime += outage_index.downtime(now - window.span)
+        downtime /= 60
+        if round_values:
+            downtime = float('%0.02f' % (downtime, ))
+        value_dict['downtime'] = (downtime, 0.0, )
+    record_interval = now - (now if earliest is None else earliest)
+    return stat_dict, record_interval, agent_list
+
+
+def get_percentiles(round_values=False, **kwargs):
+    """ Return the percentiles, see :meth:`QuantileAggregator.percentiles`. """
+    storage = utils.get_storage(**kwargs)
+    if storage not in QUANTILE_AGGREGATOR_DICT:
+        QUANTILE_AGGREGATOR_DICT[storage] = QuantileAggregator(storage)
+    aggregator = QUANTILE_AGGREGATOR_DICT[storage]
+    return aggregator.percentiles(round_values=round_values)
+
+
+def update_aggregator(storage, record):
+    aggregator = AGGREGATOR_DICT.get(storage, None)
+    if aggregator is not None:
+        aggregator.add(record)
+    aggregator = QUANTILE_AGGREGATOR_DICT.get(storage, None)
+    if aggregator is not None:
+        aggregator.add(record)
+    # Detect outages as each SpeedTest is written, not when they are queried
+    outage_index = utils.OUTAGE_INDEX_DICT.get(storage, None)
+    if outage_index is not None:
+        outage_index.update()
+
+
+utils.register_write_listener(update_aggregator)
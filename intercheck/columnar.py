@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+"""
+Intercheck columnar statistics
+
+An optional, vectorized implementation of :func:`intercheck.utils.get_stats`
+and :func:`intercheck.utils.get_summary_averages` using NumPy.  The log is held
+as one float64 column per key in :data:`KEY_LIST` (failed values are NaN) and
+is kept up to date from the storage sequence, so only new records are read,
+and trimmed to the oldest window.  The engine is opt-in, with the
+``vectorized`` setting (``--vectorized``).
+Window masks, means, mean absolute deviations and downtime are computed with
+array operations.
+
+The results are identical to the pure-Python path, not just close: sums are
+taken with ``cumsum``, which (unlike ``sum``) adds the values one after another
+in the same order as Python's built-in ``sum``.
+"""
+from __future__ import absolute_import, division, print_function
+# Python built-in
+import threading
+import logging
+import time
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# Configure the logger
+print = logging.warning
+
+
+KEY_LIST = ['start', 'duration', 'ping', 'download', 'upload']
+COLUMNAR_DICT = {}
+
+
+def available():
+    return np is not None
+
+
+def sequential_sum(array):
+    # Python's sum, in the same order, unlike numpy.sum's pairwise summation
+    if len(array) == 0:
+        return 0
+    return float(np.cumsum(array)[-1])
+
+
+class ColumnarLog(object):
+    """ The records of a storage engine as NumPy columns, sorted by ``start``.
+
+    Only the records at or after the last ``start`` requested are kept (loaded
+    again if an earlier one is requested).  New records are appended using
+    :meth:`intercheck.storage.Storage.iter_since`; if one arrives out of order,
+    the columns are loaded again.
+    """
+    def __init__(self, storage):
+        self.storage = storage
+        self.lock = threading.Lock()
+        self.loaded_start = None
+        self.sequence = None
+        self.column_dict = None
+
+    def _to_columns(self, record_list):
+        return {
+            key : np.array([ record.get(key, None) for record in record_list ],
+                           dtype=np.float64)
+            for key in KEY_LIST
+        }
+
+    def _load(self, start):
+        self.sequence = self.storage.sequence()
+        record_list = list(self.storage.iter_records(start=start))
+        self.column_dict = self._to_columns(record_list)
+        self.loaded_start = start
+
+    def _update(self):
+        sequence = self.storage.sequence()
+        if sequence == self.sequence:
+            return
+        record_list = []
+        for sequence_, record in self.storage.iter_since(self.sequence):
+            sequence = max(sequence, sequence_)
+            if record.get('start', None) is not None and record['start'] >= self.loaded_start:
+                record_list.append(record)
+        record_list.sort(key=lambda record: record['start'])
+        start_column = self.column_dict['start']
+        if len(record_list) > 0 and len(start_column) > 0:
+            if record_list[0]['start'] <= start_column[-1]:
+                self._load(self.loaded_start)
+                return
+        if len(record_list) > 0:
+            new_column_dict = self._to_columns(record_list)
+            for key in KEY_LIST:
+                column = np.concatenate([self.column_dict[key], new_column_dict[key]])
+                self.column_dict[key] = column
+        self.sequence = sequence
+
+    def _trim(self, start):
+        index = np.searchsorted(self.column_dict['start'], start, side='left')
+        if index > 0:
+            # Copied, so the memory of the older records is released
+            self.column_dict = {
+                key : column[index:].copy()
+                for key, column in self.column_dict.items()
+            }
+        self.loaded_start = start
+
+    def columns(self, start):
+        """ Return the columns of the records at or after ``start``, the start
+        of the oldest window: the older records are dropped.
+        """
+        with self.lock:
+            if self.loaded_start is None or start < self.loaded_start:
+                self._load(start)
+            else:
+                self._update()
+                self._trim(start)
+            return self.column_dict
+
+
+def get_columnar(storage):
+    if storage not in COLUMNAR_DICT:
+        COLUMNAR_DICT[storage] = ColumnarLog(storage)
+    return COLUMNAR_DICT[storage]
+
+
+def compute_stats(storage, day_list=[1, 30], latest=None, now=None):
+    """ Return ``(value_dict, downtime_dict, record_interval)``.
+
+    ``value_dict[day][key]`` is the array of the values of ``key`` within the
+    window of ``day`` days (keys without any value are omitted) and
+    ``downtime_dict[day]`` the downtime, in seconds, as in
+    :func:`intercheck.utils.get_stats`.
+    """
+    now = time.time() if now is None else now
+    latest = -1 if latest is None else int(latest)
+    day_seconds = 60 * 60 * 24
+    day_list = sorted(day_list)
+    thresh_list = [ now - 60 * 60 * 24 * day for day in day_list ]
+    column_dict = get_columnar(storage).columns(thresh_list[-1])
+    # Respect a global latest limit, if specified
+    index = np.searchsorted(column_dict['start'], latest, side='left')
+    column_dict = { key : column[index:] for key, column in column_dict.items() }
+    start_column = column_dict['start']
+    value_dict = { day : {} for day in day_list }
+    downtime_dict = { day : 0.0 for day in day_list }
+    if len(start_column) == 0:
+        return value_dict, downtime_dict, 0.0
+    start_earliest = start_column[0]
+    # A record is a failure if any of its values is missing
+    missing_dict = { key : np.isnan(column) for key, column in column_dict.items() }
+    failed = np.zeros(len(start_column), dtype=bool)
+    for key in KEY_LIST:
+        failed |= missing_dict[key]
+    # Window masks, the windows are nested so each is a suffix of the columns
+    index_list = [ np.searchsorted(start_column, thresh, side='left')
+                   for thresh in thresh_list ]
+    for day, index in zip(day_list, index_list):
+        for key in KEY_LIST:
+            present = ~missing_dict[key][index:]
+            if present.any():
+                value_dict[day][key] = column_dict[key][index:][present]
+    # Downtime: each successful record right after a failure ends an outage,
+    # which started at the previous successful record
+    ended = np.zeros(len(start_column), dtype=bool)
+    ended[1:] = ~failed[1:] & failed[:-1]
+    if ended.any():
+        succeeded = np.flatnonzero(~failed)
+        ended_index = np.flatnonzero(ended)
+        # The position of each ended outage among the successful records
+        position = np.searchsorted(succeeded, ended_index, side='left')
+        connected = np.empty(len(ended_index), dtype=np.float64)
+        has_previous = position > 0
+        connected[has_previous] = start_column[succeeded[position[has_previous] - 1]]
+        if not has_previous.all():
+            # Only the first outage can lack a previous successful record
+            start = start_column[ended_index[0]]
+            for thresh in thresh_list:
+                if start >= thresh:
+                    break
+            start_day = int(thresh / day_seconds) * day_seconds
+            connected[0] = max(start_earliest, start_day)
+        gap = start_column[ended_index] - connected
+        ended_start = start_column[ended_index]
+        for day, thresh in zip(day_list, thresh_list):
+            downtime_dict[day] = 0.0 + sequential_sum(gap[ended_start >= thresh])
+    record_interval = now - float(start_earliest)
+    return value_dict, downtime_dict, record_interval
+
+
+def get_stats(storage, day_list=[1, 30], latest=None, now=None):
+    """ See :func:`intercheck.utils.get_stats`. """
+    value_dict, downtime_dict, record_interval = compute_stats(storage, day_list,
+                                                               latest, now)
+    stat_dict = {}
+    for day in value_dict:
+        stat_dict[day] = {
+            key : column.tolist()
+            for key, column in value_dict[day].items()
+        }
+        stat_dict[day]['downtime'] = downtime_dict[day]
+    return stat_dict, record_interval
+
+
+def get_summary_averages(storage, round_values=False, day_list=[1, 30],
+                         latest=None, now=None):
+    """ See :func:`intercheck.utils.get_summary_averages`. """
+    value_dict, downtime_dict, record_interval = compute_stats(storage, day_list,
+                                                               latest, now)
+    stat_dict = {}
+    for day in value_dict:
+        stat_dict[day] = {
+            'downtime' : (downtime_dict[day] / 60, 0.0, ),
+        }
+        for key, column in value_dict[day].items():
+            if key == 'start':
+                stat_dict[day][key] = (0.0, 0.0, )
+                continue
+            value_avg = sequential_sum(column) / len(column)
+            value_var = sequential_sum(np.abs(column - value_avg)) / len(column)
+            stat_dict[day][key] = (value_avg, value_var, )
+        if round_values:
+            for key in stat_dict[day]:
+                value_avg, value_var = stat_dict[day][key]
+                value_avg = float('%0.02f' % (value_avg, ))
+                value_var = float('%0.02f' % (value_var, ))
+                stat_dict[day][key] = (value_avg, value_var, )
+    return stat_dict, record_interval
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""
+Intercheck settings service
+
+The settings are read by every page view, every settings change and every
+iteration of the background thread.  :class:`SettingsService` keeps the parsed
+``settings.json`` in memory and only re-reads it when the file's ``stat``
+(modification time, size and inode) changes, which catches edits made outside
+of Intercheck.  Saving writes a temporary file and renames it over the
+original, so a reader never sees a half-written file, and bumps
+:attr:`SettingsService.version`.  Listeners registered with
+:meth:`SettingsService.subscribe` are called with the new settings whenever
+they change, from either source.
+"""
+from __future__ import absolute_import, division, print_function
+# Python built-in
+import simplejson
+import threading
+import logging
+import os
+
+
+# Configure the logger
+print = logging.warning
+
+
+def file_signature(filepath):
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size, stat.st_ino, )
+
+
+def write_atomic(filepath, content):
+    temp_filepath = '%s.%d.tmp' % (filepath, os.getpid(), )
+    with open(temp_filepath, 'w') as temp_file:
+        temp_file.write(content)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    try:
+        os.rename(temp_filepath, filepath)
+    except OSError:
+        # Windows will not rename over an existing file
+        os.remove(filepath)
+        os.rename(temp_filepath, filepath)
+
+
+class SettingsService(object):
+    """ The cached settings of one ``settings.json`` file.
+
+    Args:
+        settings_filepath (str): the JSON file holding the settings
+        default_dict (dict): the default value of every setting, used for any
+            key missing from the file (and for the whole file if it is missing
+            or corrupt)
+    """
+    def __init__(self, settings_filepath, default_dict):
+        self.settings_filepath = settings_filepath
+        self.default_dict = dict(default_dict)
+        self.lock = threading.RLock()
+        self.settings_dict = None
+        self.signature = None
+        self.version = 0
+        self.listener_list = []
+
+    def subscribe(self, listener):
+        """ Call ``listener(settings_dict)`` whenever the settings change. """
+        with self.lock:
+            if listener not in self.listener_list:
+                self.listener_list.append(listener)
+
+    def unsubscribe(self, listener):
+        with self.lock:
+            if listener in self.listener_list:
+                self.listener_list.remove(listener)
+
+    def _notify(self, settings_dict):
+        for listener in list(self.listener_list):
+            try:
+                listener(dict(settings_dict))
+            except Exception as unexpected:
+                print('Settings listener failed: %r' % (unexpected, ))
+
+    def _changed(self, settings_dict):
+        previous_dict = self.settings_dict
+        self.settings_dict = settings_dict
+        self.signature = file_signature(self.settings_filepath)
+        if settings_dict != previous_dict:
+            self.version += 1
+            # Nobody has seen the settings before the first load
+            if previous_dict is not None:
+                self._notify(settings_dict)
+
+    def _load(self):
+        settings_dict = dict(self.default_dict)
+        try:
+            with open(self.settings_filepath, 'r') as settings_file:
+                settings_dict.update(simplejson.loads(settings_file.read()))
+        except (IOError, ValueError):
+            self._save(settings_dict)
+            return
+        self._changed(settings_dict)
+
+    def _save(self, settings_dict):
+        content = simplejson.dumps(settings_dict)
+        write_atomic(self.settings_filepath, content)
+        self._changed(dict(settings_dict))
+
+    def get(self):
+        """ Return a copy of the current settings, re-reading them if needed. """
+        with self.lock:
+            signature = file_signature(self.settings_filepath)
+            if self.settings_dict is None or signature != self.signature:
+                self._load()
+            return dict(self.settings_dict)
+
+    def save(self, settings_dict):
+        """ Replace the settings on disk and in memory. """
+        with self.lock:
+            self._save(settings_dict)
+
+    def update(self, **kwargs):
+        """ Change some of the settings, returns the new settings. """
+        with self.lock:
+            settings_dict = self.get()
+            settings_dict.update(kwargs)
+            self._save(settings_dict)
+            return dict(settings_dict)
@@ -1,15 +1,17 @@
 #!/usr/bin/env python
 from __future__ import absolute_import, division, print_function
-# HTTP / HTML
-import tornado
-import tornado.wsgi
-import tornado.httpserver
 # Intercheck
+from . import engine
+from . import events
+from . import fleet
+from . import metrics
+from . import probe
+from . import schedule
+from . import targets
 from . import utils
-from . import routes
+from . import transfer
 # Python built-in
-import webbrowser
-import threading
+import functools
 import logging
 import httplib
 import socket
@@ -22,120 +24,111 @@ print = logging.warning
 utils.configure_logging()
 
 
-# Get a handle on the APP
-APP = routes.APP
-
-
-def background(settings_filepath, min_interval_connected=60.0,
-               min_interval_disconnected=30.0, force_check_interval=1,
-               debug=True):
-    duration_run_avg = None
-    while True:
-        # Load settings
-        settings_dict = utils.load_settings(quiet=True)
-        interval = settings_dict.get('interval')
-        interval_exact = settings_dict.get('interval_exact')
-        # Check the interval to make sure it is reasonable
-        if interval < min_interval_connected:
-            print('Warning, interval less than 1 minute (minimum interval)')
-            interval = max(min_interval_connected, interval)
-        if interval < duration_run_avg:
-            print('Warning, interval less than average duration')
-        # Run SpeedTest
-        APP.status.discard('waiting')
-        APP.status.add('testing')
-        result_dict = speedtest()
-        APP.status.discard('testing')
-        APP.status.add('waiting')
-        # Check for success
-        success = result_dict.get('success')
-        if success:
-            APP.status.discard('disconnected')
-            APP.status.add('connected')
-        else:
-            APP.status.discard('connected')
-            APP.status.add('disconnected')
-            interval = min_interval_disconnected
-        # Get duration and update running average
-        duration = result_dict.get('duration')
-        if duration_run_avg is None:
-            duration_run_avg = duration
-        else:
-            duration_run_avg = (duration_run_avg + duration) * 0.5
-        # Calculate the timeout
-        timeout = max(0, interval - duration)
-        current = time.time()
-        future = current + timeout
-        # Correct for Intercheck overhead, round timeout to the nearest minute
-        offset = 0.0
-        if interval_exact:
-            near_interval = 60.0 if success else min_interval_disconnected
-            nearest = round(future / near_interval) * near_interval
-            offset = nearest - future
-        # Correct timeout and future
-        timeout += offset
-        future += offset
-        # Output results of the SpeedTest
-        time_str = time.strftime('%D %H:%M:%S', time.localtime(future))
-        if debug:
-            args = (interval, offset, duration_run_avg, )
-            additional = ' (interval %0.2f, offset %0.2f, avg. %0.3f)' % args
-        else:
-            additional = ''
-        args = (timeout, time_str, additional)
-        print('Waiting for next check in %0.2f sec. at %s%s' % args)
-        # Sleep for the timeout duration, checking for the force file
-        while timeout > 0:
-            timeout_small = min(force_check_interval, timeout)
-            timeout -= timeout_small
-            if utils.check_force():
-                print('Forcing...')
-                break
-            time.sleep(timeout_small)
+# The SpeedTest schedulers and measurement targets (by target name, None
+# without targets) and the speedtest-cli found, see start
+SCHEDULER_DICT = {}
+TARGET_DICT = {}
+SPEEDTEST_CLI = None
 
 
-def start_background(settings_filepath):
-    if hasattr(APP, 'background_thread') and APP.background_thread is not None:
-        print('Cannot start the background process, already running')
-        return
-    args = [settings_filepath]
-    APP.background_thread = threading.Thread(target=background, args=args)
-    APP.background_thread.setDaemon(True)
-    APP.background_thread.start()
-    APP.background_thread.join(0)
+def push_to_aggregator(storage_, record):
+    # Only this instance's SpeedTests, not the ones pushed to it by agents
+    pusher = fleet.get_pusher()
+    if pusher is not None and storage_ is utils.get_storage():
+        pusher.push(record)
 
 
-def speedtest(verbose=True):
-    # Ensure we have the speedtest-cli to use
-    find_speedtest(quiet=True)
+def measure(source=None, server=None):
+    """ Return ``(ping, download, upload)``, measured from ``source`` (an
+    interface or IP address) against the speedtest.net ``server``.
+
+    Runs in a worker process of the measurement pool, see :mod:`intercheck.targets`.
+    """
+    source_address = targets.source_address(source)
+    if engine.available():
+        return engine.get_engine(source_address=source_address, server_id=server).run()
+    return speedtest_cli(source=source_address, server=server)
+
+
+def measure_target(target):
+    # In the measurement pool, if started, otherwise in this process
+    args = (target['source'], target['server'], )
+    pool = targets.get_pool()
+    try:
+        if pool is None:
+            return measure(*args)
+        return pool.run(measure, *args)
+    except Exception as error:
+        print('SpeedTest of %s failed: %r' % (target['name'], error, ))
+        return None, None, None
+
+
+def run_speedtest(target=None):
+    """ Run a scheduled SpeedTest, of ``target`` if given (a target dictionary,
+    see :func:`intercheck.targets.parse_target`), returns True if it succeeded.
+    """
+    # Notice settings edited outside of Intercheck, see settings_changed
+    utils.load_settings(quiet=True)
+    name = None if target is None else target['name']
+    update_status(add='testing', discard='waiting', target=name)
+    result_dict = speedtest(target=target)
+    update_status(add='waiting', discard='testing', target=name)
+    success = result_dict.get('success')
+    if name is not None:
+        update_connected_status(success, target=name)
+    if probe.get_prober() is None:
+        # Otherwise, the connectivity probes drive the status
+        connected = success
+        if name is not None:
+            # Connected through any of the targets
+            connected = any(
+                'connected' in events.get_status(target=name_)
+                for name_ in TARGET_DICT
+            )
+        update_connected_status(connected)
+    return success
+
+
+def scheduler_kwargs(settings_dict, target=None, min_interval=60.0):
+    interval = settings_dict.get('interval')
+    if target is not None and target['interval'] is not None:
+        interval = target['interval']
+    # Check the interval to make sure it is reasonable
+    if interval < min_interval:
+        print('Warning, interval less than 1 minute (minimum interval)')
+        interval = max(min_interval, interval)
+    kwargs = {
+        'interval' : interval,
+        'align'    : settings_dict.get('interval_exact'),
+        'missed'   : settings_dict.get('missed'),
+    }
+    return kwargs
+
+
+def settings_changed(settings_dict):
+    print('Settings changed')
+    for name, scheduler in SCHEDULER_DICT.items():
+        target = TARGET_DICT.get(name, None)
+        scheduler.configure(**scheduler_kwargs(settings_dict, target=target))
+    utils.set_force()
+
+
+def speedtest(verbose=True, target=None):
+    name = None if target is None else target['name']
     # Start the SpeedTest
     if verbose:
-        print('Performing SpeedTest...')
+        if name is None:
+            print('Performing SpeedTest...')
+        else:
+            print('Performing SpeedTest of %s...' % (name, ))
     start, duration, ping, download, upload = None, None, None, None, None
     with utils.Timer() as timer:
-        try:
-            with os.popen(' '.join([APP.server_cli, '--simple'])) as response:
-                for line in response:
-                    line = line.strip().split()
-                    if len(line) == 3:
-                        try:
-                            key, value = line[:2]
-                            value = float(value)
-                            if key.startswith('Ping'):
-                                ping     = value
-                            if key.startswith('Download'):
-                                download = value
-                            if key.startswith('Upload'):
-                                upload   = value
-                        except IndexError:
-                            pass
-                        except ValueError:
-                            pass
-        except httplib.BadStatusLine:
-            pass
-        except Exception as unexpected:
-            print('\n\nCAUGHT UNEXPECTED EXCEPTION: %r\n\n' % (unexpected, ))
-            pass
+        if target is not None:
+            ping, download, upload = measure_target(target)
+        elif engine.available():
+            ping, download, upload = engine.get_engine().run()
+        else:
+            ping, download, upload = speedtest_cli()
     # Compile the results, possibly print
     start = timer.start
     duration = timer.duration
@@ -162,66 +155,248 @@ def speedtest(verbose=True):
         'upload'   : upload,
         'success'  : not failure,
     }
-    # Write results to log(s)
+    # Write results to log(s) and push them to any listening dashboards
+    if name is not None:
+        result_dict['target'] = name
     utils.write_to_logs(**result_dict)
+    events.publish('sample' if name is None else 'sample.%s' % (name, ), result_dict)
+    metrics.record_speedtest(result_dict)
     return result_dict
 
 
+def speedtest_cli(source=None, server=None):
+    # Ensure we have the speedtest-cli to use
+    find_speedtest(quiet=True)
+    command_list = [SPEEDTEST_CLI, '--simple']
+    if source is not None:
+        command_list += ['--source', source]
+    if server is not None:
+        command_list += ['--server', '%d' % (server, )]
+    ping, download, upload = None, None, None
+    try:
+        with os.popen(' '.join(command_list)) as response:
+            for line in response:
+                line = line.strip().split()
+                if len(line) == 3:
+                    try:
+                        key, value = line[:2]
+                        value = float(value)
+                        if key.startswith('Ping'):
+                            ping     = value
+                        if key.startswith('Download'):
+                            download = value
+                        if key.startswith('Upload'):
+                            upload   = value
+                    except IndexError:
+                        pass
+                    except ValueError:
+                        pass
+    except httplib.BadStatusLine:
+        pass
+    except Exception as unexpected:
+        print('\n\nCAUGHT UNEXPECTED EXCEPTION: %r\n\n' % (unexpected, ))
+        pass
+    return ping, download, upload
+
+
 def find_speedtest(command='speedtest-cli', quiet=False):
+    global SPEEDTEST_CLI
     # Check to see if speedtest-cli has already been found
-    if hasattr(APP, 'server_cli') and APP.server_cli is not None:
+    if SPEEDTEST_CLI is not None:
         if not quiet:
-            print('Cached %s (%s)' % (command, APP.server_cli, ))
+            print('Cached %s (%s)' % (command, SPEEDTEST_CLI, ))
         return
-    # Find speedtest-cli using bash 'which'
-    with os.popen(' '.join(['which', command])) as response:
-        for line in response:
-            line = line.strip()
-            if len(line) > 0 and line.endswith(command):
-                APP.server_cli = os.path.abspath(line)
-                print('Found %s (%s)' % (command, APP.server_cli, ))
-                break  # Gaurantee only first line is processed
-            else:
-                message = 'Command line interface %r cannot be found, ' + \
-                          'install using \'pip install speedtest-cli\''
-                raise RuntimeError(message % (command, ))
+    # Search the PATH, as 'which' would, without starting a shell
+    for path in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        filepath = os.path.join(path, command)
+        if os.path.isfile(filepath) and os.access(filepath, os.X_OK):
+            SPEEDTEST_CLI = os.path.abspath(filepath)
+            print('Found %s (%s)' % (command, SPEEDTEST_CLI, ))
+            return
+    message = 'Command line interface %r cannot be found, ' + \
+              'install using \'pip install speedtest-cli\''
+    raise RuntimeError(message % (command, ))
 
 
-def start(**kwargs):
-    # Configure the command line argument parser
-    cl_settings_dict = utils.configure_argparser()
-    # Load last settings from disk, if first time load default settings in utils
-    settings_dict = utils.load_settings(quiet=True)
-    # Update settings with command line argument settings
-    settings_dict.update(cl_settings_dict)
-    # Update settings with instance-specific settings
-    settings_dict.update(kwargs)
-    # Save settings
-    utils.save_settings(settings_dict, quiet=False)
+def start_scheduler(settings_dict, io_loop, target_list=[],
+                    min_interval_disconnected=30.0):
+    """ Run the SpeedTests on ``io_loop``, see :mod:`intercheck.schedule`.
+
+    Each measurement target (see :mod:`intercheck.targets`) has its own
+    scheduler; without targets, the SpeedTests of this instance have one.
+    """
+    if len(SCHEDULER_DICT) > 0:
+        print('Cannot start the scheduler, already running')
+        return
+    for target in target_list or [None]:
+        name = None if target is None else target['name']
+        func = functools.partial(run_speedtest, target=target)
+        kwargs = scheduler_kwargs(settings_dict, target=target)
+        SCHEDULER_DICT[name] = schedule.Scheduler(
+            func, retry_interval=min_interval_disconnected, io_loop=io_loop, **kwargs)
+        TARGET_DICT[name] = target
+
+    def wake():
+        for scheduler in SCHEDULER_DICT.values():
+            scheduler.wake()
+
+    watch_force(wake, io_loop)
+    for scheduler in SCHEDULER_DICT.values():
+        scheduler.start()
+
+
+def transfer_command(settings_dict):
+    """ Run ``intercheck import`` or ``intercheck export``. """
+    kwargs = {}
+    for key in ['agent', 'target']:
+        if settings_dict.get(key) is not None:
+            kwargs[key] = settings_dict.get(key)
+    storage_ = utils.get_storage(backend=settings_dict.get('storage'), **kwargs)
+    format_ = settings_dict.get('format')
+    start = settings_dict.get('start')
+    end = settings_dict.get('end')
+    if settings_dict.get('command') == 'export':
+        output_filepath = settings_dict.get('output')
+        size = transfer.export_records(storage_, output_filepath, format_=format_,
+                                       start=start, end=end)
+        if output_filepath != '-':
+            print('Exported %d bytes to %s' % (size, output_filepath, ))
+        return
+    for input_filepath in settings_dict.get('input'):
+        def on_progress(read):
+            print('\t%s: %d records read' % (input_filepath, read, ))
+        with utils.Timer() as timer:
+            record_iter = transfer.iter_file(input_filepath, format_=format_)
+            read, written = transfer.import_records(storage_, record_iter, start=start,
+                                                    end=end, on_progress=on_progress)
+        args = (written, read, input_filepath, timer.duration, )
+        print('Imported %d new of %d records from %s in %0.03f sec.' % args)
+    print('Restart Intercheck, if it is running, to refresh its summaries')
+
+
+def serve(settings_dict):
+    """ Start the web interface on the IOLoop and open it in a browser.
+
+    The web stack (Flask, Tornado and :mod:`intercheck.routes`) is only
+    imported here, so ``--headless`` never loads it.
+
+    Returns:
+        bool: False if the port is already in use
+    """
+    import tornado.httpserver
+    import webbrowser
+    from . import routes
+    from . import server
     # Determine the IP address
     try:
-        APP.server_ip_address = socket.gethostbyname(socket.gethostname())
+        server_ip_address = socket.gethostbyname(socket.gethostname())
     except socket.gaierror:
-        APP.server_ip_address = '127.0.0.1'
-    APP.server_port = settings_dict.get('port')
+        server_ip_address = '127.0.0.1'
+    server_port = settings_dict.get('port')
     # Initialize the web handler
     try:
-        wsgi_container = tornado.wsgi.WSGIContainer(APP)
-        http_server = tornado.httpserver.HTTPServer(wsgi_container)
-        http_server.listen(APP.server_port)
+        workers = settings_dict.get('workers')
+        application = server.make_application(routes.APP, workers=workers)
+        http_server = tornado.httpserver.HTTPServer(application)
+        http_server.listen(server_port)
     except socket.error:
-        args = (APP.server_port, )
+        args = (server_port, )
         print('Cannot start Intercheck on port %d, already in use' % args)
-        return
+        return False
     # Determine the URL for this server
-    url = 'http://%s:%s' % (APP.server_ip_address, APP.server_port)
+    url = 'http://%s:%s' % (server_ip_address, server_port)
     print('Intercheck starting at %s' % (url,))
     # Open URL in default browser
     print('Opening Intercheck using system\'s default browser')
     webbrowser.open(url)
-    # Start the IO loop, blocking
-    start_background('')
-    tornado.ioloop.IOLoop.instance().start()
+    return True
+
+
+def update_status(add=None, discard=None, target=None):
+    # The status is kept by the event broadcaster, see events.update_status
+    events.update_status(add=add, discard=discard, target=target)
+
+
+def update_connected_status(connected, target=None):
+    if connected:
+        update_status(add='connected', discard='disconnected', target=target)
+    else:
+        update_status(add='disconnected', discard='connected', target=target)
+
+
+def watch_force(callback, io_loop, poll_interval=1.0):
+    """ Call ``callback()`` on ``io_loop`` whenever a SpeedTest is forced.
+
+    A force is signalled by :func:`intercheck.utils.set_force()` or by creating
+    the ``~/.intercheck/force`` file, which is watched with inotify where
+    available; otherwise it is checked every ``poll_interval`` seconds.
+    """
+    import tornado.ioloop
+    force_trigger = utils.FORCE_TRIGGER
+    watched = force_trigger.watch(utils.get_force_filepath())
+
+    def on_readable(fd, events_):
+        if force_trigger.poll():
+            print('Forcing...')
+            callback()
+
+    for fd in force_trigger.fileno_list():
+        io_loop.add_handler(fd, on_readable, io_loop.READ)
+    if not watched:
+        def check_force():
+            if utils.check_force():
+                print('Forcing...')
+                callback()
+        tornado.ioloop.PeriodicCallback(check_force, poll_interval * 1000).start()
+
+
+def start(**kwargs):
+    # Configure the command line argument parser
+    cl_settings_dict = utils.configure_argparser()
+    if cl_settings_dict.get('command') is not None:
+        # intercheck import / export, without starting the server
+        transfer_command(cl_settings_dict)
+        return
+    # Load last settings from disk, if first time load default settings in utils
+    settings_dict = utils.load_settings(quiet=True)
+    # Update settings with command line argument settings
+    settings_dict.update(cl_settings_dict)
+    # Update settings with instance-specific settings
+    settings_dict.update(kwargs)
+    try:
+        target_list = targets.parse_targets(settings_dict.get('targets'))
+        probe.parse_targets(settings_dict.get('probe_targets'))
+    except ValueError as error:
+        print('Cannot start Intercheck: %s' % (error, ))
+        return
+    # Save settings
+    utils.save_settings(settings_dict, quiet=False)
+    # Re-run the SpeedTest (and reschedule) whenever the settings change
+    utils.register_settings_listener(settings_changed)
+    # Fork the measurement pool before any server socket or thread is started
+    if len(target_list) > 0:
+        targets.start_pool(settings_dict.get('target_concurrency'))
+    headless = settings_dict.get('headless')
+    if not headless and not serve(settings_dict):
+        return
+    # Start the connectivity probes and the SpeedTests in the background
+    probe_filepath = utils.get_probe_filepath()
+    probe_target_list = settings_dict.get('probe_targets')
+    probe_interval = settings_dict.get('probe_interval')
+    probe.start_probes(probe_filepath, probe_target_list, probe_interval,
+                       on_status=update_connected_status)
+    # Push the SpeedTests to the fleet aggregator, if any
+    spool_filepath = utils.get_spool_filepath()
+    pusher = fleet.start_pusher(spool_filepath, settings_dict.get('aggregator'),
+                                agent=settings_dict.get('agent'),
+                                token=settings_dict.get('fleet_token'))
+    if pusher is not None:
+        utils.register_write_listener(push_to_aggregator)
+    # Schedule the SpeedTests and start the IO loop, blocking
+    import tornado.ioloop
+    io_loop = tornado.ioloop.IOLoop.instance()
+    start_scheduler(settings_dict, io_loop, target_list=target_list)
+    io_loop.start()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""
+Intercheck downsampling
+
+The graphs cannot show more than a few hundred points per metric, so the point
+series sent by ``/points/`` are reduced with the Largest-Triangle-Three-Buckets
+(LTTB) algorithm, which keeps the visual shape (peaks, dips and outages) of the
+series while bounding its length.
+"""
+from __future__ import absolute_import, division, print_function
+
+
+def lttb(point_list, max_points):
+    """ Downsample a series with Largest-Triangle-Three-Buckets.
+
+    Args:
+        point_list (list of list): the points, ordered by time, where each point
+            is ``[x, y, ...]``; any additional values are carried through.
+        max_points (int): the maximum number of points to return (at least 3)
+
+    Returns:
+        point_list (list of list): at most ``max_points`` of the original
+            points, always including the first and the last.
+    """
+    length = len(point_list)
+    max_points = max(max_points, 3)
+    if length <= max_points:
+        return list(point_list)
+    sampled_list = [point_list[0]]
+    every = (length - 2) / (max_points - 2)
+    a = 0
+    for index in range(max_points - 2):
+        # Average point of the next bucket
+        next_start = int((index + 1) * every) + 1
+        next_end = min(int((index + 2) * every) + 1, length)
+        next_count = next_end - next_start
+        avg_x = sum(point[0] for point in point_list[next_start:next_end]) / next_count
+        avg_y = sum(point[1] for point in point_list[next_start:next_end]) / next_count
+        # Point of the current bucket with the largest triangle
+        start = int(index * every) + 1
+        end = int((index + 1) * every) + 1
+        point_x, point_y = point_list[a][0], point_list[a][1]
+        best_area, best = -1.0, start
+        for candidate in range(start, end):
+            x, y = point_list[candidate][0], point_list[candidate][1]
+            area = abs((point_x - avg_x) * (y - point_y) -
+                       (point_x - x) * (avg_y - point_y))
+            if area > best_area:
+                best_area, best = area, candidate
+        sampled_list.append(point_list[best])
+        a = best
+    sampled_list.append(point_list[-1])
+    return sampled_list
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""
+Intercheck in-process SpeedTest engine
+
+Running ``speedtest-cli`` starts a new Python interpreter for every SpeedTest,
+which downloads the speedtest.net configuration and server list and pings the
+closest servers before measuring anything.  :class:`SpeedTestEngine` uses the
+``speedtest`` module (installed by ``speedtest-cli``) in-process instead and
+keeps the configuration and the latency-ranked server list between runs.  On
+each run, only the latency of the current best server is measured; the servers
+are re-ranked when that latency drifts too far from its ranked value or when
+the cached list expires.
+
+The engine needs the ``speedtest`` 2.x API (``Speedtest(source_address=...)``);
+with an older ``speedtest-cli``, the ``speedtest-cli`` command is run instead.
+"""
+from __future__ import absolute_import, division, print_function
+# Python built-in
+import threading
+import logging
+import time
+try:
+    import speedtest as speedtest_lib
+except ImportError:
+    speedtest_lib = None
+
+
+# Configure the logger
+print = logging.warning
+
+
+ENGINE_DICT = {}
+# The first speedtest-cli version whose Speedtest takes a source_address
+MINIMUM_VERSION = (2, 0, 0, )
+
+
+class SpeedTestEngine(object):
+    """ A reusable speedtest.net client with cached configuration and servers.
+
+    Args:
+        config_ttl (float): seconds before the configuration is downloaded again
+        server_ttl (float): seconds before the server list is ranked again
+        drift (float): re-rank the servers if the best server's latency grows
+            by more than this fraction of its ranked latency
+        candidates (int): the number of closest servers to rank by latency
+        source_address (str): the local address to bind to, if any
+        server_id (int): always use this speedtest.net server, if given
+    """
+    def __init__(self, config_ttl=60 * 60 * 6, server_ttl=60 * 60 * 24,
+                 drift=0.5, candidates=5, source_address=None, server_id=None):
+        self.config_ttl = config_ttl
+        self.server_ttl = server_ttl
+        self.drift = drift
+        self.candidates = candidates
+        self.source_address = source_address
+        self.server_id = server_id
+        self.lock = threading.Lock()
+        self.client = None
+        self.config_time = None
+        self.server_list = []
+        self.server_time = None
+
+    def _get_client(self, now):
+        expired = self.config_time is None or now - self.config_time > self.config_ttl
+        if self.client is None or expired:
+            self.client = speedtest_lib.Speedtest(source_address=self.source_address)
+            self.config_time = now
+        return self.client
+
+    def _rank_servers(self, client, now):
+        client.closest = []
+        if self.server_id is None:
+            client.get_servers()
+            candidate_list = client.get_closest_servers(limit=self.candidates)
+        else:
+            client.get_servers(servers=[self.server_id])
+            candidate_list = client.get_closest_servers(limit=1)
+        server_list = []
+        for server in candidate_list:
+            try:
+                server = client.get_best_server([server])
+            except speedtest_lib.SpeedtestBestServerFailure:
+                continue
+            server_list.append((server['latency'], server, ))
+        server_list.sort(key=lambda latency_server: latency_server[0])
+        self.server_list = server_list
+        self.server_time = now
+        if len(server_list) > 0:
+            args = (len(server_list), server_list[0][1].get('sponsor'),
+                    server_list[0][0], )
+            print('Ranked %d SpeedTest servers, best is %s (%0.03f ms)' % args)
+
+    def _select_server(self, client, now):
+        expired = self.server_time is None or now - self.server_time > self.server_ttl
+        if len(self.server_list) == 0 or expired:
+            self._rank_servers(client, now)
+        if len(self.server_list) == 0:
+            raise speedtest_lib.SpeedtestBestServerFailure('No servers available')
+        ranked_latency, server = self.server_list[0]
+        # Measure the current best server only (this also sets the ping)
+        server = client.get_best_server([server])
+        if server['latency'] > ranked_latency * (1.0 + self.drift):
+            args = (server['latency'], ranked_latency, )
+            print('SpeedTest server latency drifted (%0.03f ms vs. %0.03f ms), '
+                  're-ranking' % args)
+            self._rank_servers(client, now)
+            if len(self.server_list) == 0:
+                raise speedtest_lib.SpeedtestBestServerFailure('No servers available')
+            server = client.get_best_server([self.server_list[0][1]])
+        return server
+
+    def run(self):
+        """ Perform a SpeedTest.
+
+        Returns:
+            tuple: ``(ping, download, upload)`` in ms, Mb/s and Mb/s, with None
+                for any value that could not be measured
+        """
+        ping, download, upload = None, None, None
+        with self.lock:
+            now = time.time()
+            try:
+                client = self._get_client(now)
+                server = self._select_server(client, now)
+                ping = server['latency']
+                download = client.download() / 1000.0 / 1000.0
+                upload = client.upload() / 1000.0 / 1000.0
+            except Exception as unexpected:
+                print('SpeedTest failed: %r' % (unexpected, ))
+                # Start from scratch next time, the network may have changed
+                self.client = None
+                self.server_list = []
+        return ping, download, upload
+
+
+def _version():
+    try:
+        part_list = speedtest_lib.__version__.split('.')[:3]
+        return tuple(int(part) for part in part_list)
+    except (AttributeError, ValueError):
+        return ()
+
+
+def available():
+    """ Return True if the installed ``speedtest`` module has the 2.x API. """
+    return speedtest_lib is not None and _version() >= MINIMUM_VERSION
+
+
+def get_engine(source_address=None, server_id=None):
+    """ Return the engine of this process for a source address and server. """
+    key = (source_address, server_id, )
+    if key not in ENGINE_DICT:
+        ENGINE_DICT[key] = SpeedTestEngine(source_address=source_address,
+                                           server_id=server_id)
+    return ENGINE_DICT[key]
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Intercheck event broadcasting
+
+The background thread publishes the ``status`` of Intercheck whenever it
+changes and every new ``sample`` (the SpeedTest ``result_dict``) as soon as it
+is written.  The measurement targets (see :mod:`intercheck.targets`) publish
+their own ``status.<target>`` and ``sample.<target>``.  Subscribers, such as
+the server-sent events handler in :mod:`intercheck.server`, are called from the
+publishing thread and are responsible for handing the event over to their own
+thread or IOLoop.
+"""
+from __future__ import absolute_import, division, print_function
+# Python built-in
+import threading
+import logging
+
+
+# Configure the logger
+print = logging.warning
+
+
+class EventBroadcaster(object):
+    """ Thread-safe publish / subscribe for Intercheck events.
+
+    The last event of each type is kept so that new subscribers can be brought
+    up to date immediately (see :meth:`latest`).  Events are delivered in the
+    order they are published.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Held while publishing, re-entrant so that listeners can publish
+        self.publish_lock = threading.RLock()
+        self.listener_list = []
+        self.latest_dict = {}
+
+    def subscribe(self, listener):
+        with self.lock:
+            self.listener_list.append(listener)
+
+    def unsubscribe(self, listener):
+        with self.lock:
+            if listener in self.listener_list:
+                self.listener_list.remove(listener)
+
+    def publish(self, event, data):
+        with self.publish_lock:
+            with self.lock:
+                self.latest_dict[event] = data
+                listener_list = list(self.listener_list)
+            self._notify(listener_list, event, data)
+
+    def update(self, event, func, default=None):
+        """ Publish ``func(data)``, where ``data`` is the last ``event`` published
+        (or ``default``), atomically.  Nothing is published if it returns None.
+        """
+        with self.publish_lock:
+            with self.lock:
+                data = func(self.latest_dict.get(event, default))
+                if data is None:
+                    return
+                self.latest_dict[event] = data
+                listener_list = list(self.listener_list)
+            self._notify(listener_list, event, data)
+
+    def _notify(self, listener_list, event, data):
+        for listener in listener_list:
+            try:
+                listener(event, data)
+            except Exception as unexpected:
+                print('Event listener failed: %r' % (unexpected, ))
+
+    def latest(self):
+        with self.lock:
+            return sorted(self.latest_dict.items())
+
+    def get(self, event, default=None):
+        """ Return the data of the last ``event`` published, or ``default``. """
+        with self.lock:
+            return self.latest_dict.get(event, default)
+
+
+BROADCASTER = EventBroadcaster()
+
+
+STATUS_DEFAULT = {'status': ['init']}
+
+
+def status_event(target=None):
+    return 'status' if target is None else 'status.%s' % (target, )
+
+
+def get_status(target=None):
+    """ Return the current status of Intercheck (e.g. ``['connected', 'waiting']``),
+    or of a measurement target.
+    """
+    return BROADCASTER.get(status_event(target), STATUS_DEFAULT)['status']
+
+
+def update_status(add=None, discard=None, target=None):
+    """ Add and discard a status (e.g. ``testing``) atomically, as the probes,
+    the schedulers and the measurement targets update it from their threads.
+    """
+    def update(status_dict):
+        status = set(status_dict['status'])
+        status_ = set(status)
+        if discard is not None:
+            status_.discard(discard)
+        if add is not None:
+            status_.add(add)
+        if status_ == status:
+            return None
+        return {'status': sorted(status_)}
+
+    BROADCASTER.update(status_event(target), update, default=STATUS_DEFAULT)
+
+
+def publish(event, data):
+    BROADCASTER.publish(event, data)
+
+
+def subscribe(listener):
+    BROADCASTER.subscribe(listener)
+
+
+def unsubscribe(listener):
+    BROADCASTER.unsubscribe(listener)
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+"""
+Intercheck fleet agents
+
+An Intercheck instance started with ``--aggregator <url>`` is an agent: it still
+keeps its own log, but every SpeedTest it writes is also appended to an on-disk
+spool (``~/.intercheck/spool.jsonl``) and pushed, in batches, to the aggregator
+(an instance started with ``--fleet``) by :class:`Pusher`.  Pushes reuse one
+keep-alive connection (a ``requests.Session``), failed connections are retried
+with a backoff, and while the aggregator cannot be reached the SpeedTests wait
+in the spool, which survives restarts.  A batch is only removed from the spool
+once the aggregator has stored it, and the aggregator skips the SpeedTests it
+already has, so nothing is lost or duplicated.
+
+The aggregator keeps the log of each agent in ``~/.intercheck/agents/<agent>/``
+(see :func:`intercheck.utils.get_internal_path`), so every view of the log can
+be asked for a single agent.
+"""
+from __future__ import absolute_import, division, print_function
+# Intercheck
+from . import storage
+from . import trigger
+# Python built-in
+import simplejson
+import threading
+import logging
+import numbers
+import socket
+import math
+import hmac
+import re
+import os
+
+
+# Configure the logger
+print = logging.warning
+
+
+PUSHER = None
+
+
+PUSH_ROUTE = '/fleet/push/'
+TOKEN_HEADER = 'X-Intercheck-Token'
+AGENT_PATTERN = re.compile(r'^[A-Za-z0-9_][A-Za-z0-9_.-]{0,63}$')
+MAX_BATCH_SIZE = 10000
+
+
+def check_agent(agent):
+    """ Raise ValueError unless ``agent`` is a valid agent name.
+
+    Agent names are used as directory names, so they are limited to letters,
+    digits, ``_``, ``.`` and ``-`` and cannot start with a dot.
+    """
+    if not isinstance(agent, basestring) or AGENT_PATTERN.match(agent) is None:
+        raise ValueError('Invalid agent name %r' % (agent, ))
+    return agent
+
+
+def check_token(expected, given):
+    """ Return True if ``given`` matches the ``expected`` token (or there is none). """
+    if not expected:
+        return True
+    if given is None:
+        return False
+    if not isinstance(expected, bytes):
+        expected = expected.encode('utf-8')
+    if not isinstance(given, bytes):
+        given = given.encode('utf-8')
+    return hmac.compare_digest(expected, given)
+
+
+def clean_records(record_list, key_list=storage.KEY_LIST):
+    """ Return the pushed records with only the keys in ``key_list``.
+
+    Raises ValueError unless ``record_list`` is a list (of at most
+    :data:`MAX_BATCH_SIZE`) of objects with a numeric ``start`` and a number or
+    null for every other key.
+    """
+    if not isinstance(record_list, list) or len(record_list) > MAX_BATCH_SIZE:
+        raise ValueError('Expected a list of at most %d records' % (MAX_BATCH_SIZE, ))
+    clean_list = []
+    for record in record_list:
+        if not isinstance(record, dict):
+            raise ValueError('Expected a record, got %r' % (record, ))
+        clean = {}
+        for key in key_list:
+            value = record.get(key, None)
+            if value is not None:
+                valid = isinstance(value, numbers.Real) and not isinstance(value, bool)
+                if not valid or math.isnan(value) or math.isinf(value):
+                    raise ValueError('Invalid %r in record %r' % (key, record, ))
+                value = float(value)
+            clean[key] = value
+        if clean.get('start', None) is None:
+            raise ValueError('Missing start in record %r' % (record, ))
+        clean_list.append(clean)
+    return clean_list
+
+
+def default_agent():
+    """ Return the (short) host name, as a valid agent name. """
+    agent = socket.gethostname().split('.')[0]
+    agent = re.sub(r'[^A-Za-z0-9_.-]', '-', agent).lstrip('.-')[:64]
+    return agent or 'agent'
+
+
+class Spool(object):
+    """ An append-only on-disk queue of records, one JSON object per line.
+
+    The records before the committed byte offset (kept next to the spool in
+    ``<spool>.offset``) have been delivered; once every record has been
+    delivered, the spool is truncated.
+    """
+    def __init__(self, spool_filepath):
+        self.spool_filepath = spool_filepath
+        self.offset_filepath = '%s.offset' % (spool_filepath, )
+        self.lock = threading.Lock()
+        try:
+            with open(self.offset_filepath, 'r') as offset_file:
+                self.offset = int(offset_file.read().strip() or 0)
+        except (IOError, ValueError):
+            self.offset = 0
+
+    def put(self, record_list):
+        data = ''.join('%s\n' % (simplejson.dumps(record), ) for record in record_list)
+        with self.lock:
+            with open(self.spool_filepath, 'a') as spool_file:
+                spool_file.write(data)
+                spool_file.flush()
+                os.fsync(spool_file.fileno())
+
+    def size(self):
+        try:
+            return os.path.getsize(self.spool_filepath)
+        except OSError:
+            return 0
+
+    def pending(self):
+        return self.size() > self.offset
+
+    def peek(self, max_records):
+        """ Return ``(record_list, offset)``, the next records and the offset after them. """
+        record_list = []
+        offset = self.offset
+        with self.lock:
+            try:
+                spool_file = open(self.spool_filepath, 'r')
+            except IOError:
+                return record_list, offset
+            with spool_file:
+                spool_file.seek(offset)
+                while len(record_list) < max_records:
+                    line = spool_file.readline()
+                    if not line.endswith('\n'):
+                        # End of the spool, or a partial line (e.g. from a crash)
+                        break
+                    offset += len(line)
+                    try:
+                        record_list.append(simplejson.loads(line))
+                    except ValueError:
+                        print('Skipping a corrupt spooled record')
+        return record_list, offset
+
+    def commit(self, offset):
+        with self.lock:
+            if offset >= self.size():
+                # Everything was delivered, start over
+                with open(self.spool_filepath, 'w'):
+                    pass
+                offset = 0
+            temp_filepath = '%s.tmp' % (self.offset_filepath, )
+            with open(temp_filepath, 'w') as offset_file:
+                offset_file.write('%d' % (offset, ))
+            os.rename(temp_filepath, self.offset_filepath)
+            self.offset = offset
+
+
+class Pusher(object):
+    """ Push the spooled records of this agent to the fleet aggregator.
+
+    Args:
+        url (str): the base URL of the aggregator, e.g. ``http://host:5000``
+        agent (str): the name of this agent
+        spool (Spool): the records waiting to be pushed
+        token (str): the shared secret expected by the aggregator, if any
+        batch_size (int): the maximum number of records per request
+        interval (float): seconds between two pushes, at most
+        timeout (float): seconds before a request is considered failed
+        retries (int): connection retries within a push, before backing off
+        max_backoff (float): the longest wait after consecutive failures
+    """
+    def __init__(self, url, agent, spool, token=None, batch_size=500,
+                 interval=30.0, timeout=10.0, retries=3, max_backoff=60 * 10):
+        # Only agents need requests, it is imported on demand
+        import requests
+        import requests.adapters
+        self.url = '%s%s' % (url.rstrip('/'), PUSH_ROUTE, )
+        self.agent = check_agent(agent)
+        self.spool = spool
+        self.token = token
+        self.batch_size = batch_size
+        self.interval = interval
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1,
+                                                max_retries=retries)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers['Content-Type'] = 'application/json'
+        if token is not None:
+            self.session.headers[TOKEN_HEADER] = token
+        self.wake_trigger = trigger.Trigger()
+        self.stopped = False
+        self.thread = None
+
+    def push(self, record):
+        """ Spool ``record`` and wake up the pushing thread. """
+        self.spool.put([record])
+        self.wake_trigger.set()
+
+    def flush(self):
+        """ Push every spooled record, returns False if the aggregator failed. """
+        import requests
+        while self.spool.pending():
+            record_list, offset = self.spool.peek(self.batch_size)
+            if offset == self.spool.offset:
+                # Only a partial line is left, it is completed by the next put
+                break
+            if len(record_list) > 0:
+                data = simplejson.dumps({
+                    'agent'   : self.agent,
+                    'records' : record_list,
+                })
+                try:
+                    response = self.session.post(self.url, data=data,
+                                                 timeout=self.timeout)
+                    response.raise_for_status()
+                except requests.RequestException as error:
+                    print('Cannot push to the aggregator %s: %s' % (self.url, error, ))
+                    return False
+            self.spool.commit(offset)
+        return True
+
+    def run(self):
+        backoff = self.interval
+        while not self.stopped:
+            if self.flush():
+                backoff = self.interval
+                timeout = self.interval
+            else:
+                # Back off while the aggregator is unreachable
+                timeout = backoff
+                backoff = min(backoff * 2, self.max_backoff)
+            self.wake_trigger.wait(timeout)
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.wake_trigger.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+def get_pusher():
+    """ Return the running :class:`Pusher`, or None if this is not an agent. """
+    return PUSHER
+
+
+def start_pusher(spool_filepath, url, agent=None, token=None):
+    global PUSHER
+    if PUSHER is not None:
+        print('Cannot start pushing to the aggregator, already running')
+        return PUSHER
+    if not url:
+        return None
+    agent = default_agent() if agent is None else agent
+    PUSHER = Pusher(url, agent, Spool(spool_filepath), token=token)
+    PUSHER.start()
+    print('Pushing SpeedTests to the aggregator %s as %r' % (url, agent, ))
+    return PUSHER
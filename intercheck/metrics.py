@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+"""
+Intercheck metrics
+
+Counters, gauges and histograms exported at ``/metrics`` in the Prometheus text
+format (version 0.0.4), covering the SpeedTests, the background scheduler, every
+web route and the storage engine.
+
+Measurements are taken on the hot paths, so recording one never takes a lock:
+every thread accumulates into its own shard (a plain dictionary, registered
+once per thread), and a scrape sums the shards.  Gauges are single assignments.
+Under the GIL, a scrape therefore sees every measurement either entirely or not
+at all, and never slows down the thread being measured.
+"""
+from __future__ import absolute_import, division, print_function
+# Python built-in
+import functools
+import threading
+import logging
+import bisect
+import types
+import time
+
+
+# Configure the logger
+print = logging.warning
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+# Histogram buckets, in seconds unless noted otherwise
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0]
+SIZE_BUCKETS = [256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+                16777216]
+SPEEDTEST_BUCKETS = [5.0, 10.0, 15.0, 20.0, 25.0, 30.0, 45.0, 60.0, 90.0, 120.0]
+OFFSET_BUCKETS = [-30.0, -10.0, -5.0, -1.0, -0.1, 0.0, 0.1, 1.0, 5.0, 10.0, 30.0]
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return '%d' % (value, )
+    return repr(value)
+
+
+def format_labels(label_list):
+    if len(label_list) == 0:
+        return ''
+    label_str = ','.join(
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'), )
+        for key, value in label_list
+    )
+    return '{%s}' % (label_str, )
+
+
+class Registry(object):
+    """ The metrics of the process, and the per-thread shards they record into. """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.metric_list = []
+        self.shard_list = []
+
+    def register(self, metric):
+        with self.lock:
+            self.metric_list.append(metric)
+        return metric
+
+    def shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = {}
+            # The only lock taken while recording, once per thread
+            with self.lock:
+                self.shard_list.append(shard)
+            self.local.shard = shard
+        return shard
+
+    def collect(self, metric):
+        """ Return ``{label_list: value}`` for ``metric``, summed over the shards. """
+        value_dict = {}
+        for shard in list(self.shard_list):
+            for key, value in list(shard.items()):
+                if key[0] is not metric:
+                    continue
+                if key[1] in value_dict:
+                    value_dict[key[1]] = metric.merge(value_dict[key[1]], value)
+                else:
+                    value_dict[key[1]] = metric.copy(value)
+        return value_dict
+
+    def render(self):
+        """ Return all of the metrics in the Prometheus text format. """
+        line_list = []
+        for metric in list(self.metric_list):
+            line_list.append('# HELP %s %s' % (metric.name, metric.description, ))
+            line_list.append('# TYPE %s %s' % (metric.name, metric.type, ))
+            line_list += metric.render()
+        line_list.append('')
+        return '\n'.join(line_list)
+
+
+REGISTRY = Registry()
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, description, registry=REGISTRY):
+        self.name = name
+        self.description = description
+        self.registry = registry
+        registry.register(self)
+
+    def copy(self, value):
+        return value
+
+    def merge(self, value, other):
+        return value + other
+
+
+class Counter(Metric):
+    """ A monotonically increasing count, e.g. of SpeedTests. """
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        shard = self.registry.shard()
+        key = (self, tuple(sorted(labels.items())), )
+        shard[key] = shard.get(key, 0) + amount
+
+    def render(self):
+        value_dict = self.registry.collect(self)
+        return [
+            '%s%s %s' % (self.name, format_labels(label_list), format_value(value), )
+            for label_list, value in sorted(value_dict.items())
+        ]
+
+
+class Gauge(Metric):
+    """ A value that is set, e.g. the latest download speed. """
+    type = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super(Gauge, self).__init__(*args, **kwargs)
+        self.value_dict = {}
+
+    def set(self, value, **labels):
+        self.value_dict[tuple(sorted(labels.items()))] = value
+
+    def render(self):
+        return [
+            '%s%s %s' % (self.name, format_labels(label_list), format_value(value), )
+            for label_list, value in sorted(self.value_dict.items())
+            if value is not None
+        ]
+
+
+class Histogram(Metric):
+    """ The distribution of observed values, counted into ``buckets``.
+
+    Each shard keeps the (non-cumulative) count of every bucket, followed by the
+    overflow count and the sum of the observed values.
+    """
+    type = 'histogram'
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS, **kwargs):
+        super(Histogram, self).__init__(name, description, **kwargs)
+        self.buckets = sorted(buckets)
+
+    def observe(self, value, **labels):
+        shard = self.registry.shard()
+        key = (self, tuple(sorted(labels.items())), )
+        state = shard.get(key, None)
+        if state is None:
+            state = [0] * (len(self.buckets) + 1) + [0.0]
+            shard[key] = state
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    def copy(self, value):
+        return list(value)
+
+    def merge(self, value, other):
+        return [ left + right for left, right in zip(value, other) ]
+
+    def render(self):
+        line_list = []
+        value_dict = self.registry.collect(self)
+        for label_list, state in sorted(value_dict.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + [float('inf')], state[:-1]):
+                cumulative += count
+                bucket_label_list = label_list + (('le', format_value(float(bound))), )
+                args = (self.name, format_labels(bucket_label_list), cumulative, )
+                line_list.append('%s_bucket%s %d' % args)
+            labels = format_labels(label_list)
+            line_list.append('%s_sum%s %s' % (self.name, labels, format_value(state[-1]), ))
+            line_list.append('%s_count%s %d' % (self.name, labels, cumulative, ))
+        return line_list
+
+
+SPEEDTEST_TOTAL = Counter(
+    'intercheck_speedtest_total',
+    'SpeedTests performed, by result')
+SPEEDTEST_SECONDS = Histogram(
+    'intercheck_speedtest_duration_seconds',
+    'Duration of each SpeedTest', buckets=SPEEDTEST_BUCKETS)
+SPEEDTEST_LATEST = Gauge(
+    'intercheck_speedtest_latest',
+    'The latest ping (ms), download and upload (Mb/s) measured')
+SPEEDTEST_TIMESTAMP = Gauge(
+    'intercheck_speedtest_latest_timestamp_seconds',
+    'When the latest SpeedTest started')
+SCHEDULER_RUN_AVG_SECONDS = Histogram(
+    'intercheck_scheduler_duration_run_avg_seconds',
+    'Mean SpeedTest duration so far, as seen by the scheduler',
+    buckets=SPEEDTEST_BUCKETS)
+SCHEDULER_OFFSET_SECONDS = Histogram(
+    'intercheck_scheduler_offset_seconds',
+    'How late each SpeedTest started after its scheduled slot',
+    buckets=OFFSET_BUCKETS)
+SCHEDULER_MISSED_TOTAL = Counter(
+    'intercheck_scheduler_missed_total',
+    'Scheduled slots that went by (e.g. while suspended), by what was done')
+HTTP_SECONDS = Histogram(
+    'intercheck_http_request_duration_seconds',
+    'Time to serve each request (including its streamed body), by route')
+HTTP_BYTES = Histogram(
+    'intercheck_http_response_size_bytes',
+    'Size of each response body, by route', buckets=SIZE_BUCKETS)
+RESPONSE_CACHE_TOTAL = Counter(
+    'intercheck_response_cache_total',
+    'JSON responses served from (hit) or computed into (miss) the cache, by route')
+STORAGE_SECONDS = Histogram(
+    'intercheck_storage_duration_seconds',
+    'Time spent in each storage operation, by engine')
+
+
+def record_speedtest(result_dict):
+    """ Record a SpeedTest ``result_dict`` (see :func:`intercheck.core.speedtest`).
+
+    The SpeedTests of a measurement target are labelled with its name.
+    """
+    labels = {}
+    if result_dict.get('target', None) is not None:
+        labels['target'] = result_dict['target']
+    success = result_dict.get('success', False)
+    SPEEDTEST_TOTAL.inc(result='success' if success else 'failure', **labels)
+    duration = result_dict.get('duration', None)
+    if duration is not None:
+        SPEEDTEST_SECONDS.observe(duration, **labels)
+    # Failed values are missing, keep the latest measured ones
+    for key in ['ping', 'download', 'upload']:
+        value = result_dict.get(key, None)
+        if value is not None:
+            SPEEDTEST_LATEST.set(value, metric=key, **labels)
+    if result_dict.get('start', None) is not None:
+        SPEEDTEST_TIMESTAMP.set(result_dict['start'], **labels)
+
+
+def record_request(route, method, status, duration, size):
+    HTTP_SECONDS.observe(duration, route=route, method=method, status=status)
+    HTTP_BYTES.observe(size, route=route, method=method)
+
+
+def iter_timed(iterator, histogram, start, **labels):
+    try:
+        for value in iterator:
+            yield value
+    finally:
+        histogram.observe(time.time() - start, **labels)
+
+
+def time_storage(func):
+    """ Decorate a storage method to time it into :data:`STORAGE_SECONDS`.
+
+    Generators are timed until they are exhausted (or closed).
+    """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        start = time.time()
+        labels = {'storage': self.name, 'operation': func.__name__}
+        result = func(self, *args, **kwargs)
+        if isinstance(result, types.GeneratorType):
+            return iter_timed(result, STORAGE_SECONDS, start, **labels)
+        STORAGE_SECONDS.observe(time.time() - start, **labels)
+        return result
+    return wrapper
+
+
+class ClosingIterator(object):
+    """ Wrap a WSGI response body, counting its bytes until it is closed. """
+    def __init__(self, app_iter, on_close):
+        self.app_iter = app_iter
+        self.iterator = iter(app_iter)
+        self.on_close = on_close
+        self.size = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = next(self.iterator)
+        self.size += len(chunk)
+        return chunk
+
+    next = __next__
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            self.on_close(self.size)
+
+
+class WSGIMetricsMiddleware(object):
+    """ Record the latency and size of every response of a WSGI application.
+
+    The route is read from ``environ['intercheck.route']``, which the
+    application sets (the URL rule that matched), so that the metrics are not
+    split by query strings or unknown paths.
+    """
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        start = time.time()
+        status_list = []
+
+        def start_response_(status, response_headers, exc_info=None):
+            status_list.append(status.split(' ', 1)[0])
+            return start_response(status, response_headers, exc_info)
+
+        def on_close(size):
+            route = environ.get('intercheck.route', 'unknown')
+            status = status_list[-1] if len(status_list) > 0 else '500'
+            method = environ.get('REQUEST_METHOD', 'GET')
+            record_request(route, method, status, time.time() - start, size)
+
+        app_iter = self.wsgi_app(environ, start_response_)
+        return ClosingIterator(app_iter, on_close)
+
+
+def render():
+    return REGISTRY.render()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+"""
+Intercheck outage index
+
+Outages are detected once per SpeedTest, as it is written, instead of being
+re-derived from the whole log by every summary.  An outage starts at the last
+successful SpeedTest before a failed one and ends at the next successful
+SpeedTest, as in :func:`intercheck.utils.get_stats`.  Each outage is a row of an
+SQLite3 table (``~/.intercheck/outages.sqlite3``) with its ``start``, ``end``,
+``duration`` and number of ``failed`` SpeedTests, indexed by both ends.
+
+Every row also keeps the running ``total`` of the durations of all of the
+outages that ended before it (a prefix sum, in order of ``end``), so the
+downtime over any window is the difference of two indexed lookups.
+"""
+from __future__ import absolute_import, division, print_function
+# Python built-in
+import threading
+import logging
+import sqlite3
+
+
+# Configure the logger
+print = logging.warning
+
+
+# Any missing value makes a SpeedTest a failure, as in get_stats
+FAILURE_KEY_LIST = ['ping', 'download', 'upload', 'duration']
+
+
+class OutageIndex(object):
+    """ Outage intervals of the SpeedTests in one storage engine.
+
+    The index follows the storage sequence (see
+    :meth:`intercheck.storage.Storage.iter_since`): :meth:`update` only reads
+    the records written since the last update.  A record older than the latest
+    one indexed (e.g. from an import) makes the index be rebuilt from storage.
+
+    While disconnected, the current outage is kept with a NULL ``end`` and
+    does not count towards the downtime until it ends.
+    """
+    def __init__(self, outage_filepath, storage):
+        self.outage_filepath = outage_filepath
+        self.storage = storage
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        connection = self._connect()
+        connection.execute('PRAGMA journal_mode=WAL')
+        with connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS outage ('
+                '    start    REAL PRIMARY KEY,'
+                '    end      REAL,'
+                '    duration REAL,'
+                '    failed   INTEGER NOT NULL,'
+                '    total    REAL'
+                ')'
+            )
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS outage_end ON outage (end)'
+            )
+            # The state of the detector, so it can resume after a restart
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS state ('
+                '    key   TEXT PRIMARY KEY,'
+                '    value'
+                ')'
+            )
+        self.state_dict = self._load_state(connection)
+        if self.state_dict.get('storage') != storage.name:
+            self.state_dict = self._reset(connection)
+        self.generation = 0
+
+    def _connect(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.outage_filepath)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def _load_state(self, connection):
+        cursor = connection.execute('SELECT key, value FROM state')
+        return dict(cursor.fetchall())
+
+    def _reset(self, connection):
+        state_dict = {
+            'storage'   : self.storage.name,
+            'sequence'  : 0,
+            'latest'    : None,
+            'connected' : None,
+            'outage'    : None,
+            'total'     : 0.0,
+        }
+        with connection:
+            connection.execute('DELETE FROM outage')
+            self._save_state(connection, state_dict)
+        return state_dict
+
+    def _save_state(self, connection, state_dict):
+        connection.executemany(
+            'INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)',
+            list(state_dict.items())
+        )
+
+    def update(self):
+        """ Index the records written since the last update. """
+        connection = self._connect()
+        with self.lock:
+            sequence = self.storage.sequence()
+            if sequence == self.state_dict['sequence']:
+                return
+            if sequence < self.state_dict['sequence']:
+                # The log was replaced, start over
+                self.state_dict = self._reset(connection)
+            state_dict = dict(self.state_dict)
+            rebuild = False
+            with connection:
+                for sequence_, record in self.storage.iter_since(state_dict['sequence']):
+                    state_dict['sequence'] = max(state_dict['sequence'], sequence_)
+                    start = record.get('start', None)
+                    if start is None:
+                        continue
+                    latest = state_dict['latest']
+                    if latest is not None and start <= latest:
+                        if start < latest:
+                            rebuild = True
+                            break
+                        continue
+                    self._add(connection, state_dict, record)
+                if not rebuild:
+                    self._save_state(connection, state_dict)
+            if rebuild:
+                state_dict = self._reset(connection)
+                with connection:
+                    for record in self.storage.iter_records():
+                        if record.get('start', None) is not None:
+                            self._add(connection, state_dict, record)
+                    state_dict['sequence'] = sequence
+                    self._save_state(connection, state_dict)
+            self.state_dict = state_dict
+            self.generation += 1
+
+    def _add(self, connection, state_dict, record):
+        start = record['start']
+        failed = any(record.get(key, None) is None for key in FAILURE_KEY_LIST)
+        outage = state_dict['outage']
+        if failed:
+            if outage is None:
+                # Starts at the last successful SpeedTest, if any
+                outage = state_dict['connected']
+                if outage is None:
+                    outage = start
+                state_dict['outage'] = outage
+                connection.execute(
+                    'INSERT OR REPLACE INTO outage (start, failed) VALUES (?, 1)',
+                    (outage, )
+                )
+            else:
+                connection.execute(
+                    'UPDATE outage SET failed = failed + 1 WHERE start = ?',
+                    (outage, )
+                )
+        else:
+            if outage is not None:
+                duration = start - outage
+                state_dict['total'] += duration
+                connection.execute(
+                    'UPDATE outage SET end = ?, duration = ?, total = ? '
+                    'WHERE start = ?',
+                    (start, duration, state_dict['total'], outage, )
+                )
+                state_dict['outage'] = None
+            state_dict['connected'] = start
+        state_dict['latest'] = start
+
+    def _total_before(self, connection, end):
+        """ Return the total duration of the outages that ended before ``end``. """
+        if end is None:
+            return 0.0
+        cursor = connection.execute(
+            'SELECT total FROM outage WHERE end < ? AND end IS NOT NULL '
+            'ORDER BY end DESC LIMIT 1',
+            (end, )
+        )
+        row = cursor.fetchone()
+        return 0.0 if row is None else row[0]
+
+    def downtime(self, start=None, end=None):
+        """ Return the seconds of the outages that ended within ``[start, end)``. """
+        self.update()
+        connection = self._connect()
+        if end is None:
+            total = self.state_dict['total']
+        else:
+            total = self._total_before(connection, end)
+        return total - self._total_before(connection, start)
+
+    def outages(self, start=None, end=None):
+        """ Return the outages overlapping ``[start, end)``, in order.
+
+        Each outage is a dictionary with its ``start``, ``end`` (None while
+        ongoing), ``duration`` and number of ``failed`` SpeedTests.
+        """
+        self.update()
+        connection = self._connect()
+        where_list, arg_list = [], []
+        if start is not None:
+            where_list.append('(end IS NULL OR end > ?)')
+            arg_list.append(start)
+        if end is not None:
+            where_list.append('start < ?')
+            arg_list.append(end)
+        where = ''
+        if len(where_list) > 0:
+            where = ' WHERE %s' % (' AND '.join(where_list), )
+        cursor = connection.execute(
+            'SELECT start, end, duration, failed FROM outage%s ORDER BY start' % (where, ),
+            arg_list
+        )
+        outage_list = [
+            {
+                'start'    : start_,
+                'end'      : end_,
+                'duration' : duration,
+                'failed'   : failed,
+            }
+            for start_, end_, duration, failed in cursor.fetchall()
+        ]
+        return outage_list
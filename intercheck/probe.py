@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+"""
+Intercheck connectivity probes
+
+A full SpeedTest uses real bandwidth, so it only runs every few minutes and
+downtime measured from SpeedTests is only as accurate as that interval.  The
+probes are a second, lightweight tier, off unless ``probe_interval`` is set (as
+they contact third-party hosts): every ``probe_interval`` seconds each target in
+``probe_targets`` is checked concurrently with a TCP connect, a DNS lookup or an
+HTTP ``HEAD`` request.  A round in which every target fails is a
+disconnection.  The latencies and the resulting outages are kept in their own
+SQLite3 store (``~/.intercheck/probe.sqlite3``), and while the probes run they
+drive the ``connected`` / ``disconnected`` status and the summary downtime.
+
+Targets are written as ``host:port`` (or ``tcp://host:port``),
+``dns://hostname`` or ``http(s)://host[:port]/path``; a local target such as
+``127.0.0.1:5000`` works too.  A DNS lookup is a single UDP query to the first
+nameserver of the system resolver, so that it cannot outlast the probe timeout
+like ``getaddrinfo`` can.
+"""
+from __future__ import absolute_import, division, print_function
+# Intercheck
+from . import trigger
+# Python built-in
+import threading
+import logging
+import httplib
+import sqlite3
+import random
+import socket
+import struct
+import time
+try:
+    import concurrent.futures
+except ImportError:
+    concurrent = None
+
+
+# Configure the logger
+print = logging.warning
+
+
+PROBER = None
+
+
+RESOLV_CONF_FILEPATH = '/etc/resolv.conf'
+SCHEME_LIST = ['tcp', 'dns', 'http', 'https']
+
+
+def parse_target(target):
+    """ Return ``(scheme, host, port, path)`` for a probe target string.
+
+    Raises ValueError for an unknown scheme, a missing host or an invalid port.
+    """
+    target_ = target
+    scheme = 'tcp'
+    if '://' in target:
+        scheme, target = target.split('://', 1)
+    if scheme not in SCHEME_LIST:
+        raise ValueError('Unknown scheme of probe target %r' % (target_, ))
+    path = '/'
+    if '/' in target:
+        target, path = target.split('/', 1)
+        path = '/%s' % (path, )
+    host, port = target, None
+    if ':' in target:
+        host, port = target.rsplit(':', 1)
+        if not port.isdigit() or not 0 < int(port) < 65536:
+            raise ValueError('Invalid port of probe target %r' % (target_, ))
+        port = int(port)
+    if len(host) == 0:
+        raise ValueError('Missing host of probe target %r' % (target_, ))
+    if port is None:
+        port = {'http': 80, 'https': 443}.get(scheme, 53)
+    return scheme, host, port, path
+
+
+def parse_targets(target_list):
+    """ Parse every probe target string, see :func:`parse_target`. """
+    return [ parse_target(target) for target in target_list ]
+
+
+def get_nameserver(resolv_conf_filepath=RESOLV_CONF_FILEPATH):
+    """ Return the first nameserver of the system resolver (like the C library,
+    ``127.0.0.1`` if there is none).
+    """
+    try:
+        with open(resolv_conf_filepath, 'r') as resolv_conf:
+            for line in resolv_conf:
+                field_list = line.split()
+                if len(field_list) >= 2 and field_list[0] == 'nameserver':
+                    return field_list[1].split('%')[0]
+    except IOError:
+        pass
+    return '127.0.0.1'
+
+
+def dns_query(hostname, nameserver, port=53, timeout=2.0):
+    """ Look up the A record of ``hostname`` with one UDP query to ``nameserver``.
+
+    Raises socket.error (or socket.timeout) unless it answers without an error
+    within ``timeout`` seconds.
+    """
+    query_id = random.randint(0, 0xffff)
+    # A recursive query with a single question (see RFC 1035)
+    header = struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0)
+    label_list = [ label for label in hostname.encode('idna').split(b'.') if label ]
+    question = b''.join(struct.pack('!B', len(label)) + label for label in label_list)
+    question += b'\x00' + struct.pack('!HH', 1, 1)
+    family = socket.AF_INET6 if ':' in nameserver else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect((nameserver, port))
+        sock.send(header + question)
+        deadline = time.time() + timeout
+        while True:
+            response = sock.recv(512)
+            if len(response) >= 12 and struct.unpack('!H', response[:2])[0] == query_id:
+                break
+            # Not the answer to this query, wait for it until the deadline
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout('timed out')
+            sock.settimeout(remaining)
+    finally:
+        sock.close()
+    rcode = struct.unpack('!H', response[2:4])[0] & 0x000f
+    if rcode != 0:
+        raise socket.error('DNS lookup of %r failed (rcode %d)' % (hostname, rcode, ))
+
+
+def probe_target(target, timeout=2.0):
+    """ Probe a single target, returns the latency in ms or None on failure. """
+    return probe_address(parse_target(target), timeout=timeout)
+
+
+def probe_address(address, timeout=2.0):
+    """ Probe a parsed target (see :func:`parse_target`), like
+    :func:`probe_target`.
+    """
+    scheme, host, port, path = address
+    start = time.time()
+    try:
+        if scheme == 'tcp':
+            connection = socket.create_connection((host, port), timeout=timeout)
+            connection.close()
+        elif scheme == 'dns':
+            dns_query(host, get_nameserver(), timeout=timeout)
+        elif scheme in ['http', 'https']:
+            if scheme == 'http':
+                connection = httplib.HTTPConnection(host, port, timeout=timeout)
+            else:
+                connection = httplib.HTTPSConnection(host, port, timeout=timeout)
+            try:
+                connection.request('HEAD', path)
+                connection.getresponse().read()
+            finally:
+                connection.close()
+    except (socket.error, httplib.HTTPException):
+        return None
+    return (time.time() - start) * 1000.0
+
+
+class ProbeStore(object):
+    """ Compact SQLite3 store of probe latencies and outages.
+
+    Each probe is one ``(start, target, latency)`` row, with the targets
+    interned in their own table.  Outages are kept as ``(start, end)``
+    intervals (``end`` is NULL while ongoing), so downtime over any window is a
+    sum over the few outages that overlap it.
+    """
+    def __init__(self, probe_filepath):
+        self.probe_filepath = probe_filepath
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.target_dict = {}
+        self.generation = 0
+        connection = self._connect()
+        connection.execute('PRAGMA journal_mode=WAL')
+        with connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS target ('
+                '    id   INTEGER PRIMARY KEY,'
+                '    name TEXT NOT NULL UNIQUE'
+                ')'
+            )
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS probe ('
+                '    start   REAL NOT NULL,'
+                '    target  INTEGER NOT NULL,'
+                '    latency REAL'
+                ')'
+            )
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS probe_start ON probe (start)'
+            )
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS outage ('
+                '    start REAL PRIMARY KEY,'
+                '    end   REAL'
+                ')'
+            )
+
+    def _connect(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.probe_filepath)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def _get_target_id(self, connection, target):
+        if target not in self.target_dict:
+            connection.execute('INSERT OR IGNORE INTO target (name) VALUES (?)',
+                               (target, ))
+            cursor = connection.execute('SELECT id FROM target WHERE name = ?',
+                                        (target, ))
+            self.target_dict[target] = cursor.fetchone()[0]
+        return self.target_dict[target]
+
+    def write_round(self, start, latency_dict):
+        connection = self._connect()
+        with self.lock, connection:
+            row_list = [
+                (start, self._get_target_id(connection, target), latency, )
+                for target, latency in sorted(latency_dict.items())
+            ]
+            connection.executemany('INSERT INTO probe VALUES (?, ?, ?)', row_list)
+
+    def open_outage(self, start):
+        connection = self._connect()
+        with self.lock, connection:
+            connection.execute('INSERT OR REPLACE INTO outage VALUES (?, NULL)',
+                               (start, ))
+            self.generation += 1
+
+    def close_outage(self, end):
+        connection = self._connect()
+        with self.lock, connection:
+            connection.execute('UPDATE outage SET end = ? WHERE end IS NULL',
+                               (end, ))
+            self.generation += 1
+
+    def ongoing_outage(self):
+        connection = self._connect()
+        cursor = connection.execute('SELECT start FROM outage WHERE end IS NULL')
+        row = cursor.fetchone()
+        return None if row is None else row[0]
+
+    def downtime(self, start, end=None):
+        """ Return the seconds of downtime between ``start`` and ``end``. """
+        end = time.time() if end is None else end
+        connection = self._connect()
+        cursor = connection.execute(
+            'SELECT start, end FROM outage '
+            'WHERE start < ? AND (end IS NULL OR end > ?)',
+            (end, start, )
+        )
+        downtime = 0.0
+        for outage_start, outage_end in cursor:
+            outage_end = end if outage_end is None else min(outage_end, end)
+            downtime += max(0.0, outage_end - max(outage_start, start))
+        return downtime
+
+    def etag(self):
+        # An ongoing outage grows every second, so it changes every minute
+        etag = '%d' % (self.generation, )
+        if self.ongoing_outage() is not None:
+            etag += '-%d' % (int(time.time() // 60), )
+        return etag
+
+    def prune(self, before):
+        connection = self._connect()
+        with self.lock, connection:
+            connection.execute('DELETE FROM probe WHERE start < ?', (before, ))
+            connection.execute('DELETE FROM outage WHERE end < ?', (before, ))
+
+
+class Prober(object):
+    """ Probe all targets concurrently every ``interval`` seconds.
+
+    Args:
+        store (ProbeStore): where the probe rounds and outages are written
+        target_list (list of str): the probe targets, raises ValueError if one
+            is invalid (see :func:`parse_target`)
+        interval (float): seconds between the start of two rounds
+        timeout (float): seconds before a probe is considered failed
+        retention (float): seconds of probes to keep in the store
+        on_status (callable): called with True / False whenever the
+            connectivity changes
+    """
+    def __init__(self, store, target_list, interval=5.0, timeout=2.0,
+                 retention=60 * 60 * 24 * 30, on_status=None):
+        self.store = store
+        self.target_list = list(target_list)
+        # Parsed once, so invalid targets are rejected before the first round
+        self.address_list = parse_targets(self.target_list)
+        self.interval = interval
+        self.timeout = min(timeout, interval)
+        self.retention = retention
+        self.on_status = on_status
+        self.connected = None
+        self.outage_start = store.ongoing_outage()
+        self.stop_trigger = trigger.Trigger()
+        self.thread = None
+        self.executor = None
+        if concurrent is not None and len(self.target_list) > 1:
+            max_workers = len(self.target_list)
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+
+    def probe_round(self):
+        start = time.time()
+        if self.executor is None:
+            latency_list = [
+                probe_address(address, timeout=self.timeout)
+                for address in self.address_list
+            ]
+        else:
+            future_list = [
+                self.executor.submit(probe_address, address, timeout=self.timeout)
+                for address in self.address_list
+            ]
+            latency_list = [ future.result() for future in future_list ]
+        latency_dict = dict(zip(self.target_list, latency_list))
+        self.store.write_round(start, latency_dict)
+        connected = any(latency is not None for latency in latency_list)
+        # Track outages
+        if not connected and self.outage_start is None:
+            self.outage_start = start
+            self.store.open_outage(start)
+        if connected and self.outage_start is not None:
+            self.outage_start = None
+            self.store.close_outage(start)
+        if connected != self.connected:
+            self.connected = connected
+            if self.on_status is not None:
+                self.on_status(connected)
+        return connected
+
+    def run(self):
+        deadline = time.time()
+        last_prune = None
+        while True:
+            try:
+                self.probe_round()
+            except Exception as unexpected:
+                print('Probe round failed: %r' % (unexpected, ))
+            now = time.time()
+            if last_prune is None or now - last_prune > 60 * 60:
+                self.store.prune(now - self.retention)
+                last_prune = now
+            # Sleep until the next round is due, skipping any missed rounds
+            deadline += self.interval
+            if deadline < now:
+                deadline = now + self.interval - (now - deadline) % self.interval
+            if self.stop_trigger.wait(deadline - now):
+                break
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_trigger.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+def get_prober():
+    """ Return the running :class:`Prober`, or None if the probes are off. """
+    return PROBER
+
+
+def start_probes(probe_filepath, target_list, interval, on_status=None):
+    global PROBER
+    if PROBER is not None:
+        print('Cannot start the probes, already running')
+        return PROBER
+    if interval <= 0 or len(target_list) == 0:
+        return None
+    store = ProbeStore(probe_filepath)
+    PROBER = Prober(store, target_list, interval=interval, on_status=on_status)
+    PROBER.start()
+    args = (len(target_list), interval, )
+    print('Probing %d targets every %0.2f sec.' % args)
+    return PROBER
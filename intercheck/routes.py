@@ -4,11 +4,17 @@ from __future__ import absolute_import, division, print_function
 import flask
 from flask import request
 # Intercheck
+from . import aggregate
+from . import events
+from . import fleet
+from . import metrics
+from . import storage
+from . import probe
+from . import targets
 from . import utils
 # Python built-in
 import logging
 import math
-import os
 
 
 # Configure the logger
@@ -17,7 +23,39 @@ print = logging.warning
 
 # Application
 APP = flask.Flask(__name__)
-APP.status = set(['init'])
+# Record the latency and size of every response, see /metrics
+APP.wsgi_app = metrics.WSGIMetricsMiddleware(APP.wsgi_app)
+
+
+@APP.before_request
+def label_route():
+    # Label the metrics by URL rule (e.g. /summary/), not by the full URL
+    rule = request.url_rule
+    request.environ['intercheck.route'] = 'unknown' if rule is None else rule.rule
+
+
+def log_kwargs():
+    # The views of a single fleet agent (?agent=<name>) or measurement target
+    # (?target=<name>), if given
+    kwargs = {}
+    agent = request.args.get('agent', None)
+    if agent is not None:
+        if agent not in utils.get_agent_list():
+            flask.abort(404)
+        kwargs['agent'] = agent
+    target = request.args.get('target', None)
+    if target is not None:
+        if target not in utils.get_target_list(**kwargs):
+            flask.abort(404)
+        kwargs['target'] = target
+    return kwargs
+
+
+def check_fleet():
+    settings_dict = utils.load_settings(quiet=True)
+    if not settings_dict.get('fleet'):
+        flask.abort(404)
+    return settings_dict
 
 
 ################################################################################
@@ -38,10 +76,8 @@ def index():
 
 @APP.route('/force/')
 def force():
-    utils.set_force()
-    force_filepath = utils.get_force_filepath()
     status_dict = {
-        'status': os.path.exists(force_filepath),
+        'status': utils.set_force(),
     }
     return utils.encode_to_json(status_dict)
 
@@ -81,50 +117,295 @@ def settings():
     return utils.encode_to_json(accepted_dict)
 
 
-@APP.route('/status/')
-def status():
+@APP.route('/metrics')
+def metrics_():
+    response = flask.make_response(metrics.render())
+    response.headers['Content-Type'] = metrics.CONTENT_TYPE
+    return response
+
+
+def status_content(target=None):
+    # Also served natively by server.StatusHandler, outside of a Flask request
     status_dict = {
-        'status': list(APP.status),
+        'status': events.get_status(target=target),
     }
     return utils.encode_to_json(status_dict)
 
 
+@APP.route('/status/')
+def status():
+    return status_content(target=request.args.get('target', None))
+
+
 @APP.route('/summary/')
 def summary():
-    day_seconds = 60 * 60 * 24
-    stat_dict, record_interval = utils.get_summary_averages(round_values=True)
-    record_interval = int(math.ceil(record_interval / day_seconds))
-    status_dict = {
-        'stats'    : stat_dict,
-        'interval' : record_interval,
-    }
-    return utils.encode_to_json(status_dict)
+    kwargs = log_kwargs()
+
+    def summary_content():
+        day_seconds = 60 * 60 * 24
+        stat_dict, record_interval = aggregate.get_summary(round_values=True,
+                                                           **kwargs)
+        record_interval = int(math.ceil(record_interval / day_seconds))
+        percentile_dict = aggregate.get_percentiles(round_values=True, **kwargs)
+        status_dict = {
+            'stats'       : stat_dict,
+            'percentiles' : percentile_dict,
+            'interval'    : record_interval,
+        }
+        return utils.encode_to_json(status_dict)
+
+    # Only recompute if something has been written since the client's copy
+    sequence = utils.get_storage(**kwargs).sequence()
+    etag = 'summary-%d-%r' % (sequence, sorted(kwargs.items()), )
+    prober = probe.get_prober()
+    if prober is not None and len(kwargs) == 0:
+        etag += '-probe-%s' % (prober.store.etag(), )
+    return utils.conditional_response(etag, summary_content)
 
 
 @APP.route('/points/')
 def points():
     latest = request.args.get('latest', None)
-    stat_dict = utils.get_points(latest=latest)
+    resolution = request.args.get('resolution', None)
+    max_points = request.args.get('max_points', None)
+    since = request.args.get('since', None)
+    kwargs = log_kwargs()
+
+    # Check argument values
+    if latest is not None:
+        try:
+            latest = float(latest)
+        except ValueError:
+            latest = None
+    if resolution not in ['raw'] + storage.RESOLUTION_LIST:
+        resolution = None
+    if max_points is not None:
+        try:
+            max_points = int(max_points)
+        except ValueError:
+            max_points = None
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            since = None
+
+    def points_content():
+        point_dict, resolution_, cursor = utils.get_points(
+            latest=latest, resolution=resolution, max_points=max_points,
+            since=since, **kwargs)
+        status_dict = {
+            'points'     : point_dict,
+            'resolution' : resolution_,
+            'cursor'     : cursor,
+        }
+        return utils.encode_to_json(status_dict)
+
+    # Only recompute if something has been written since the client's copy
+    sequence = utils.get_storage(**kwargs).sequence()
+    args = (sequence, latest, resolution, max_points, since, sorted(kwargs.items()), )
+    etag = 'points-%d-%r-%r-%r-%r-%r' % args
+    return utils.conditional_response(etag, points_content)
+
+
+@APP.route('/outages/')
+def outages():
+    start = request.args.get('from', None)
+    end = request.args.get('to', None)
+    kwargs = log_kwargs()
+
+    # Check argument values
+    try:
+        start = None if start is None else float(start)
+    except ValueError:
+        start = None
+    try:
+        end = None if end is None else float(end)
+    except ValueError:
+        end = None
+
+    def outages_content():
+        outage_index = utils.get_outage_index(**kwargs)
+        outage_list = outage_index.outages(start=start, end=end)
+        status_dict = {
+            'outages'  : outage_list,
+            'downtime' : outage_index.downtime(start=start, end=end),
+        }
+        return utils.encode_to_json(status_dict)
+
+    # Only recompute if something has been written since the client's copy
+    sequence = utils.get_storage(**kwargs).sequence()
+    etag = 'outages-%d-%r-%r-%r' % (sequence, start, end, sorted(kwargs.items()), )
+    return utils.conditional_response(etag, outages_content)
+
+
+@APP.route('/targets/')
+def targets_():
+    settings_dict = utils.load_settings(quiet=True)
+    target_list = []
+    for target in settings_dict.get('targets', []):
+        try:
+            target_list.append(targets.parse_target(target))
+        except ValueError:
+            continue
+    # Do not create the log of a target that has not run a SpeedTest yet
+    logged_list = utils.get_target_list()
+    for target_dict in target_list:
+        name = target_dict['name']
+        target_dict['status'] = events.get_status(target=name)
+        target_dict['records'] = 0
+        if name in logged_list:
+            target_dict['records'] = utils.get_storage(target=name).sequence()
+    concurrency = settings_dict.get('target_concurrency')
+
+    def targets_content():
+        status_dict = {
+            'targets'     : target_list,
+            'concurrency' : concurrency,
+        }
+        return utils.encode_to_json(status_dict)
+
+    state_list = [ sorted(target_dict.items()) for target_dict in target_list ]
+    etag = 'targets-%r-%r' % (state_list, concurrency, )
+    return utils.conditional_response(etag, targets_content)
+
+
+################################################################################
+# Fleet Routes
+################################################################################
+
+
+@APP.route(fleet.PUSH_ROUTE, methods=['POST'])
+def fleet_push():
+    settings_dict = check_fleet()
+    token = request.headers.get(fleet.TOKEN_HEADER, None)
+    if not fleet.check_token(settings_dict.get('fleet_token'), token):
+        flask.abort(403)
+    payload = request.get_json(force=True, silent=True)
+    if not isinstance(payload, dict):
+        flask.abort(400)
+    try:
+        agent = fleet.check_agent(payload.get('agent', None))
+        record_list = fleet.clean_records(payload.get('records', None))
+    except ValueError:
+        flask.abort(400)
+    utils.write_many_to_logs(record_list, agent=agent)
+    status_dict = {
+        'agent'    : agent,
+        'received' : len(record_list),
+    }
+    return utils.encode_to_json(status_dict)
+
+
+@APP.route('/fleet/agents/')
+def fleet_agents():
+    check_fleet()
+    agent_list = []
+    for agent in utils.get_agent_list():
+        storage_ = utils.get_storage(agent=agent)
+        agent_list.append({
+            'agent'   : agent,
+            'records' : storage_.sequence(),
+        })
     status_dict = {
-        'points' : stat_dict,
+        'agents' : agent_list,
     }
     return utils.encode_to_json(status_dict)
 
 
+def fleet_sequence():
+    # Changes whenever any agent pushes, or a new agent appears
+    agent_list = utils.get_agent_list()
+    sequence_list = [
+        utils.get_storage(agent=agent).sequence()
+        for agent in agent_list
+    ]
+    return '%d-%d' % (len(agent_list), sum(sequence_list), )
+
+
+@APP.route('/fleet/summary/')
+def fleet_summary():
+    check_fleet()
+
+    def summary_content():
+        day_seconds = 60 * 60 * 24
+        stat_dict, record_interval, agent_list = aggregate.get_fleet_summary(
+            round_values=True)
+        record_interval = int(math.ceil(record_interval / day_seconds))
+        status_dict = {
+            'stats'    : stat_dict,
+            'interval' : record_interval,
+            'agents'   : agent_list,
+        }
+        return utils.encode_to_json(status_dict)
+
+    etag = 'fleet-summary-%s' % (fleet_sequence(), )
+    return utils.conditional_response(etag, summary_content)
+
+
+@APP.route('/fleet/points/')
+def fleet_points():
+    check_fleet()
+    resolution = request.args.get('resolution', None)
+    max_points = request.args.get('max_points', None)
+
+    # Check argument values
+    if resolution not in storage.RESOLUTION_LIST:
+        resolution = None
+    if max_points is not None:
+        try:
+            max_points = int(max_points)
+        except ValueError:
+            max_points = None
+
+    def points_content():
+        point_dict, resolution_, agent_list = utils.get_fleet_points(
+            resolution=resolution, max_points=max_points)
+        status_dict = {
+            'points'     : point_dict,
+            'resolution' : resolution_,
+            'agents'     : agent_list,
+        }
+        return utils.encode_to_json(status_dict)
+
+    args = (fleet_sequence(), resolution, max_points, )
+    etag = 'fleet-points-%s-%r-%r' % args
+    return utils.conditional_response(etag, points_content)
+
+
 ################################################################################
 # File Downalod Routes
 ################################################################################
 
 
+def download_args():
+    start = request.args.get('from', None)
+    end = request.args.get('to', None)
+    compress = request.args.get('gzip', 'true') != 'false'
+
+    # Check argument values
+    try:
+        start = None if start is None else float(start)
+    except ValueError:
+        start = None
+    try:
+        end = None if end is None else float(end)
+    except ValueError:
+        end = None
+    return start, end, compress
+
+
 @APP.route('/download/log.csv')
 def download_csv():
-    csv_log_filepath = utils.get_csv_log_filepath()
-    response = utils.download_file(csv_log_filepath)
+    start, end, compress = download_args()
+    response = utils.download_log('.csv', start=start, end=end,
+                                  compress=compress)
     return response
 
 
 @APP.route('/download/log.json')
 def download_json():
-    json_log_filepath = utils.get_json_log_filepath()
-    response = utils.download_file(json_log_filepath)
+    start, end, compress = download_args()
+    response = utils.download_log('.json', start=start, end=end,
+                                  compress=compress)
     return response
@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+"""
+Intercheck SpeedTest scheduler
+
+SpeedTests run at *slots*, the wall-clock times of a grid of ``interval``
+seconds.  With ``align`` (the ``interval_exact`` setting) the grid is aligned
+to the local clock, e.g. every 5 minutes at :00, :05, :10, ...; otherwise it
+starts at the first SpeedTest.  Each slot follows the previous one on the grid,
+instead of being "now" plus a timeout, so timing errors do not accumulate.
+
+:class:`Scheduler` waits on the Tornado IOLoop, not in a sleeping thread, and
+runs the SpeedTests one after another in its own long-lived worker thread.
+The wait for a slot is an absolute deadline on the monotonic clock, so setting
+the wall clock does not wake it up early.  Where it exists, that is the clock
+that keeps counting while the system is suspended (``CLOCK_BOOTTIME``);
+otherwise a slot that is due on the wall clock is trusted over the monotonic
+deadline, as it is after a suspend.  The wait is also checked at least every
+:data:`MAX_WAIT` seconds, whatever clock the IOLoop uses.  On waking up, after a
+suspend or a SpeedTest longer than ``interval``, the slots that went by are
+*missed* and handled by the ``missed`` policy:
+
+- ``skip``: drop the missed slots and wait for the next one
+- ``once``: run once, right away, for all of the missed slots
+- ``catchup``: run once for each missed slot, back to back (at most
+  ``max_catchup`` in a row), then skip the rest
+"""
+from __future__ import absolute_import, division, print_function
+# Intercheck
+from . import metrics
+# Python built-in
+import threading
+import functools
+import calendar
+import logging
+import math
+import time
+import sys
+import os
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+
+# Configure the logger
+print = logging.warning
+
+
+MISSED_POLICY_LIST = ['catchup', 'once', 'skip']
+
+
+# The longest wait before the deadline is checked again
+MAX_WAIT = 60.0
+
+
+# clock_gettime clock ids (see clock_gettime(2))
+CLOCK_MONOTONIC = 1
+CLOCK_BOOTTIME = 7
+
+
+def load_monotonic():
+    """ Return ``(clock, suspend_aware)``: a monotonic clock, or ``time.time``
+    if there is none, and whether it keeps counting while suspended.
+
+    Python 2 has no ``time.monotonic``, so on Linux ``clock_gettime`` is called
+    through ctypes, with ``CLOCK_BOOTTIME`` if the kernel has it.
+    """
+    if hasattr(time, 'CLOCK_BOOTTIME'):
+        return functools.partial(time.clock_gettime, time.CLOCK_BOOTTIME), True
+    if hasattr(time, 'monotonic'):
+        return time.monotonic, False
+    if ctypes is None or not sys.platform.startswith('linux'):
+        return time.time, False
+    libc_name = ctypes.util.find_library('c')
+    if libc_name is None:
+        return time.time, False
+    try:
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        clock_gettime = libc.clock_gettime
+    except (OSError, AttributeError):
+        return time.time, False
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    def make_clock(clock_id):
+        def monotonic():
+            value = timespec()
+            if clock_gettime(clock_id, ctypes.byref(value)) != 0:
+                errno_ = ctypes.get_errno()
+                raise OSError(errno_, os.strerror(errno_))
+            return value.tv_sec + value.tv_nsec * 1e-9
+        return monotonic
+
+    for clock_id, suspend_aware in [(CLOCK_BOOTTIME, True), (CLOCK_MONOTONIC, False)]:
+        monotonic = make_clock(clock_id)
+        try:
+            monotonic()
+        except OSError:
+            # e.g. CLOCK_BOOTTIME before Linux 2.6.39
+            continue
+        return monotonic, suspend_aware
+    return time.time, False
+
+
+monotonic, SUSPEND_AWARE = load_monotonic()
+
+
+def utc_offset(wall):
+    """ Return the offset of the local time from UTC, in seconds, at ``wall``. """
+    return calendar.timegm(time.localtime(wall)) - math.floor(wall)
+
+
+class Scheduler(object):
+    """ Run ``func`` at every slot, see the module documentation.
+
+    Args:
+        func (callable): runs a SpeedTest (in a worker thread) and returns True
+            if it succeeded
+        interval (float): seconds between two slots
+        retry_interval (float): seconds between two slots after a failure
+        align (bool): align the slots to the local wall clock
+        missed (str): the policy for missed slots, see :data:`MISSED_POLICY_LIST`
+        max_catchup (int): the most missed slots run in a row by ``catchup``
+        tolerance (float): how late (in seconds) a slot can start before it is
+            missed, defaults to half of the interval
+        io_loop (tornado.ioloop.IOLoop): defaults to the current IOLoop
+    """
+    def __init__(self, func, interval, retry_interval=30.0, align=True,
+                 missed='once', max_catchup=3, tolerance=None, io_loop=None):
+        if missed not in MISSED_POLICY_LIST:
+            raise ValueError('Unknown missed slot policy %r' % (missed, ))
+        self.func = func
+        self.interval = float(interval)
+        self.retry_interval = float(retry_interval)
+        self.align = align
+        self.missed = missed
+        self.max_catchup = max_catchup
+        self.tolerance = tolerance
+        self.io_loop = io_loop
+        self.origin = None
+        self.last_slot = None
+        self.slot = None
+        self.deadline = None
+        self.timeout = None
+        self.success = True
+        self.running = False
+        self.stopped = False
+        self.forced = False
+        self.catchup = 0
+        self.count = 0
+        self.duration_total = 0.0
+        # The worker thread and the slot it is asked to run, see _run
+        self.thread = None
+        self.job = None
+        self.job_condition = threading.Condition()
+
+    def current_interval(self):
+        return self.interval if self.success else self.retry_interval
+
+    def duration_avg(self):
+        """ Return the mean duration of the runs so far, or None. """
+        if self.count == 0:
+            return None
+        return self.duration_total / self.count
+
+    def grid_after(self, wall, interval):
+        """ Return the first slot of the ``interval`` grid strictly after ``wall``. """
+        origin = -utc_offset(wall) if self.align else self.origin
+        # A slot computed from the grid may be a rounding error before the grid
+        index = math.floor((wall - origin) / interval + 1e-6) + 1
+        return origin + index * interval
+
+    def start(self):
+        """ Run now, then at every slot.  The IOLoop must be started separately. """
+        if self.io_loop is None:
+            import tornado.ioloop
+            self.io_loop = tornado.ioloop.IOLoop.current()
+        self.origin = time.time()
+        self.io_loop.add_callback(self._run, self.origin)
+
+    def stop(self):
+        self.stopped = True
+        self.io_loop.add_callback(self._cancel)
+        with self.job_condition:
+            self.job_condition.notify()
+
+    def wake(self):
+        """ Run now (e.g. a forced SpeedTest), or right after the current run.
+
+        Safe to call from any thread.
+        """
+        self.io_loop.add_callback(self._force)
+
+    def configure(self, **kwargs):
+        """ Change ``interval``, ``align``, ``missed``, ... and reschedule.
+
+        Safe to call from any thread.
+        """
+        if kwargs.get('missed', self.missed) not in MISSED_POLICY_LIST:
+            raise ValueError('Unknown missed slot policy %r' % (kwargs['missed'], ))
+        self.io_loop.add_callback(self._configure, kwargs)
+
+    def _configure(self, kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+        self.interval = float(self.interval)
+        self.retry_interval = float(self.retry_interval)
+        if not self.running and self.slot is not None:
+            self._cancel()
+            self.slot = self.grid_after(self.last_slot, self.current_interval())
+            self._arm()
+
+    def _cancel(self):
+        if self.timeout is not None:
+            self.io_loop.remove_timeout(self.timeout)
+            self.timeout = None
+
+    def _arm(self):
+        wall = time.time()
+        delay = max(0.0, self.slot - wall)
+        self.deadline = monotonic() + delay
+        self.timeout = self.io_loop.call_later(min(delay, MAX_WAIT), self._wake)
+        time_str = time.strftime('%D %H:%M:%S', time.localtime(self.slot))
+        avg = self.duration_avg() or 0.0
+        args = (delay, time_str, self.current_interval(), avg, )
+        print('Waiting for next check in %0.2f sec. at %s (interval %0.2f, avg. %0.3f)' % args)
+
+    def _wake(self):
+        self.timeout = None
+        remaining = self.deadline - monotonic()
+        if remaining > 0.001 and (SUSPEND_AWARE or time.time() < self.slot):
+            # Not due yet (e.g. the wall clock was set forward), keep waiting.
+            # Without a suspend-aware clock, a slot due on the wall clock is
+            # run: the monotonic clock may have stopped during a suspend
+            delay = min(remaining, MAX_WAIT)
+            self.timeout = self.io_loop.call_later(delay, self._wake)
+            return
+        interval = self.current_interval()
+        tolerance = interval * 0.5 if self.tolerance is None else self.tolerance
+        late = time.time() - self.slot
+        if late <= tolerance:
+            self.catchup = 0
+            self._run(self.slot)
+            return
+        # Every slot from this one to the latest one that went by was missed
+        missed = int(math.floor(late / interval)) + 1
+        latest = self.slot + (missed - 1) * interval
+        if self.missed == 'catchup' and self.catchup < self.max_catchup:
+            self.catchup += 1
+            metrics.SCHEDULER_MISSED_TOTAL.inc(action='caught_up')
+            self._run(self.slot)
+        elif self.missed == 'once':
+            if missed > 1:
+                metrics.SCHEDULER_MISSED_TOTAL.inc(missed - 1, action='skipped')
+            metrics.SCHEDULER_MISSED_TOTAL.inc(action='caught_up')
+            self._run(latest)
+        else:
+            print('Skipping %d missed check(s)' % (missed, ))
+            metrics.SCHEDULER_MISSED_TOTAL.inc(missed, action='skipped')
+            self.catchup = 0
+            self.last_slot = latest
+            self.slot = latest + interval
+            self._arm()
+
+    def _force(self):
+        if self.stopped:
+            return
+        if self.running:
+            self.forced = True
+            return
+        self._cancel()
+        self.catchup = 0
+        self._run(time.time())
+
+    def _run(self, slot):
+        self.running = True
+        self.last_slot = slot
+        metrics.SCHEDULER_OFFSET_SECONDS.observe(time.time() - slot)
+        # A single long-lived worker, as every thread keeps its own shard in
+        # metrics.REGISTRY: a thread per run would add a shard per run
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._worker)
+            self.thread.setDaemon(True)
+            self.thread.start()
+        with self.job_condition:
+            self.job = slot
+            self.job_condition.notify()
+
+    def _worker(self):
+        while True:
+            with self.job_condition:
+                while self.job is None and not self.stopped:
+                    self.job_condition.wait()
+                if self.job is None:
+                    return
+                slot, self.job = self.job, None
+            self._work(slot)
+
+    def _work(self, slot):
+        start = time.time()
+        try:
+            success = bool(self.func())
+        except Exception as unexpected:
+            print('\n\nCAUGHT UNEXPECTED EXCEPTION: %r\n\n' % (unexpected, ))
+            success = False
+        duration = time.time() - start
+        self.io_loop.add_callback(self._done, slot, success, duration)
+
+    def _done(self, slot, success, duration):
+        self.running = False
+        self.success = success
+        self.count += 1
+        self.duration_total += duration
+        metrics.SCHEDULER_RUN_AVG_SECONDS.observe(self.duration_avg())
+        if self.duration_avg() > self.interval:
+            print('Warning, interval less than average duration')
+        if self.stopped:
+            return
+        if self.forced:
+            self.forced = False
+            self._run(time.time())
+            return
+        self.slot = self.grid_after(slot, self.current_interval())
+        self._arm()
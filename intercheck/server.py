@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+"""
+Intercheck asynchronous web server
+
+The Flask ``APP`` is a WSGI application, which Tornado can only run
+synchronously on its IOLoop thread (``tornado.wsgi.WSGIContainer``), so one
+slow request stalls every other client.  Instead, :class:`WSGIExecutorHandler`
+runs the Flask views in a bounded thread pool and streams their responses back
+from the IOLoop, while cheap endpoints (``/status/`` and ``/metrics``) are
+served by native Tornado handlers without leaving the IOLoop.  ``/events/``
+pushes status changes and new samples to any number of dashboards as
+server-sent events.
+"""
+from __future__ import absolute_import, division, print_function
+# HTTP / HTML
+import tornado.concurrent
+import tornado.ioloop
+import tornado.wsgi
+import tornado.web
+import tornado.gen
+# Intercheck
+from . import events
+from . import metrics
+from . import routes
+# Python built-in
+import simplejson
+import logging
+try:
+    import concurrent.futures
+except ImportError:
+    concurrent = None
+
+
+# Configure the logger
+print = logging.warning
+
+
+class NativeHandler(tornado.web.RequestHandler):
+    """ A native handler, which records its latency and size like
+    :class:`intercheck.metrics.WSGIMetricsMiddleware` does for the Flask views.
+    """
+    route = None
+    size = 0
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        super(NativeHandler, self).write(chunk)
+
+    def on_finish(self):
+        args = (self.route, self.request.method, str(self.get_status()),
+                self.request.request_time(), self.size, )
+        metrics.record_request(*args)
+
+
+class StatusHandler(NativeHandler):
+    """ Native handler for ``/status/``, served directly on the IOLoop. """
+    route = '/status/'
+
+    def get(self):
+        content = routes.status_content(target=self.get_argument('target', None))
+        self.set_header('Content-Type', 'text/html; charset=utf-8')
+        self.write(content)
+
+
+class MetricsHandler(NativeHandler):
+    """ Native handler for ``/metrics``, so scrapes never wait for a worker. """
+    route = '/metrics'
+
+    def get(self):
+        self.set_header('Content-Type', metrics.CONTENT_TYPE)
+        self.write(metrics.render())
+
+
+class EventsHandler(tornado.web.RequestHandler):
+    """ Server-sent events (``text/event-stream``) for ``/events/``.
+
+    Each client immediately receives the latest ``status`` and ``sample``
+    events and then every new event as it is published, plus a comment every
+    :attr:`keepalive_interval` seconds so that dead connections are noticed.
+    As the stream never ends, the request metrics record the time to the
+    first byte, and the size of each event.
+    """
+    route = '/events/'
+    keepalive_interval = 15.0
+
+    @tornado.gen.coroutine
+    def get(self):
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        self.ioloop = tornado.ioloop.IOLoop.current()
+        self.closed = tornado.concurrent.Future()
+        for event, data in events.BROADCASTER.latest():
+            self.send(event, data)
+        events.subscribe(self.on_event)
+        self.keepalive = tornado.ioloop.PeriodicCallback(
+            self.send_keepalive, self.keepalive_interval * 1000)
+        self.keepalive.start()
+        self.flush()
+        metrics.HTTP_SECONDS.observe(self.request.request_time(),
+                                     route=self.route,
+                                     method=self.request.method,
+                                     status=str(self.get_status()))
+        yield self.closed
+
+    def on_event(self, event, data):
+        # Called from the publishing thread, hand over to the IOLoop
+        self.ioloop.add_callback(self.send, event, data)
+
+    def send(self, event, data):
+        if self.closed.done():
+            return
+        args = (event, simplejson.dumps(data), )
+        message = 'event: %s\ndata: %s\n\n' % args
+        self.write(message)
+        self.flush()
+        metrics.HTTP_BYTES.observe(len(message), route=self.route,
+                                   method=self.request.method)
+
+    def send_keepalive(self):
+        if self.closed.done():
+            return
+        self.write(': keepalive\n\n')
+        self.flush()
+
+    def on_connection_close(self):
+        events.unsubscribe(self.on_event)
+        if hasattr(self, 'keepalive'):
+            self.keepalive.stop()
+        if hasattr(self, 'closed') and not self.closed.done():
+            self.closed.set_result(None)
+
+
+class WSGIExecutorHandler(tornado.web.RequestHandler):
+    """ Run a WSGI application in a thread pool and stream its response.
+
+    Both the call into the application and each iteration of its response
+    body happen on the executor, so large (streaming) downloads and expensive
+    statistics never block the IOLoop.
+    """
+    SUPPORTED_METHODS = ('GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'OPTIONS')
+
+    def initialize(self, container, executor):
+        self.container = container
+        self.executor = executor
+
+    def compute_etag(self):
+        # The application is responsible for its own ETags
+        return None
+
+    @staticmethod
+    def start_application(application, environ):
+        header_dict = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            header_dict['status'] = status
+            header_dict['headers'] = response_headers
+            return lambda data: None
+
+        app_iter = application(environ, start_response)
+        iterator = iter(app_iter)
+        chunk = next(iterator, None)
+        return header_dict, app_iter, iterator, chunk
+
+    @tornado.gen.coroutine
+    def handle(self, *args, **kwargs):
+        environ = self.container.environ(self.request)
+        application = self.container.wsgi_application
+        result = yield self.executor.submit(self.start_application,
+                                            application, environ)
+        header_dict, app_iter, iterator, chunk = result
+        # Copy the status and headers from the application
+        status = header_dict['status']
+        status_code = int(status.split()[0])
+        reason = status.split(' ', 1)[1] if ' ' in status else None
+        self.set_status(status_code, reason)
+        self.clear_header('Content-Type')
+        for key, value in header_dict['headers']:
+            self.add_header(key, value)
+        # Stream the body, one chunk at a time from the executor
+        try:
+            while chunk is not None:
+                if chunk:
+                    self.write(chunk)
+                    yield self.flush()
+                chunk = yield self.executor.submit(next, iterator, None)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        self.finish()
+
+    get = head = post = put = delete = options = handle
+
+
+def make_application(app, workers=4):
+    """ Return the Tornado application serving the Flask ``app``.
+
+    Args:
+        app (flask.Flask): the WSGI application
+        workers (int): the number of threads used to run the Flask views.  If
+            zero (or :mod:`concurrent.futures` is not available), the views run
+            synchronously on the IOLoop through ``tornado.wsgi.WSGIContainer``.
+
+    Returns:
+        application (tornado.web.Application)
+    """
+    container = tornado.wsgi.WSGIContainer(app)
+    if workers > 0 and concurrent is None:
+        print('Cannot import concurrent.futures, install using '
+              '\'pip install futures\', serving synchronously')
+        workers = 0
+    if workers > 0:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        fallback = (r'.*', WSGIExecutorHandler, {
+            'container' : container,
+            'executor'  : executor,
+        })
+    else:
+        fallback = (r'.*', tornado.web.FallbackHandler, {
+            'fallback' : container,
+        })
+    handler_list = [
+        (r'/events/', EventsHandler),
+        (r'/metrics', MetricsHandler),
+        (r'/status/', StatusHandler),
+        fallback,
+    ]
+    return tornado.web.Application(handler_list)
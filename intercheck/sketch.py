@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""
+Intercheck quantile sketches
+
+:class:`DDSketch` estimates quantiles (e.g. the 95th percentile ping) without
+keeping the values: each value is counted into a logarithmically sized bin, so
+any quantile is returned within a relative error of ``relative_accuracy`` (1%
+by default).  Sketches with the same accuracy merge exactly, by adding their
+bins, which is what makes it possible to keep one sketch per time bucket and
+answer arbitrary windows by merging the buckets they cover.
+
+See Masson, Rim and Lee, "DDSketch: A Fast and Fully-Mergeable Quantile Sketch
+with Relative-Error Guarantees", VLDB 2019.
+"""
+from __future__ import absolute_import, division, print_function
+# Python built-in
+import logging
+import math
+
+
+# Configure the logger
+print = logging.warning
+
+
+# Values at or below this are counted as zero (SpeedTest values are never negative)
+MIN_VALUE = 1e-9
+
+
+class DDSketch(object):
+    """ A mergeable quantile sketch of non-negative values.
+
+    The number of bins grows with the logarithm of the range of the values,
+    not with their count: at 1% accuracy, values between 0.01 and 100,000 need
+    at most about 800 bins.
+    """
+    __slots__ = ('relative_accuracy', 'gamma', 'log_gamma', 'bin_dict',
+                 'zero_count', 'count', 'min', 'max')
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1.0 + relative_accuracy) / (1.0 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bin_dict = {}
+        self.zero_count = 0
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        if value <= MIN_VALUE:
+            self.zero_count += 1
+        else:
+            key = int(math.ceil(math.log(value) / self.log_gamma))
+            self.bin_dict[key] = self.bin_dict.get(key, 0) + 1
+        self.count += 1
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """ Add the values of ``other`` (with the same accuracy) to this sketch. """
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('Cannot merge sketches with different accuracies')
+        if other.count == 0:
+            return
+        for key, count in other.bin_dict.items():
+            self.bin_dict[key] = self.bin_dict.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+
+    def copy(self):
+        sketch = DDSketch(self.relative_accuracy)
+        sketch.merge(self)
+        return sketch
+
+    def quantile(self, quantile):
+        """ Return the estimated ``quantile`` (between 0 and 1), None if empty. """
+        if self.count == 0:
+            return None
+        rank = quantile * (self.count - 1)
+        cumulative = self.zero_count
+        if cumulative > rank:
+            return 0.0
+        value = self.max
+        for key in sorted(self.bin_dict):
+            cumulative += self.bin_dict[key]
+            if cumulative > rank:
+                # The middle of the bin, within relative_accuracy of any value in it
+                value = 2.0 * self.gamma ** key / (self.gamma + 1.0)
+                break
+        return min(max(value, self.min), self.max)
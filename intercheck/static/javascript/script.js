@@ -3,6 +3,7 @@ var status_timeout = undefined;
 var status_min_interval = 5 * 1000;
 var summary_timeout = undefined;
 var summary_min_interval = 60 * 60 * 1000;
+var events_source = undefined;
 
 function force() {
     if( ! $("a#status-force").find("i").hasClass("fa-circle")) {
@@ -18,8 +19,10 @@ function force() {
             if(response["status"]) {
                 $("a#status-force").addClass("forcing");
                 $("a#status-force").find("span").html("Forcing...");
-                // Make this interval double what the force interval is in Intercheck
-                status_timeout = setTimeout(get_status, 2000);
+                if(events_source === undefined) {
+                    // Make this interval double what the force interval is in Intercheck
+                    status_timeout = setTimeout(get_status, 2000);
+                }
             }
             else {
                 update_status_message("Intercheck could not force a SpeedTest", true);
@@ -28,6 +31,27 @@ function force() {
     }
 }
 
+function get_events() {
+    // Prefer pushed events, fall back to polling if the browser cannot
+    if(typeof(EventSource) === "undefined") {
+        return false;
+    }
+    events_source = new EventSource("/events/");
+    events_source.addEventListener("status", function(event) {
+        response = $.parseJSON(event.data);
+        update_status_indicators(response["status"]);
+    });
+    events_source.addEventListener("sample", function(event) {
+        clearTimeout(summary_timeout);
+        get_summary();
+    });
+    events_source.onerror = function() {
+        // The browser reconnects on its own
+        update_status_indicators([]);
+    };
+    return true;
+}
+
 function get_status() {
     var request = $.ajax({
         type: "GET",
@@ -38,7 +62,9 @@ function get_status() {
         response = $.parseJSON(raw);
         update_status_indicators(response["status"]);
     }).complete(function() {
-        status_timeout = setTimeout(get_status, status_min_interval);
+        if(events_source === undefined) {
+            status_timeout = setTimeout(get_status, status_min_interval);
+        }
     });
 }
 
@@ -126,6 +152,7 @@ function init_graphs() {
 $(document).ready(function() {
 
     init_graphs();
+    get_events();
     get_status();
     get_summary();
 
@@ -0,0 +1,1378 @@
+#!/usr/bin/env python
+"""
+Intercheck storage engines
+
+Every SpeedTest record is a flat dictionary keyed by :data:`KEY_LIST` (or a
+:class:`Record`, which behaves like one).  The storage engines below all
+expose the same small interface (:class:`Storage`) so that
+:func:`intercheck.utils.write_to_logs`, :func:`intercheck.utils.get_stats` and
+the download routes do not need to know how the records are kept on disk.
+"""
+from __future__ import absolute_import, division, print_function
+# Intercheck
+from . import metrics
+# Python built-in
+import simplejson
+import itertools
+import threading
+import calendar
+import logging
+import sqlite3
+import shutil
+import struct
+import bisect
+import gzip
+import mmap
+import time
+import csv
+import os
+
+
+# Configure the logger
+print = logging.warning
+
+
+KEY_LIST = ['start', 'duration', 'ping', 'download', 'upload']
+CHUNK_SIZE = 64 * 1024
+METRIC_LIST = ['ping', 'download', 'upload', 'duration']
+
+
+# Rollup resolutions, in seconds per bucket
+RESOLUTION_DICT = {
+    'minute' : 60,
+    'hour'   : 60 * 60,
+    'day'    : 60 * 60 * 24,
+}
+RESOLUTION_LIST = sorted(RESOLUTION_DICT.keys(), key=RESOLUTION_DICT.get)
+
+
+def new_rollup(start):
+    rollup = {
+        'start' : start,
+        'count' : 0,
+    }
+    for key in METRIC_LIST:
+        rollup['%s_count' % (key, )] = 0
+        rollup['%s_sum' % (key, )] = 0.0
+        rollup['%s_min' % (key, )] = None
+        rollup['%s_max' % (key, )] = None
+    return rollup
+
+
+def update_rollup(rollup, record):
+    rollup['count'] += 1
+    for key in METRIC_LIST:
+        value = record.get(key, None)
+        if value is None:
+            continue
+        min_key, max_key = '%s_min' % (key, ), '%s_max' % (key, )
+        rollup['%s_count' % (key, )] += 1
+        rollup['%s_sum' % (key, )] += value
+        if rollup[min_key] is None or value < rollup[min_key]:
+            rollup[min_key] = value
+        if rollup[max_key] is None or value > rollup[max_key]:
+            rollup[max_key] = value
+
+
+def finalize_rollup(rollup):
+    """ Return a copy of the rollup with the ``<key>_mean`` of each metric. """
+    rollup = dict(rollup)
+    for key in METRIC_LIST:
+        count = rollup['%s_count' % (key, )]
+        total = rollup.pop('%s_sum' % (key, ))
+        rollup['%s_mean' % (key, )] = total / count if count > 0 else None
+    return rollup
+
+
+class Record(object):
+    """ A compact, read-only SpeedTest record.
+
+    Records decoded from the binary log (see :class:`BinaryStorage`) use slots
+    instead of a dictionary per record, but support the dictionary methods used
+    by the rest of Intercheck (``record['start']``, :meth:`get`, :meth:`items`).
+    """
+    __slots__ = tuple(KEY_LIST)
+
+    def __init__(self, start=None, duration=None, ping=None, download=None,
+                 upload=None):
+        self.start = start
+        self.duration = duration
+        self.ping = ping
+        self.download = download
+        self.upload = upload
+
+    def __getitem__(self, key):
+        if key not in KEY_LIST:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in KEY_LIST
+
+    def __iter__(self):
+        return iter(KEY_LIST)
+
+    def __len__(self):
+        return len(KEY_LIST)
+
+    def __eq__(self, other):
+        try:
+            return all(self[key] == other[key] for key in KEY_LIST)
+        except (KeyError, TypeError):
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Record(%s)' % (', '.join('%s=%r' % item for item in self.items()), )
+
+    def get(self, key, default=None):
+        if key not in KEY_LIST:
+            return default
+        return getattr(self, key)
+
+    def keys(self):
+        return list(KEY_LIST)
+
+    def values(self):
+        return [ getattr(self, key) for key in KEY_LIST ]
+
+    def items(self):
+        return [ (key, getattr(self, key), ) for key in KEY_LIST ]
+
+
+class RollupTable(object):
+    """ In-memory rollup buckets of a single resolution, sorted by start. """
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.start_list = []
+        self.rollup_dict = {}
+
+    def add(self, record):
+        start = record.get('start', None)
+        if start is None:
+            return
+        bucket = int(start // self.seconds) * self.seconds
+        if bucket not in self.rollup_dict:
+            if len(self.start_list) == 0 or self.start_list[-1] < bucket:
+                self.start_list.append(bucket)
+            else:
+                bisect.insort(self.start_list, bucket)
+            self.rollup_dict[bucket] = new_rollup(bucket)
+        update_rollup(self.rollup_dict[bucket], record)
+
+    def slice(self, start=None, end=None):
+        if start is None:
+            lo = 0
+        else:
+            bucket = int(start // self.seconds) * self.seconds
+            lo = bisect.bisect_left(self.start_list, bucket)
+        if end is None:
+            hi = len(self.start_list)
+        else:
+            hi = bisect.bisect_left(self.start_list, end)
+        return [ self.rollup_dict[bucket] for bucket in self.start_list[lo:hi] ]
+
+    def trim(self, start):
+        """ Drop the buckets before ``start``. """
+        index = bisect.bisect_left(self.start_list, start)
+        for bucket in self.start_list[:index]:
+            del self.rollup_dict[bucket]
+        del self.start_list[:index]
+
+
+def read_csv_log(csv_log_filepath):
+    record_list = []
+    try:
+        with open(csv_log_filepath, 'r') as csv_log:
+            reader = csv.reader(csv_log)
+            header = next(reader, None)
+            if header is None:
+                return record_list
+            for line in reader:
+                if len(line) != len(header):
+                    continue
+                record = {}
+                for key, value in zip(header, line):
+                    record[key] = None if value == '' else float(value)
+                record_list.append(record)
+    except IOError:
+        pass
+    return record_list
+
+
+def write_csv_log(csv_log_filepath, record, key_list=KEY_LIST):
+    if not os.path.exists(csv_log_filepath):
+        with open(csv_log_filepath, 'w') as csv_log:
+            csv_line = ','.join(key_list)
+            csv_log.write('%s\n' % (csv_line, ))
+    with open(csv_log_filepath, 'a') as csv_log:
+        args = [ record.get(key, None) for key in key_list ]
+        args = [ '' if arg is None else '%s' % (arg, ) for arg in args ]
+        csv_line = ','.join(args)
+        csv_log.write('%s\n' % (csv_line, ))
+
+
+def write_json_log(json_log_filepath, record, key_list=KEY_LIST):
+    log = read_json_log(json_log_filepath)
+    with open(json_log_filepath, 'w') as json_log:
+        args = { key : record.get(key, None) for key in key_list }
+        log['log'].append(args)
+        simplejson.dump(log, json_log)
+
+
+def write_jsonl_log(jsonl_log_filepath, record, key_list=KEY_LIST):
+    args = { key : record.get(key, None) for key in key_list }
+    jsonl_line = simplejson.dumps(args)
+    with open(jsonl_log_filepath, 'a') as jsonl_log:
+        jsonl_log.write('%s\n' % (jsonl_line, ))
+
+
+def read_legacy_log(json_log_filepath=None, csv_log_filepath=None):
+    """ Read the legacy JSON (or, failing that, CSV) log for migration. """
+    if json_log_filepath is not None and os.path.exists(json_log_filepath):
+        try:
+            return read_json_log(json_log_filepath)['log'], json_log_filepath
+        except simplejson.JSONDecodeError:
+            print('Cannot parse %s, skipping' % (json_log_filepath, ))
+    if csv_log_filepath is not None and os.path.exists(csv_log_filepath):
+        return read_csv_log(csv_log_filepath), csv_log_filepath
+    return [], None
+
+
+def read_json_log(json_log_filepath):
+    try:
+        with open(json_log_filepath, 'r') as json_log:
+            log = simplejson.load(json_log)
+    except IOError:
+        log = {
+            'log' : []
+        }
+    return log
+
+
+def build_where(start=None, end=None):
+    """ Return an SQL ``WHERE`` clause (and its arguments) for ``[start, end)``. """
+    where_list, arg_list = [], []
+    if start is not None:
+        where_list.append('start >= ?')
+        arg_list.append(start)
+    if end is not None:
+        where_list.append('start < ?')
+        arg_list.append(end)
+    if len(where_list) == 0:
+        return '', arg_list
+    return ' WHERE %s' % (' AND '.join(where_list), ), arg_list
+
+
+class Storage(object):
+    """ Base storage interface shared by all engines.
+
+    Subclasses must implement :meth:`_write` and :meth:`iter_records`;
+    everything else is built on top of those two methods.  The minute, hour and
+    day rollups (see :meth:`iter_rollups`) are built in memory on first use,
+    from the records of the days requested only, and then kept up to date by
+    every write.
+    """
+    name = None
+    # Whether records with the same start are skipped when written
+    unique = False
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rollup_table_dict = None
+        # The rollups only cover the records from here on (None for all)
+        self.rollup_start = None
+
+    def write(self, record):
+        self.write_many([record])
+
+    @metrics.time_storage
+    def write_many(self, record_list):
+        with self.lock:
+            accepted_list = self._write(record_list)
+            if accepted_list is not None:
+                record_list = accepted_list
+            if self.rollup_table_dict is not None:
+                rollup_start = self.rollup_start
+                for record in record_list:
+                    start = record.get('start', None)
+                    if rollup_start is not None and start < rollup_start:
+                        # Before the records the rollups cover
+                        continue
+                    for rollup_table in self.rollup_table_dict.values():
+                        rollup_table.add(record)
+
+    def _write(self, record_list):
+        """ Write the records, returns the ones written if some were skipped. """
+        raise NotImplementedError
+
+    def iter_records(self, start=None, end=None):
+        """ Yield records (in order of ``start``) within ``[start, end)``. """
+        raise NotImplementedError
+
+    def iter_since(self, sequence=None):
+        """ Yield ``(sequence, record)`` for the records written after ``sequence``.
+
+        Sequences increase monotonically in the order records are written, so
+        the last sequence seen by a client is a cursor for the next poll.
+        """
+        raise NotImplementedError
+
+    def sequence(self):
+        """ Return the sequence of the last record written (0 if empty). """
+        raise NotImplementedError
+
+    @metrics.time_storage
+    def iter_rollups(self, resolution, start=None, end=None):
+        """ Yield the rollups of a resolution (see :data:`RESOLUTION_DICT`).
+
+        Each rollup has the bucket ``start``, the record ``count`` and the
+        ``<key>_count``, ``<key>_min``, ``<key>_max`` and ``<key>_mean`` of every
+        metric in :data:`METRIC_LIST`.  A bucket is included if it overlaps
+        ``[start, end)``.
+        """
+        # From the start of the largest bucket, so every bucket is complete
+        rollup_start = None
+        if start is not None:
+            seconds = RESOLUTION_DICT[RESOLUTION_LIST[-1]]
+            rollup_start = int(start // seconds) * seconds
+        with self.lock:
+            covered = self.rollup_table_dict is not None and (
+                self.rollup_start is None or
+                (rollup_start is not None and rollup_start >= self.rollup_start)
+            )
+            if not covered:
+                rollup_table_dict = {
+                    resolution_ : RollupTable(seconds)
+                    for resolution_, seconds in RESOLUTION_DICT.items()
+                }
+                for record in self.iter_records(start=rollup_start):
+                    for rollup_table in rollup_table_dict.values():
+                        rollup_table.add(record)
+                self.rollup_table_dict = rollup_table_dict
+                self.rollup_start = rollup_start
+            elif rollup_start is not None and rollup_start > self.rollup_start:
+                # The window moved on, forget the older buckets
+                for rollup_table in self.rollup_table_dict.values():
+                    rollup_table.trim(rollup_start)
+                self.rollup_start = rollup_start
+            rollup_list = self.rollup_table_dict[resolution].slice(start, end)
+            rollup_list = [ finalize_rollup(rollup) for rollup in rollup_list ]
+        for rollup in rollup_list:
+            yield rollup
+
+    @metrics.time_storage
+    def count(self, start=None, end=None):
+        return sum(1 for _ in self.iter_records(start=start, end=end))
+
+    def close(self):
+        pass
+
+    def iter_csv(self, key_list=KEY_LIST, chunk_size=CHUNK_SIZE, **kwargs):
+        """ Yield the CSV log in chunks of about ``chunk_size`` bytes. """
+        line_list = [','.join(key_list)]
+        size = 0
+        for record in self.iter_records(**kwargs):
+            args = [ record.get(key, None) for key in key_list ]
+            args = [ '' if arg is None else '%s' % (arg, ) for arg in args ]
+            csv_line = ','.join(args)
+            line_list.append(csv_line)
+            size += len(csv_line) + 1
+            if size >= chunk_size:
+                line_list.append('')
+                yield '\n'.join(line_list)
+                line_list, size = [], 0
+        line_list.append('')
+        yield '\n'.join(line_list)
+
+    def iter_json(self, key_list=KEY_LIST, chunk_size=CHUNK_SIZE, **kwargs):
+        """ Yield the JSON log (``{"log": [...]}``) in chunks of about
+        ``chunk_size`` bytes.
+        """
+        chunk_list = ['{"log": [']
+        size = 0
+        separator = ''
+        for record in self.iter_records(**kwargs):
+            args = { key : record.get(key, None) for key in key_list }
+            json_str = '%s%s' % (separator, simplejson.dumps(args), )
+            separator = ', '
+            chunk_list.append(json_str)
+            size += len(json_str)
+            if size >= chunk_size:
+                yield ''.join(chunk_list)
+                chunk_list, size = [], 0
+        chunk_list.append(']}')
+        yield ''.join(chunk_list)
+
+    def iter_jsonl(self, key_list=KEY_LIST, chunk_size=CHUNK_SIZE, **kwargs):
+        """ Yield the JSON Lines log (one object per line) in chunks of about
+        ``chunk_size`` bytes.
+        """
+        line_list = []
+        size = 0
+        for record in self.iter_records(**kwargs):
+            args = { key : record.get(key, None) for key in key_list }
+            json_line = simplejson.dumps(args)
+            line_list.append(json_line)
+            size += len(json_line) + 1
+            if size >= chunk_size:
+                line_list.append('')
+                yield '\n'.join(line_list)
+                line_list, size = [], 0
+        if len(line_list) > 0:
+            line_list.append('')
+            yield '\n'.join(line_list)
+
+    def export_csv(self, key_list=KEY_LIST, **kwargs):
+        return ''.join(self.iter_csv(key_list=key_list, **kwargs))
+
+    def export_json(self, key_list=KEY_LIST, **kwargs):
+        return ''.join(self.iter_json(key_list=key_list, **kwargs))
+
+
+class JSONStorage(Storage):
+    """ Legacy storage, a CSV log and a JSON log rewritten on every write. """
+    name = 'json'
+
+    def __init__(self, json_log_filepath, csv_log_filepath):
+        super(JSONStorage, self).__init__()
+        self.json_log_filepath = json_log_filepath
+        self.csv_log_filepath = csv_log_filepath
+
+    def _write(self, record_list):
+        for record in record_list:
+            write_csv_log(self.csv_log_filepath, record)
+            write_json_log(self.json_log_filepath, record)
+
+    @metrics.time_storage
+    def iter_records(self, start=None, end=None):
+        log = read_json_log(self.json_log_filepath)
+        for record in log['log']:
+            if start is not None and record['start'] < start:
+                continue
+            if end is not None and record['start'] >= end:
+                continue
+            yield record
+
+    @metrics.time_storage
+    def iter_since(self, sequence=None):
+        sequence = 0 if sequence is None else sequence
+        log = read_json_log(self.json_log_filepath)
+        for index, record in enumerate(log['log'][sequence:]):
+            yield sequence + index + 1, record
+
+    def sequence(self):
+        return len(read_json_log(self.json_log_filepath)['log'])
+
+
+class JSONLinesTailReader(object):
+    """ Incremental reader for an append-only JSON Lines log.
+
+    The reader remembers the byte offset of the last complete line it parsed,
+    so each :meth:`update` only decodes the records appended since the previous
+    call.  Records are kept in memory, sorted by ``start``, so that time-range
+    queries are a binary search, and in file order, so that the line number of
+    a record is its sequence.  If the file shrinks or is replaced, the reader
+    starts over from the beginning.
+    """
+    def __init__(self, jsonl_log_filepath):
+        self.jsonl_log_filepath = jsonl_log_filepath
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.offset = 0
+        self.inode = None
+        self.record_list = []
+        self.start_list = []
+        self.arrival_list = []
+
+    def update(self):
+        with self.lock:
+            try:
+                stat = os.stat(self.jsonl_log_filepath)
+            except OSError:
+                self.reset()
+                return 0
+            if stat.st_ino != self.inode or stat.st_size < self.offset:
+                self.reset()
+                self.inode = stat.st_ino
+            if stat.st_size == self.offset:
+                return 0
+            with open(self.jsonl_log_filepath, 'rb') as jsonl_log:
+                jsonl_log.seek(self.offset)
+                data = jsonl_log.read(stat.st_size - self.offset)
+            # Only consume complete lines, a partial line is still being written
+            end = data.rfind(b'\n')
+            if end < 0:
+                return 0
+            count = 0
+            for line in data[:end].split(b'\n'):
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                try:
+                    record = simplejson.loads(line)
+                except simplejson.JSONDecodeError:
+                    print('Skipping corrupt line in %s' % (self.jsonl_log_filepath, ))
+                    continue
+                self._insert(record)
+                count += 1
+            self.offset += end + 1
+            return count
+
+    def _insert(self, record):
+        start = record.get('start', None)
+        if start is None:
+            return
+        self.arrival_list.append(record)
+        if len(self.start_list) == 0 or self.start_list[-1] <= start:
+            self.start_list.append(start)
+            self.record_list.append(record)
+        else:
+            index = bisect.bisect_right(self.start_list, start)
+            self.start_list.insert(index, start)
+            self.record_list.insert(index, record)
+
+    def slice(self, start=None, end=None):
+        self.update()
+        with self.lock:
+            lo = 0 if start is None else bisect.bisect_left(self.start_list, start)
+            hi = len(self.start_list) if end is None else bisect.bisect_left(self.start_list, end)
+            return self.record_list[lo:hi]
+
+    def since(self, sequence=None):
+        self.update()
+        sequence = 0 if sequence is None else sequence
+        with self.lock:
+            return sequence, self.arrival_list[sequence:]
+
+    def sequence(self):
+        self.update()
+        return len(self.arrival_list)
+
+
+class JSONLinesStorage(Storage):
+    """ Append-only JSON Lines storage, one JSON object per line.
+
+    Writes never re-read the file, and reads go through a
+    :class:`JSONLinesTailReader` so only new lines are parsed.
+    """
+    name = 'jsonl'
+
+    def __init__(self, jsonl_log_filepath, json_log_filepath=None,
+                 csv_log_filepath=None):
+        super(JSONLinesStorage, self).__init__()
+        self.jsonl_log_filepath = jsonl_log_filepath
+        self._migrate(json_log_filepath, csv_log_filepath)
+        self.reader = JSONLinesTailReader(jsonl_log_filepath)
+        self._repair()
+
+    def _migrate(self, json_log_filepath, csv_log_filepath):
+        """ One-time import of the legacy log, if there is no JSON Lines log. """
+        if os.path.exists(self.jsonl_log_filepath):
+            return
+        record_list, source = read_legacy_log(json_log_filepath,
+                                              csv_log_filepath)
+        if source is None:
+            return
+        with open(self.jsonl_log_filepath, 'w') as jsonl_log:
+            for record in record_list:
+                args = { key : record.get(key, None) for key in KEY_LIST }
+                jsonl_log.write('%s\n' % (simplejson.dumps(args), ))
+        args = (len(record_list), source, self.jsonl_log_filepath, )
+        print('Migrated %d records from %s to %s' % args)
+
+    def _repair(self):
+        """ Terminate a partial last line (e.g. from a crash) before appending. """
+        try:
+            with open(self.jsonl_log_filepath, 'rb') as jsonl_log:
+                jsonl_log.seek(0, os.SEEK_END)
+                if jsonl_log.tell() == 0:
+                    return
+                jsonl_log.seek(-1, os.SEEK_END)
+                last = jsonl_log.read(1)
+        except IOError:
+            return
+        if last != b'\n':
+            with open(self.jsonl_log_filepath, 'a') as jsonl_log:
+                jsonl_log.write('\n')
+
+    def _write(self, record_list):
+        for record in record_list:
+            write_jsonl_log(self.jsonl_log_filepath, record)
+
+    @metrics.time_storage
+    def iter_records(self, start=None, end=None):
+        for record in self.reader.slice(start=start, end=end):
+            yield record
+
+    @metrics.time_storage
+    def iter_since(self, sequence=None):
+        sequence, record_list = self.reader.since(sequence)
+        for index, record in enumerate(record_list):
+            yield sequence + index + 1, record
+
+    def sequence(self):
+        return self.reader.sequence()
+
+    @metrics.time_storage
+    def count(self, start=None, end=None):
+        return len(self.reader.slice(start=start, end=end))
+
+
+# Binary log format: a header, then one fixed-width little-endian record per
+# SpeedTest (the values of KEY_LIST as float64, NaN if missing, and a flags
+# byte), sorted by start
+BINARY_MAGIC = b'INTRCHK\x00'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<8sII')
+BINARY_RECORD = struct.Struct('<%ddB' % (len(KEY_LIST), ))
+BINARY_START = struct.Struct('<d')
+BINARY_BLOCK = 1024
+BINARY_BLOCK_RECORD = struct.Struct('<' + BINARY_RECORD.format[1:] * BINARY_BLOCK)
+FLAG_FAILED = 0x01
+
+
+def pack_record(record):
+    value_list = [ record.get(key, None) for key in KEY_LIST ]
+    flags = FLAG_FAILED if None in value_list else 0
+    value_list = [ float('nan') if value is None else value for value in value_list ]
+    return BINARY_RECORD.pack(*(value_list + [flags]))
+
+
+def unpack_records(buffer_, offset, count):
+    """ Return the ``count`` records packed in ``buffer_`` from ``offset``. """
+    width = len(KEY_LIST) + 1
+    if count == BINARY_BLOCK:
+        block = BINARY_BLOCK_RECORD
+    else:
+        block = struct.Struct('<' + BINARY_RECORD.format[1:] * count)
+    value_list = block.unpack_from(buffer_, offset)
+    record_list = []
+    for index in range(0, len(value_list), width):
+        # NaN is the only value not equal to itself
+        record_value_list = [
+            None if value != value else value
+            for value in value_list[index:index + width - 1]
+        ]
+        record_list.append(Record(*record_value_list))
+    return record_list
+
+
+def iter_binary_file(binary_file):
+    """ Yield the records of a binary log from a (e.g. gzip) file object. """
+    header = binary_file.read(BINARY_HEADER.size)
+    if len(header) < BINARY_HEADER.size:
+        return
+    block_size = BINARY_BLOCK * BINARY_RECORD.size
+    remainder = b''
+    while True:
+        data = binary_file.read(block_size)
+        if not data:
+            break
+        data = remainder + data
+        count = len(data) // BINARY_RECORD.size
+        remainder = data[count * BINARY_RECORD.size:]
+        for record in unpack_records(data, 0, count):
+            yield record
+
+
+class BinaryLogReader(object):
+    """ Memory-mapped reader for the binary log.
+
+    The file is mapped read-only and mapped again whenever it grows or is
+    replaced.  Records are decoded only when they are read, and a time range
+    is found by binary search on the ``start`` of the fixed-width records.
+    """
+    def __init__(self, binary_log_filepath):
+        self.binary_log_filepath = binary_log_filepath
+        self.lock = threading.Lock()
+        self.buffer = None
+        self.size = None
+        self.inode = None
+
+    def mapping(self):
+        """ Return ``(buffer, count)``, the current mapping and its records. """
+        with self.lock:
+            try:
+                stat = os.stat(self.binary_log_filepath)
+            except OSError:
+                self.buffer, self.size, self.inode = None, None, None
+                return None, 0
+            if stat.st_ino != self.inode or stat.st_size != self.size:
+                self.buffer = None
+                if stat.st_size > BINARY_HEADER.size:
+                    with open(self.binary_log_filepath, 'rb') as binary_log:
+                        # Older mappings are closed once no reader uses them
+                        self.buffer = mmap.mmap(binary_log.fileno(), 0,
+                                                access=mmap.ACCESS_READ)
+                self.size = stat.st_size
+                self.inode = stat.st_ino
+            buffer_, size = self.buffer, self.size
+        if buffer_ is None:
+            return None, 0
+        # Ignore a partial last record (e.g. from a crash)
+        count = (size - BINARY_HEADER.size) // BINARY_RECORD.size
+        return buffer_, count
+
+    def start_at(self, buffer_, index):
+        offset = BINARY_HEADER.size + index * BINARY_RECORD.size
+        return BINARY_START.unpack_from(buffer_, offset)[0]
+
+    def bisect(self, buffer_, count, start):
+        """ Return the index of the first record at or after ``start``. """
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.start_at(buffer_, mid) < start:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def slice(self, start=None, end=None):
+        """ Return ``(buffer, lo, hi)`` for the records within ``[start, end)``. """
+        buffer_, count = self.mapping()
+        if buffer_ is None:
+            return None, 0, 0
+        lo = 0 if start is None else self.bisect(buffer_, count, start)
+        hi = count if end is None else self.bisect(buffer_, count, end)
+        return buffer_, lo, max(lo, hi)
+
+    def iter_slice(self, buffer_, lo, hi):
+        # Decode a block of records per call into struct, not one at a time
+        for block_lo in range(lo, hi, BINARY_BLOCK):
+            block_hi = min(hi, block_lo + BINARY_BLOCK)
+            offset = BINARY_HEADER.size + block_lo * BINARY_RECORD.size
+            for record in unpack_records(buffer_, offset, block_hi - block_lo):
+                yield record
+
+
+class BinaryStorage(Storage):
+    """ Append-only, fixed-width binary storage, read through ``mmap``.
+
+    Each record is :data:`BINARY_RECORD` (five float64 values and a flags
+    byte, 41 bytes) instead of a JSON object, and is decoded into a
+    :class:`Record` only when read.  Records are kept sorted by ``start`` (and
+    unique, like :class:`SQLiteStorage`), so a new SpeedTest is a single
+    append and records already stored are skipped; only a new record older than
+    the last one (e.g. from an import) makes the file be rewritten, in which
+    case :meth:`iter_since` may repeat records.
+    """
+    name = 'binary'
+    unique = True
+
+    def __init__(self, binary_log_filepath, json_log_filepath=None,
+                 csv_log_filepath=None):
+        super(BinaryStorage, self).__init__()
+        self.binary_log_filepath = binary_log_filepath
+        self.reader = BinaryLogReader(binary_log_filepath)
+        self._migrate(json_log_filepath, csv_log_filepath)
+        self._repair()
+
+    def _migrate(self, json_log_filepath, csv_log_filepath):
+        """ One-time import of the legacy log, if there is no binary log. """
+        if os.path.exists(self.binary_log_filepath):
+            return
+        record_list, source = read_legacy_log(json_log_filepath,
+                                              csv_log_filepath)
+        if source is None:
+            return
+        self._write(record_list)
+        args = (len(record_list), source, self.binary_log_filepath, )
+        print('Migrated %d records from %s to %s' % args)
+
+    def _repair(self):
+        """ Check the header and drop a partial last record (e.g. from a crash). """
+        try:
+            size = os.path.getsize(self.binary_log_filepath)
+        except OSError:
+            return
+        with open(self.binary_log_filepath, 'r+b') as binary_log:
+            if size < BINARY_HEADER.size:
+                # Not even a complete header, so there cannot be any records
+                binary_log.truncate(0)
+                binary_log.write(self._header())
+                return
+            magic, version, record_size = BINARY_HEADER.unpack(
+                binary_log.read(BINARY_HEADER.size))
+            if magic != BINARY_MAGIC or record_size != BINARY_RECORD.size:
+                message = '%s is not an Intercheck binary log (version %d)'
+                raise IOError(message % (self.binary_log_filepath, BINARY_VERSION, ))
+            partial = (size - BINARY_HEADER.size) % BINARY_RECORD.size
+            if partial > 0:
+                binary_log.truncate(size - partial)
+
+    def _header(self):
+        return BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, BINARY_RECORD.size)
+
+    def _rewrite(self, record_list):
+        temp_filepath = '%s.tmp' % (self.binary_log_filepath, )
+        with open(temp_filepath, 'wb') as binary_log:
+            binary_log.write(self._header())
+            for record in record_list:
+                binary_log.write(pack_record(record))
+        os.rename(temp_filepath, self.binary_log_filepath)
+
+    def _write(self, record_list):
+        record_list = [ record for record in record_list
+                        if record.get('start', None) is not None ]
+        record_list.sort(key=lambda record: record['start'])
+        buffer_, count = self.reader.mapping()
+        last = None if count == 0 else self.reader.start_at(buffer_, count - 1)
+        # Skip the starts already stored or repeated in the batch (e.g. a fleet
+        # push sent again, or an import), so that they never cause a rewrite
+        accepted_list = []
+        previous = None
+        for record in record_list:
+            start = record['start']
+            if start == previous:
+                continue
+            previous = start
+            if last is not None and start <= last:
+                index = self.reader.bisect(buffer_, count, start)
+                if index < count and self.reader.start_at(buffer_, index) == start:
+                    continue
+            accepted_list.append(record)
+        if len(accepted_list) == 0:
+            return accepted_list
+        if last is None or accepted_list[0]['start'] > last:
+            # In order, append
+            exists = os.path.exists(self.binary_log_filepath)
+            with open(self.binary_log_filepath, 'ab') as binary_log:
+                if not exists:
+                    binary_log.write(self._header())
+                data = b''.join(pack_record(record) for record in accepted_list)
+                binary_log.write(data)
+            return accepted_list
+        # A new record before the last one, merge into a new file
+        merged_dict = {}
+        for record in self.reader.iter_slice(buffer_, 0, count):
+            merged_dict[record['start']] = record
+        for record in accepted_list:
+            merged_dict[record['start']] = record
+        self._rewrite([ merged_dict[start] for start in sorted(merged_dict) ])
+        return accepted_list
+
+    @metrics.time_storage
+    def iter_records(self, start=None, end=None):
+        buffer_, lo, hi = self.reader.slice(start=start, end=end)
+        for record in self.reader.iter_slice(buffer_, lo, hi):
+            yield record
+
+    @metrics.time_storage
+    def iter_since(self, sequence=None):
+        # Records are appended in order, so the position is the sequence
+        sequence = 0 if sequence is None else sequence
+        buffer_, count = self.reader.mapping()
+        for index, record in enumerate(self.reader.iter_slice(buffer_, sequence, count)):
+            yield sequence + index + 1, record
+
+    def sequence(self):
+        buffer_, count = self.reader.mapping()
+        return count
+
+    @metrics.time_storage
+    def count(self, start=None, end=None):
+        buffer_, lo, hi = self.reader.slice(start=start, end=end)
+        return hi - lo
+
+
+SEGMENT_PERIOD_LIST = ['day', 'week', 'month']
+
+
+def segment_begin(start, period='month'):
+    """ Return the (UTC) start of the segment of ``period`` holding ``start``. """
+    day = int(start // (60 * 60 * 24)) * 60 * 60 * 24
+    if period == 'day':
+        return day
+    if period == 'week':
+        # The epoch was a Thursday, segments start on Mondays
+        return day - ((day // (60 * 60 * 24) + 3) % 7) * 60 * 60 * 24
+    if period == 'month':
+        year, month = time.gmtime(start)[:2]
+        return calendar.timegm((year, month, 1, 0, 0, 0))
+    raise ValueError('Unknown segment period %r' % (period, ))
+
+
+def segment_end(begin, period='month'):
+    if period == 'day':
+        return begin + 60 * 60 * 24
+    if period == 'week':
+        return begin + 60 * 60 * 24 * 7
+    if period == 'month':
+        year, month = time.gmtime(begin)[:2]
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return calendar.timegm((year, month, 1, 0, 0, 0))
+    raise ValueError('Unknown segment period %r' % (period, ))
+
+
+def gzip_count(gzip_filepath):
+    """ Return the number of records in a gzipped binary log, without reading it.
+
+    The last four bytes of a gzip file are the uncompressed size (modulo 4 GiB),
+    and the records have a fixed width.
+    """
+    with open(gzip_filepath, 'rb') as gzip_file:
+        gzip_file.seek(-4, os.SEEK_END)
+        size = struct.unpack('<I', gzip_file.read(4))[0]
+    return max(0, size - BINARY_HEADER.size) // BINARY_RECORD.size
+
+
+class SegmentedStorage(Storage):
+    """ Time-partitioned storage, one binary log (:class:`BinaryStorage`) per
+    ``period`` (a day, week or month, in UTC).
+
+    Queries only open the segments that overlap the requested range, so the
+    hot path never touches old history.  Segments that ended more than
+    ``archive_days`` ago are gzipped (and are only decompressed, streaming, for
+    the queries that need them, e.g. full exports); segments that ended more
+    than ``expire_days`` ago are deleted.  Either is disabled if 0 or None.
+
+    The sequence counts every record ever stored, including expired ones, and
+    (like :class:`BinaryStorage`) follows the order of the segments, so
+    :meth:`iter_since` may repeat records after an out-of-order write.
+    """
+    name = 'segmented'
+    unique = True
+
+    def __init__(self, segment_path, json_log_filepath=None,
+                 csv_log_filepath=None, period='month', archive_days=90,
+                 expire_days=None):
+        super(SegmentedStorage, self).__init__()
+        if period not in SEGMENT_PERIOD_LIST:
+            raise ValueError('Unknown segment period %r' % (period, ))
+        self.segment_path = segment_path
+        self.period = period
+        self.archive_days = archive_days
+        self.expire_days = expire_days
+        self.index_filepath = os.path.join(segment_path, 'index.json')
+        self.segment_lock = threading.RLock()
+        self.hot_dict = {}
+        self.archive_dict = {}
+        self.expired = 0
+        self.retention_time = None
+        if not os.path.exists(segment_path):
+            os.makedirs(segment_path)
+        self._scan()
+        self._migrate(json_log_filepath, csv_log_filepath)
+        self.apply_retention()
+
+    def _scan(self):
+        try:
+            with open(self.index_filepath, 'r') as index_file:
+                index_dict = simplejson.load(index_file)
+            self.expired = index_dict.get('expired', 0)
+        except (IOError, ValueError):
+            self.expired = 0
+        for filename in sorted(os.listdir(self.segment_path)):
+            part_list = filename.split('.')
+            if len(part_list) < 3 or part_list[0] != 'log' or not part_list[1].isdigit():
+                continue
+            begin = calendar.timegm(time.strptime(part_list[1], '%Y%m%d'))
+            filepath = os.path.join(self.segment_path, filename)
+            if part_list[2:] == ['bin']:
+                self.hot_dict[begin] = BinaryStorage(filepath)
+            elif part_list[2:] == ['bin', 'gz']:
+                self.archive_dict[begin] = (filepath, gzip_count(filepath), )
+
+    def _save_index(self):
+        temp_filepath = '%s.tmp' % (self.index_filepath, )
+        with open(temp_filepath, 'w') as index_file:
+            simplejson.dump({'expired': self.expired}, index_file)
+        os.rename(temp_filepath, self.index_filepath)
+
+    def _migrate(self, json_log_filepath, csv_log_filepath):
+        """ One-time import of the legacy log, if there are no segments. """
+        if len(self.hot_dict) > 0 or len(self.archive_dict) > 0 or self.expired > 0:
+            return
+        record_list, source = read_legacy_log(json_log_filepath,
+                                              csv_log_filepath)
+        if source is None:
+            return
+        self._write(record_list)
+        args = (len(record_list), source, self.segment_path, )
+        print('Migrated %d records from %s to %s' % args)
+
+    def _segment_filepath(self, begin):
+        date = time.strftime('%Y%m%d', time.gmtime(begin))
+        return os.path.join(self.segment_path, 'log.%s.bin' % (date, ))
+
+    def _unarchive(self, begin):
+        gzip_filepath, count = self.archive_dict.pop(begin)
+        segment_filepath = self._segment_filepath(begin)
+        temp_filepath = '%s.tmp' % (segment_filepath, )
+        with gzip.open(gzip_filepath, 'rb') as gzip_file:
+            with open(temp_filepath, 'wb') as segment_file:
+                shutil.copyfileobj(gzip_file, segment_file)
+        os.rename(temp_filepath, segment_filepath)
+        os.remove(gzip_filepath)
+        self.hot_dict[begin] = BinaryStorage(segment_filepath)
+
+    def _archive(self, begin):
+        segment = self.hot_dict.pop(begin)
+        count = segment.sequence()
+        gzip_filepath = '%s.gz' % (segment.binary_log_filepath, )
+        temp_filepath = '%s.tmp' % (gzip_filepath, )
+        with open(segment.binary_log_filepath, 'rb') as segment_file:
+            with gzip.open(temp_filepath, 'wb') as gzip_file:
+                shutil.copyfileobj(segment_file, gzip_file)
+        os.rename(temp_filepath, gzip_filepath)
+        os.remove(segment.binary_log_filepath)
+        self.archive_dict[begin] = (gzip_filepath, count, )
+
+    def _expire(self, begin):
+        if begin in self.hot_dict:
+            segment = self.hot_dict.pop(begin)
+            self.expired += segment.sequence()
+            os.remove(segment.binary_log_filepath)
+        else:
+            gzip_filepath, count = self.archive_dict.pop(begin)
+            self.expired += count
+            os.remove(gzip_filepath)
+        self._save_index()
+
+    def apply_retention(self, now=None):
+        """ Archive and expire the segments that ended long enough ago. """
+        now = time.time() if now is None else now
+        with self.segment_lock:
+            self.retention_time = now
+            begin_list = sorted(set(self.hot_dict) | set(self.archive_dict))
+            for begin in begin_list:
+                end = segment_end(begin, self.period)
+                if self.expire_days and end < now - self.expire_days * 60 * 60 * 24:
+                    self._expire(begin)
+                    print('Expired log segment %s' % (self._segment_filepath(begin), ))
+                elif self.archive_days and begin in self.hot_dict:
+                    if end < now - self.archive_days * 60 * 60 * 24:
+                        print('Archiving log segment %s' % (self._segment_filepath(begin), ))
+                        self._archive(begin)
+
+    def _write(self, record_list):
+        group_dict = {}
+        for record in record_list:
+            if record.get('start', None) is None:
+                continue
+            begin = segment_begin(record['start'], self.period)
+            group_dict.setdefault(begin, []).append(record)
+        accepted_list = []
+        with self.segment_lock:
+            for begin in sorted(group_dict):
+                if begin in self.archive_dict:
+                    self._unarchive(begin)
+                if begin not in self.hot_dict:
+                    segment_filepath = self._segment_filepath(begin)
+                    self.hot_dict[begin] = BinaryStorage(segment_filepath)
+                accepted_list += self.hot_dict[begin]._write(group_dict[begin])
+        # Check the retention at most once an hour
+        if self.retention_time is None or time.time() - self.retention_time > 60 * 60:
+            self.apply_retention()
+        return accepted_list
+
+    def _segments(self, start=None, end=None):
+        """ Return ``(begin, segment, count)`` in order, ``segment`` is None if archived. """
+        with self.segment_lock:
+            segment_list = [ (begin, segment, None, )
+                             for begin, segment in self.hot_dict.items() ]
+            segment_list += [ (begin, None, gzip_filepath_count, )
+                              for begin, gzip_filepath_count in self.archive_dict.items() ]
+        segment_list.sort(key=lambda segment_: segment_[0])
+        if start is not None:
+            segment_list = [ segment_ for segment_ in segment_list
+                             if segment_end(segment_[0], self.period) > start ]
+        if end is not None:
+            segment_list = [ segment_ for segment_ in segment_list
+                             if segment_[0] < end ]
+        return segment_list
+
+    def _iter_archive(self, gzip_filepath, start=None, end=None):
+        with gzip.open(gzip_filepath, 'rb') as gzip_file:
+            for record in iter_binary_file(gzip_file):
+                if start is not None and record['start'] < start:
+                    continue
+                if end is not None and record['start'] >= end:
+                    break
+                yield record
+
+    def _count(self, segment, archive):
+        if segment is None:
+            return archive[1]
+        buffer_, count = segment.reader.mapping()
+        return count
+
+    # The segments are read through their reader, so they are not timed twice
+    @metrics.time_storage
+    def iter_records(self, start=None, end=None):
+        for begin, segment, archive in self._segments(start, end):
+            if segment is None:
+                record_iter = self._iter_archive(archive[0], start=start, end=end)
+            else:
+                buffer_, lo, hi = segment.reader.slice(start=start, end=end)
+                record_iter = segment.reader.iter_slice(buffer_, lo, hi)
+            for record in record_iter:
+                yield record
+
+    @metrics.time_storage
+    def iter_since(self, sequence=None):
+        # The segments are concatenated in order, after the expired records
+        sequence = 0 if sequence is None else sequence
+        offset = self.expired
+        for begin, segment, archive in self._segments():
+            count = self._count(segment, archive)
+            skip = max(0, sequence - offset)
+            if skip < count:
+                if segment is None:
+                    record_iter = itertools.islice(self._iter_archive(archive[0]),
+                                                   skip, None)
+                else:
+                    buffer_, count = segment.reader.mapping()
+                    record_iter = segment.reader.iter_slice(buffer_, skip, count)
+                for index, record in enumerate(record_iter):
+                    yield offset + skip + index + 1, record
+            offset += count
+
+    def sequence(self):
+        sequence = self.expired
+        for begin, segment, archive in self._segments():
+            sequence += self._count(segment, archive)
+        return sequence
+
+    @metrics.time_storage
+    def count(self, start=None, end=None):
+        count = 0
+        for begin, segment, archive in self._segments(start, end):
+            if segment is None:
+                count += sum(1 for _ in self._iter_archive(archive[0], start, end))
+            else:
+                buffer_, lo, hi = segment.reader.slice(start=start, end=end)
+                count += hi - lo
+        return count
+
+
+class SQLiteStorage(Storage):
+    """ Indexed SQLite3 storage, one row per SpeedTest.
+
+    The database runs in write-ahead-log (WAL) mode so that the web server can
+    keep reading while the background thread appends a new SpeedTest, and each
+    write is a single committed ``INSERT`` instead of a rewrite of the history.
+    Connections are kept per-thread, as required by :mod:`sqlite3`.  The
+    rollups are stored in one table per resolution and updated in the same
+    transaction as the record.
+    """
+    name = 'sqlite'
+    unique = True
+
+    def __init__(self, sqlite_log_filepath, json_log_filepath=None,
+                 csv_log_filepath=None):
+        super(SQLiteStorage, self).__init__()
+        self.sqlite_log_filepath = sqlite_log_filepath
+        self.local = threading.local()
+        self._setup()
+        self._migrate(json_log_filepath, csv_log_filepath)
+        self._backfill_rollups()
+
+    def _connect(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.sqlite_log_filepath)
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def _setup(self):
+        connection = self._connect()
+        connection.execute('PRAGMA journal_mode=WAL')
+        with connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS log ('
+                '    id       INTEGER PRIMARY KEY,'
+                '    start    REAL NOT NULL,'
+                '    duration REAL,'
+                '    ping     REAL,'
+                '    download REAL,'
+                '    upload   REAL'
+                ')'
+            )
+            connection.execute(
+                'CREATE UNIQUE INDEX IF NOT EXISTS log_start ON log (start)'
+            )
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS meta ('
+                '    key   TEXT PRIMARY KEY,'
+                '    value TEXT'
+                ')'
+            )
+            column_list = []
+            for key in METRIC_LIST:
+                column_list += [
+                    '%s_count INTEGER NOT NULL DEFAULT 0' % (key, ),
+                    '%s_sum REAL NOT NULL DEFAULT 0.0' % (key, ),
+                    '%s_min REAL' % (key, ),
+                    '%s_max REAL' % (key, ),
+                ]
+            for resolution in RESOLUTION_LIST:
+                connection.execute(
+                    'CREATE TABLE IF NOT EXISTS rollup_%s ('
+                    '    start INTEGER PRIMARY KEY,'
+                    '    count INTEGER NOT NULL DEFAULT 0,'
+                    '    %s'
+                    ')' % (resolution, ', '.join(column_list), )
+                )
+
+    def _get_meta(self, key, default=None):
+        connection = self._connect()
+        cursor = connection.execute('SELECT value FROM meta WHERE key = ?',
+                                    (key, ))
+        row = cursor.fetchone()
+        return default if row is None else row[0]
+
+    def _migrate(self, json_log_filepath, csv_log_filepath):
+        """ One-time import of the legacy JSON (or, failing that, CSV) log. """
+        if self._get_meta('migrated') is not None:
+            return
+        record_list, source = read_legacy_log(json_log_filepath,
+                                              csv_log_filepath)
+        connection = self._connect()
+        with self.lock, connection:
+            self._insert(connection, record_list)
+            connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                               ('migrated', source or '', ))
+        if source is not None:
+            args = (len(record_list), source, self.sqlite_log_filepath, )
+            print('Migrated %d records from %s to %s' % args)
+
+    def _insert(self, connection, record_list):
+        row_list = [
+            tuple(record.get(key, None) for key in KEY_LIST)
+            for record in record_list
+            if record.get('start', None) is not None
+        ]
+        connection.executemany(
+            'INSERT OR IGNORE INTO log (%s) VALUES (?, ?, ?, ?, ?)' % (
+                ', '.join(KEY_LIST), ),
+            row_list
+        )
+
+    def _backfill_rollups(self):
+        """ Build the rollup tables from the log, once, with ``GROUP BY``. """
+        if self._get_meta('rollups') is not None:
+            return
+        select_list = []
+        for key in METRIC_LIST:
+            select_list += [
+                'COUNT(%s)' % (key, ),
+                'TOTAL(%s)' % (key, ),
+                'MIN(%s)' % (key, ),
+                'MAX(%s)' % (key, ),
+            ]
+        connection = self._connect()
+        with self.lock, connection:
+            for resolution in RESOLUTION_LIST:
+                seconds = RESOLUTION_DICT[resolution]
+                bucket = 'CAST(start / %d AS INTEGER) * %d' % (seconds, seconds, )
+                connection.execute('DELETE FROM rollup_%s' % (resolution, ))
+                connection.execute(
+                    'INSERT INTO rollup_%s SELECT %s, COUNT(*), %s FROM log '
+                    'GROUP BY 1' % (resolution, bucket, ', '.join(select_list), )
+                )
+            connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                               ('rollups', '1', ))
+
+    def _update_rollups(self, connection, record):
+        for resolution in RESOLUTION_LIST:
+            seconds = RESOLUTION_DICT[resolution]
+            bucket = int(record['start'] // seconds) * seconds
+            cursor = connection.execute(
+                'SELECT * FROM rollup_%s WHERE start = ?' % (resolution, ),
+                (bucket, )
+            )
+            row = cursor.fetchone()
+            if row is None:
+                rollup = new_rollup(bucket)
+            else:
+                column_list = [ column[0] for column in cursor.description ]
+                rollup = dict(zip(column_list, row))
+            update_rollup(rollup, record)
+            column_list = sorted(rollup.keys())
+            connection.execute(
+                'INSERT OR REPLACE INTO rollup_%s (%s) VALUES (%s)' % (
+                    resolution, ', '.join(column_list),
+                    ', '.join(['?'] * len(column_list)), ),
+                [ rollup[column] for column in column_list ]
+            )
+
+    @metrics.time_storage
+    def write_many(self, record_list):
+        connection = self._connect()
+        with self.lock, connection:
+            for record in record_list:
+                if record.get('start', None) is None:
+                    continue
+                cursor = connection.execute(
+                    'INSERT OR IGNORE INTO log (%s) VALUES (?, ?, ?, ?, ?)' % (
+                        ', '.join(KEY_LIST), ),
+                    tuple(record.get(key, None) for key in KEY_LIST)
+                )
+                if cursor.rowcount > 0:
+                    self._update_rollups(connection, record)
+
+    @metrics.time_storage
+    def iter_rollups(self, resolution, start=None, end=None):
+        if start is not None:
+            seconds = RESOLUTION_DICT[resolution]
+            start = int(start // seconds) * seconds
+        where, arg_list = build_where(start, end)
+        query = 'SELECT * FROM rollup_%s%s ORDER BY start' % (resolution, where, )
+        connection = self._connect()
+        cursor = connection.execute(query, arg_list)
+        column_list = [ column[0] for column in cursor.description ]
+        for row in cursor:
+            yield finalize_rollup(dict(zip(column_list, row)))
+
+    @metrics.time_storage
+    def iter_records(self, start=None, end=None):
+        where, arg_list = build_where(start, end)
+        query = 'SELECT %s FROM log%s ORDER BY start' % (', '.join(KEY_LIST),
+                                                         where, )
+        connection = self._connect()
+        for row in connection.execute(query, arg_list):
+            yield dict(zip(KEY_LIST, row))
+
+    @metrics.time_storage
+    def iter_since(self, sequence=None):
+        sequence = 0 if sequence is None else sequence
+        query = 'SELECT id, %s FROM log WHERE id > ? ORDER BY id' % (
+            ', '.join(KEY_LIST), )
+        connection = self._connect()
+        for row in connection.execute(query, (sequence, )):
+            yield row[0], dict(zip(KEY_LIST, row[1:]))
+
+    def sequence(self):
+        connection = self._connect()
+        row = connection.execute('SELECT MAX(id) FROM log').fetchone()
+        return 0 if row[0] is None else row[0]
+
+    @metrics.time_storage
+    def count(self, start=None, end=None):
+        where, arg_list = build_where(start, end)
+        query = 'SELECT COUNT(*) FROM log%s' % (where, )
+        connection = self._connect()
+        return connection.execute(query, arg_list).fetchone()[0]
+
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+
+STORAGE_BACKENDS = {
+    BinaryStorage.name    : BinaryStorage,
+    JSONStorage.name      : JSONStorage,
+    JSONLinesStorage.name : JSONLinesStorage,
+    SegmentedStorage.name : SegmentedStorage,
+    SQLiteStorage.name    : SQLiteStorage,
+}
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+"""
+Intercheck measurement targets
+
+A gateway with several uplinks can measure each of them.  A target is a named
+SpeedTest with its own source (a network interface, or a local IP address, to
+bind to), speedtest.net server and interval, written as::
+
+    name[,source=<interface or IP>][,server=<id>][,interval=<seconds>]
+
+e.g. ``--target wan1,source=eth0 --target wan2,source=eth1,server=1234``.  Each
+target keeps its own log in ``~/.intercheck/targets/<name>/`` (see
+:func:`intercheck.utils.get_internal_path`), its own schedule and its own
+status; ``/summary/``, ``/points/``, ``/outages/`` and ``/status/`` report one
+target with ``?target=<name>``.
+
+The SpeedTests of all targets run in a pool of worker processes
+(:class:`MeasurementPool`), at most ``target_concurrency`` at a time: 1
+serialises targets that share a bottleneck, more measure independent links in
+parallel.  Binding to a source address never affects the web server, and a
+SpeedTest stuck for longer than the timeout is killed with its worker, which is
+replaced, so the other targets keep being measured.
+"""
+from __future__ import absolute_import, division, print_function
+# Python built-in
+import multiprocessing
+import logging
+import Queue
+import socket
+import struct
+import signal
+import fcntl
+import re
+
+
+# Configure the logger
+print = logging.warning
+
+
+POOL = None
+
+
+NAME_PATTERN = re.compile(r'^[A-Za-z0-9_][A-Za-z0-9_.-]{0,63}$')
+KEY_LIST = ['source', 'server', 'interval']
+
+
+# ioctl request for the IPv4 address of an interface (see netdevice(7))
+SIOCGIFADDR = 0x8915
+
+
+def check_target(name):
+    """ Raise ValueError unless ``name`` is a valid target name.
+
+    Target names are used as directory names, so they are limited to letters,
+    digits, ``_``, ``.`` and ``-`` and cannot start with a dot.
+    """
+    if not isinstance(name, basestring) or NAME_PATTERN.match(name) is None:
+        raise ValueError('Invalid target name %r' % (name, ))
+    return name
+
+
+def parse_target(target):
+    """ Return the target dictionary (``name``, ``source``, ``server`` and
+    ``interval``) of a target string, see the module documentation.
+    """
+    part_list = [ part.strip() for part in target.split(',') ]
+    target_dict = { key : None for key in KEY_LIST }
+    target_dict['name'] = check_target(part_list[0])
+    for part in part_list[1:]:
+        key, _, value = part.partition('=')
+        if key not in KEY_LIST or len(value) == 0:
+            raise ValueError('Invalid option %r of target %r' % (part, target, ))
+        target_dict[key] = value
+    try:
+        if target_dict['server'] is not None:
+            target_dict['server'] = int(target_dict['server'])
+        if target_dict['interval'] is not None:
+            target_dict['interval'] = int(target_dict['interval'])
+    except ValueError:
+        raise ValueError('Invalid server or interval of target %r' % (target, ))
+    return target_dict
+
+
+def parse_targets(target_list):
+    """ Parse every target string, raises ValueError for duplicate names. """
+    target_dict_list = [ parse_target(target) for target in target_list ]
+    name_list = [ target_dict['name'] for target_dict in target_dict_list ]
+    if len(set(name_list)) != len(name_list):
+        raise ValueError('Duplicate target names in %r' % (target_list, ))
+    return target_dict_list
+
+
+def interface_address(interface):
+    """ Return the IPv4 address of a network interface (Linux only). """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        request = struct.pack('256s', interface[:15].encode('utf-8'))
+        response = fcntl.ioctl(sock.fileno(), SIOCGIFADDR, request)
+    except IOError:
+        raise ValueError('Interface %r has no IPv4 address' % (interface, ))
+    finally:
+        sock.close()
+    return socket.inet_ntoa(response[20:24])
+
+
+def source_address(source):
+    """ Return the local address to bind to for ``source`` (an IP or interface).
+
+    Interfaces are resolved on every SpeedTest, as their address may change.
+    """
+    if source is None:
+        return None
+    try:
+        socket.inet_aton(source)
+        return source
+    except socket.error:
+        return interface_address(source)
+
+
+def init_worker():
+    # Ctrl-C stops Intercheck, which stops the pool
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def worker_loop(connection, parent_connection):
+    """ Call the ``(func, args)`` received on ``connection`` and send back
+    ``(True, result)`` or ``(False, exception)``, until it is closed.
+    """
+    # Otherwise, the connection would never be closed when Intercheck exits
+    parent_connection.close()
+    init_worker()
+    while True:
+        try:
+            func, args = connection.recv()
+        except (EOFError, IOError):
+            return
+        try:
+            response = (True, func(*args), )
+        except Exception as error:
+            response = (False, error, )
+        try:
+            connection.send(response)
+        except Exception:
+            # e.g. an exception that cannot be pickled
+            connection.send((False, RuntimeError(repr(response[1])), ))
+
+
+class Worker(object):
+    """ A worker process of the :class:`MeasurementPool`.
+
+    Workers live as long as they do not time out, so the SpeedTest engines they
+    keep (see :func:`intercheck.engine.get_engine`) are reused between runs.
+    """
+    def __init__(self):
+        self.connection, child_connection = multiprocessing.Pipe()
+        args = (child_connection, self.connection, )
+        self.process = multiprocessing.Process(target=worker_loop, args=args)
+        self.process.daemon = True
+        self.process.start()
+        child_connection.close()
+
+    def stop(self):
+        self.connection.close()
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+
+
+class MeasurementPool(object):
+    """ Run SpeedTests in worker processes, at most ``concurrency`` at a time.
+
+    Unlike ``multiprocessing.Pool``, a task that times out is stopped: its
+    worker is killed and replaced.
+
+    Args:
+        concurrency (int): the number of worker processes
+        timeout (float): seconds before a SpeedTest is given up on
+    """
+    def __init__(self, concurrency=1, timeout=60 * 10):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.idle_queue = Queue.Queue()
+        for index in range(concurrency):
+            self.idle_queue.put(Worker())
+
+    def run(self, func, *args):
+        """ Return ``func(*args)``, called in a worker process.
+
+        ``func`` must be a module-level function.  Waits for an idle worker, and
+        raises any exception raised by ``func``, or
+        ``multiprocessing.TimeoutError``.
+        """
+        worker = self.idle_queue.get()
+        try:
+            worker.connection.send((func, args, ))
+            if not worker.connection.poll(self.timeout):
+                worker.stop()
+                worker = Worker()
+                message = 'Killed a SpeedTest running for over %d sec.'
+                raise multiprocessing.TimeoutError(message % (self.timeout, ))
+            success, result = worker.connection.recv()
+        except (EOFError, IOError):
+            # The worker died (e.g. killed by the OOM killer)
+            worker.stop()
+            worker = Worker()
+            raise RuntimeError('The SpeedTest worker process died')
+        finally:
+            self.idle_queue.put(worker)
+        if not success:
+            raise result
+        return result
+
+    def stop(self):
+        for index in range(self.concurrency):
+            self.idle_queue.get().stop()
+
+
+def get_pool():
+    """ Return the running :class:`MeasurementPool`, or None. """
+    return POOL
+
+
+def start_pool(concurrency):
+    global POOL
+    if POOL is not None:
+        print('Cannot start the measurement pool, already running')
+        return POOL
+    POOL = MeasurementPool(concurrency=max(1, concurrency))
+    print('Measuring targets in %d process(es)' % (POOL.concurrency, ))
+    return POOL
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+"""
+Intercheck bulk import and export
+
+``intercheck import <file>...`` and ``intercheck export <file>`` move SpeedTest
+records between files and the storage engine, one record at a time, so memory
+use does not depend on the size of the log.  Files are CSV (with a header row),
+JSON (the ``{"log": [...]}`` format of ``/download/log.json``, or a bare list)
+or JSON Lines, chosen by the extension (``.csv``, ``.json``, ``.jsonl``) or
+``--format``, optionally gzipped (``.gz``); ``-`` is standard input or output.
+
+Imports skip the records whose ``start`` is already stored, so the same file
+(or two overlapping logs) can be imported again safely.  Converting between
+formats is an import followed by an export.
+"""
+from __future__ import absolute_import, division, print_function
+# Intercheck
+from . import storage
+# Python built-in
+import simplejson
+import logging
+import gzip
+import time
+import csv
+import sys
+import os
+
+
+# Configure the logger
+print = logging.warning
+
+
+FORMAT_LIST = ['csv', 'json', 'jsonl']
+EXTENSION_DICT = {
+    '.csv'    : 'csv',
+    '.json'   : 'json',
+    '.jsonl'  : 'jsonl',
+    '.ndjson' : 'jsonl',
+}
+READ_SIZE = 1024 * 1024
+BATCH_SIZE = 10000
+PROGRESS_INTERVAL = 1000000
+
+
+def parse_time(value):
+    """ Parse a UNIX timestamp or a local ``YYYY-MM-DD[THH:MM[:SS]]`` date. """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for format_ in ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d %H:%M:%S',
+                    '%Y-%m-%d %H:%M', '%Y-%m-%d']:
+        try:
+            return time.mktime(time.strptime(value, format_))
+        except ValueError:
+            continue
+    raise ValueError('Cannot parse %r as a time (a timestamp or YYYY-MM-DD)' % (value, ))
+
+
+def get_format(filepath, format_=None):
+    """ Return ``(format, compressed)`` for a file, by its extension. """
+    compressed = filepath.endswith('.gz')
+    if compressed:
+        filepath = filepath[:-len('.gz')]
+    if format_ is None:
+        format_ = EXTENSION_DICT.get(os.path.splitext(filepath)[1].lower(), None)
+    if format_ not in FORMAT_LIST:
+        raise ValueError('Unknown format of %r, specify it with --format' % (filepath, ))
+    return format_, compressed
+
+
+def open_file(filepath, mode, compressed=False):
+    if filepath == '-':
+        return sys.stdin if 'r' in mode else sys.stdout
+    if compressed:
+        return gzip.open(filepath, mode)
+    return open(filepath, mode)
+
+
+def to_record(record, key_list=storage.KEY_LIST):
+    return { key : record.get(key, None) for key in key_list }
+
+
+def iter_csv_file(csv_file):
+    """ Yield the records of a CSV file, the first row names the columns. """
+    reader = csv.reader(csv_file)
+    header = next(reader, None)
+    if header is None:
+        return
+    header = [ key.strip() for key in header ]
+    for line in reader:
+        if len(line) != len(header):
+            continue
+        record = {}
+        for key, value in zip(header, line):
+            record[key] = None if value == '' else float(value)
+        yield record
+
+
+def iter_json_file(json_file, read_size=READ_SIZE):
+    """ Yield the objects of the first JSON list in a file, without reading the
+    whole file: each object is decoded as soon as it is complete.
+    """
+    decoder = simplejson.JSONDecoder()
+    buffer_ = ''
+    index = 0
+    eof = False
+
+    def fill(buffer_, index):
+        data = json_file.read(read_size)
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return buffer_[index:] + data, 0, len(data) == 0
+
+    # Find the list (e.g. the "log" of {"log": [...]})
+    while True:
+        position = buffer_.find('[', index)
+        if position >= 0:
+            index = position + 1
+            break
+        buffer_, index, eof = fill(buffer_, len(buffer_))
+        if eof:
+            return
+    while True:
+        # Skip the separators
+        while index < len(buffer_) and buffer_[index] in ' \t\r\n,':
+            index += 1
+        if index >= len(buffer_):
+            if eof:
+                raise ValueError('Unexpected end of the JSON file')
+            buffer_, index, eof = fill(buffer_, index)
+            continue
+        if buffer_[index] == ']':
+            return
+        try:
+            value, index_ = decoder.raw_decode(buffer_, index)
+        except ValueError:
+            # Most likely an object split across two reads
+            if eof or len(buffer_) - index > read_size * 4:
+                raise
+            buffer_, index, eof = fill(buffer_, index)
+            continue
+        index = index_
+        yield value
+
+
+def iter_jsonl_file(jsonl_file):
+    """ Yield the records of a JSON Lines file, skipping blank lines. """
+    for line in jsonl_file:
+        line = line.strip()
+        if line:
+            yield simplejson.loads(line)
+
+
+READER_DICT = {
+    'csv'   : iter_csv_file,
+    'json'  : iter_json_file,
+    'jsonl' : iter_jsonl_file,
+}
+
+
+def iter_file(filepath, format_=None):
+    """ Yield the records of a file, see :data:`READER_DICT`. """
+    format_, compressed = get_format(filepath, format_)
+    input_file = open_file(filepath, 'rb', compressed)
+    try:
+        for record in READER_DICT[format_](input_file):
+            yield to_record(record)
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+
+
+def import_records(storage_, record_iter, start=None, end=None,
+                   batch_size=BATCH_SIZE, on_progress=None):
+    """ Write the records of ``record_iter`` within ``[start, end)`` to storage.
+
+    Records whose ``start`` is already stored are skipped.  Engines that keep
+    ``start`` unique (:attr:`intercheck.storage.Storage.unique`) skip them on
+    their own; for the others, the stored starts are loaded once.
+    ``on_progress(read)`` is called every :data:`PROGRESS_INTERVAL` records.
+
+    Returns:
+        tuple: ``(read, written)``, the number of records read and written
+    """
+    seen = None
+    if not storage_.unique:
+        seen = set(record['start'] for record in storage_.iter_records())
+    count_before = storage_.count()
+    read = 0
+    progress = PROGRESS_INTERVAL
+    batch_list = []
+    for record in record_iter:
+        read += 1
+        record_start = record.get('start', None)
+        if record_start is None:
+            continue
+        if start is not None and record_start < start:
+            continue
+        if end is not None and record_start >= end:
+            continue
+        if seen is not None:
+            if record_start in seen:
+                continue
+            seen.add(record_start)
+        batch_list.append(record)
+        if len(batch_list) >= batch_size:
+            storage_.write_many(batch_list)
+            batch_list = []
+            if on_progress is not None and read >= progress:
+                on_progress(read)
+                progress += PROGRESS_INTERVAL
+    if len(batch_list) > 0:
+        storage_.write_many(batch_list)
+    return read, storage_.count() - count_before
+
+
+def export_records(storage_, filepath, format_=None, start=None, end=None):
+    """ Write the stored records within ``[start, end)`` to a file.
+
+    Returns:
+        int: the number of bytes written (before compression)
+    """
+    format_, compressed = get_format(filepath, format_)
+    iter_dict = {
+        'csv'   : storage_.iter_csv,
+        'json'  : storage_.iter_json,
+        'jsonl' : storage_.iter_jsonl,
+    }
+    size = 0
+    output_file = open_file(filepath, 'wb', compressed)
+    try:
+        for chunk in iter_dict[format_](start=start, end=end):
+            if not isinstance(chunk, bytes):
+                chunk = chunk.encode('utf-8')
+            output_file.write(chunk)
+            size += len(chunk)
+    finally:
+        if output_file is sys.stdout:
+            output_file.flush()
+        else:
+            output_file.close()
+    return size
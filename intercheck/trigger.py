@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""
+Intercheck wake-up trigger
+
+The scheduler waits until its next SpeedTest is due, unless it is forced to run
+early.  :class:`Trigger` is a self-pipe: :meth:`Trigger.set` writes a byte, and
+the IOLoop watches the pipe (see :meth:`Trigger.fileno_list` and
+:func:`intercheck.core.watch_force`), so the scheduler wakes up only when it is
+due or signalled.  On Linux, the trigger can
+also watch a file with inotify (see :meth:`Trigger.watch`), which keeps the
+``~/.intercheck/force`` file working for external scripts.
+"""
+from __future__ import absolute_import, division, print_function
+# Python built-in
+import threading
+import logging
+import select
+import errno
+import fcntl
+import time
+import os
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+
+# Configure the logger
+print = logging.warning
+
+
+# inotify event masks (see inotify(7))
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
+
+
+def load_inotify():
+    if ctypes is None:
+        return None
+    libc_name = ctypes.util.find_library('c')
+    if libc_name is None:
+        return None
+    try:
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+def drain(fd):
+    try:
+        while os.read(fd, 4096):
+            pass
+    except OSError as error:
+        if error.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+            raise
+
+
+class Trigger(object):
+    """ A wake-up signal that can be waited on without polling. """
+    def __init__(self):
+        self.read_fd, self.write_fd = os.pipe()
+        set_nonblocking(self.read_fd)
+        set_nonblocking(self.write_fd)
+        self.lock = threading.Lock()
+        self.watch_fd = None
+        self.watch_filepath = None
+
+    def set(self):
+        try:
+            os.write(self.write_fd, b'!')
+        except OSError as error:
+            # The pipe is full, so the trigger is already set
+            if error.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def clear(self):
+        drain(self.read_fd)
+
+    def fileno_list(self):
+        """ Return the file descriptors that become readable when the trigger is set. """
+        fd_list = [self.read_fd]
+        if self.watch_fd is not None:
+            fd_list.append(self.watch_fd)
+        return fd_list
+
+    def poll(self):
+        """ Return True (and clear the trigger) if it is set, without blocking. """
+        if self.watch_fd is not None:
+            drain(self.watch_fd)
+            self.check_watched()
+        if self.is_set():
+            self.clear()
+            return True
+        return False
+
+    def is_set(self):
+        readable, _, _ = select.select([self.read_fd], [], [], 0)
+        return len(readable) > 0
+
+    def watch(self, filepath):
+        """ Set the trigger whenever ``filepath`` is created (or touched).
+
+        The file is deleted once it has been noticed, like the original force
+        file.  Returns False if inotify is not available on this platform.
+        """
+        with self.lock:
+            if self.watch_filepath == filepath:
+                return True
+            libc = load_inotify()
+            if libc is None:
+                return False
+            watch_fd = libc.inotify_init1(IN_NONBLOCK)
+            if watch_fd < 0:
+                return False
+            path = os.path.dirname(filepath).encode('utf-8')
+            mask = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+            if libc.inotify_add_watch(watch_fd, path, mask) < 0:
+                os.close(watch_fd)
+                return False
+            if self.watch_fd is not None:
+                os.close(self.watch_fd)
+            self.watch_fd = watch_fd
+            self.watch_filepath = filepath
+        self.check_watched()
+        return True
+
+    def check_watched(self):
+        if self.watch_filepath is not None and os.path.exists(self.watch_filepath):
+            try:
+                os.remove(self.watch_filepath)
+            except OSError:
+                pass
+            self.set()
+
+    def wait(self, timeout=None):
+        """ Block until the trigger is set or ``timeout`` seconds pass.
+
+        Returns True (and clears the trigger) if it was set.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            fd_list = [self.read_fd]
+            if self.watch_fd is not None:
+                fd_list.append(self.watch_fd)
+            remaining = None
+            if deadline is not None:
+                remaining = max(0.0, deadline - time.time())
+            try:
+                readable, _, _ = select.select(fd_list, [], [], remaining)
+            except (select.error, OSError) as error:
+                if error.args[0] != errno.EINTR:
+                    raise
+                readable = []
+            if self.watch_fd is not None and self.watch_fd in readable:
+                # Something changed in the directory, check for the watched file
+                drain(self.watch_fd)
+                self.check_watched()
+            if self.is_set():
+                self.clear()
+                return True
+            if deadline is not None and time.time() >= deadline:
+                return False
@@ -1,12 +1,27 @@
 #!/usr/bin/env python
 from __future__ import absolute_import, division, print_function
-# HTTP / HTML
-import flask
+# Intercheck
+from . import columnar
+from . import config
+from . import downsample
+from . import fleet
+from . import metrics
+from . import outage
+from . import schedule
+from . import storage
+from . import targets
+from . import transfer
+from . import trigger
 # Python built-in
 import simplejson
+import threading
 import argparse
+import hashlib
 import logging
+import glob
 import time
+import zlib
+import sys
 import os
 
 
@@ -21,9 +36,68 @@ tagline = 'An automated SpeedTest logger and web interface for monitoring Intern
 
 
 DEFAULT_SETTINGS = {
-    'port'           : 5000,
-    'interval'       : 60 * 5,
-    'interval_exact' : True,
+    'port'               : 5000,
+    'interval'           : 60 * 5,
+    'interval_exact'     : True,
+    'storage'            : 'sqlite',
+    'workers'            : 4,
+    'probe_interval'     : 0,
+    'probe_targets'      : ['8.8.8.8:53', '1.1.1.1:53'],
+    'segment_period'     : 'month',
+    'archive_after'      : 90,
+    'expire_after'       : 0,
+    'aggregator'         : None,
+    'agent'              : None,
+    'fleet'              : False,
+    'fleet_token'        : None,
+    'headless'           : False,
+    'missed'             : 'once',
+    'targets'            : [],
+    'target_concurrency' : 1,
+    'vectorized'         : False,
+}
+
+
+COMMAND_LIST = ['export', 'import']
+
+
+POINTS_MAX_POINTS = 500
+POINTS_MAX_POINTS_LIMIT = 5000
+# Up to this many times max_points are read, then downsampled
+POINTS_OVERSAMPLE = 4
+
+
+STORAGE_DICT = {}
+
+
+OUTAGE_INDEX_DICT = {}
+
+
+SETTINGS_SERVICE_DICT = {}
+
+
+INTERNAL_PATH_DICT = {}
+
+
+EXPORT_LOCK = threading.Lock()
+
+
+# Encoded JSON responses, see cached_content
+RESPONSE_CACHE_DICT = {}
+RESPONSE_CACHE_SIZE = 256
+RESPONSE_CACHE_LOCK = threading.Lock()
+RESPONSE_GENERATION = 0
+
+
+FORCE_TRIGGER = trigger.Trigger()
+
+
+WRITE_LISTENER_LIST = []
+
+
+MIMETYPE_DICT = {
+    '.csv'  : 'text/csv',
+    '.json' : 'application/json',
 }
 
 
@@ -33,6 +107,29 @@ GLOBAL_DICT = {
 }
 
 
+class CachedContent(object):
+    """ The encoded content of one response, computed at most once. """
+    def __init__(self, generation, etag):
+        self.generation = generation
+        self.etag = etag
+        self.lock = threading.Lock()
+        self.content = None
+        self.content_gzip = None
+
+    def get(self, content_func, compress=False, route='unknown'):
+        with self.lock:
+            hit = self.content is not None
+            if not hit:
+                content = content_func()
+                if not isinstance(content, bytes):
+                    content = content.encode('utf-8')
+                self.content = content
+            if compress and self.content_gzip is None:
+                self.content_gzip = b''.join(iter_gzip([self.content]))
+        metrics.RESPONSE_CACHE_TOTAL.inc(route=route, result='hit' if hit else 'miss')
+        return self.content_gzip if compress else self.content
+
+
 class Timer:
     def __enter__(self):
         self.start = time.time()
@@ -43,18 +140,86 @@ class Timer:
         self.duration = self.end - self.start
 
 
+def accepts_gzip():
+    import flask
+    return 'gzip' in flask.request.accept_encodings
+
+
+def bump_generation():
+    """ Invalidate every cached response, see :func:`cached_content`. """
+    global RESPONSE_GENERATION
+    with RESPONSE_CACHE_LOCK:
+        RESPONSE_GENERATION += 1
+
+
+def cached_content(key, etag, content_func, compress=False):
+    """ Return the encoded ``content_func()`` for ``key``, computed once.
+
+    The content is cached until the generation is bumped (by a write or a
+    settings update, see :func:`bump_generation`) or ``etag`` changes (e.g. by
+    a write from another process), so concurrent requests between two
+    SpeedTests share one computation.  With ``compress``, the gzipped content
+    is cached as well.
+    """
+    import flask
+    with RESPONSE_CACHE_LOCK:
+        cached = RESPONSE_CACHE_DICT.get(key, None)
+        if cached is None or cached.generation != RESPONSE_GENERATION or cached.etag != etag:
+            if len(RESPONSE_CACHE_DICT) >= RESPONSE_CACHE_SIZE:
+                RESPONSE_CACHE_DICT.clear()
+            cached = CachedContent(RESPONSE_GENERATION, etag)
+            RESPONSE_CACHE_DICT[key] = cached
+    route = flask.request.environ.get('intercheck.route', 'unknown')
+    return cached.get(content_func, compress=compress, route=route)
+
+
 def check_force(autodelete=True, **kwargs):
     force_filepath = get_force_filepath(**kwargs)
-    if not os.path.exists(force_filepath):
+    if not FORCE_TRIGGER.is_set() and not os.path.exists(force_filepath):
         return False
     if autodelete:
         clear_force(**kwargs)
     return True
 
 
-def configure_argparser():
+def conditional_response(etag, content_func, cache=True):
+    """ Return a response for ``content_func()``, or 304 if the ETag matches.
+
+    The content is only computed when the client does not already have it, so
+    ``etag`` must change whenever the content would (e.g. by including the
+    storage sequence).  With ``cache``, it is also shared between clients (see
+    :func:`cached_content`), keyed by the route and its query arguments, and
+    gzipped for the clients that accept it.
+    """
+    import flask
+    etag = hashlib.md5(etag.encode('utf-8')).hexdigest()
+    compress = cache and accepts_gzip()
+    # Both encodings are cached together, but are different entities
+    response_etag = '%s-gzip' % (etag, ) if compress else etag
+    if flask.request.if_none_match.contains(response_etag):
+        response = flask.Response(status=304)
+    elif cache:
+        key = (flask.request.path, tuple(sorted(flask.request.args.items(multi=True))), )
+        content = cached_content(key, etag, content_func, compress=compress)
+        response = flask.Response(content, mimetype='application/json')
+        if compress:
+            response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = flask.make_response(content_func())
+    if cache:
+        response.headers['Vary'] = 'Accept-Encoding'
+    response.set_etag(response_etag)
+    return response
+
+
+def configure_argparser(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) > 0 and argv[0] in COMMAND_LIST:
+        return configure_command_argparser(argv[0], argv[1:])
     # Specify default arguments
-    parser = argparse.ArgumentParser()
+    parser = argparse.ArgumentParser(
+        epilog='commands: intercheck {%s} -h' % (','.join(COMMAND_LIST), ))
     parser.add_argument('-p', '--port', type=int,
                         default=DEFAULT_SETTINGS.get('port'),
                         help='which port to have the web server listen on')
@@ -63,9 +228,114 @@ def configure_argparser():
                         help='interval (in seconds) between each check')
     parser.add_argument('-e', '--interval-exact', type=bool,
                         default=DEFAULT_SETTINGS.get('interval_exact'),
-                        help='round interval to the nearest minute')
+                        help='align the checks to the clock (e.g. every 5 '
+                             'minutes at :00, :05, ...)')
+    parser.add_argument('--missed', type=str,
+                        choices=schedule.MISSED_POLICY_LIST,
+                        default=DEFAULT_SETTINGS.get('missed'),
+                        help='the checks missed (e.g. while suspended) are all '
+                             'run (catchup), run once or skipped')
+    parser.add_argument('-s', '--storage', type=str,
+                        default=DEFAULT_SETTINGS.get('storage'),
+                        choices=sorted(storage.STORAGE_BACKENDS.keys()),
+                        help='which storage engine to use for the SpeedTest log')
+    parser.add_argument('-w', '--workers', type=int,
+                        default=DEFAULT_SETTINGS.get('workers'),
+                        help='number of threads serving the web interface '
+                             '(0 to serve synchronously)')
+    parser.add_argument('--vectorized', action='store_true',
+                        default=DEFAULT_SETTINGS.get('vectorized'),
+                        help='compute the statistics with NumPy, if installed')
+    parser.add_argument('--probe-interval', type=float,
+                        default=DEFAULT_SETTINGS.get('probe_interval'),
+                        help='interval (in seconds) between connectivity probes '
+                             '(0, the default, to disable)')
+    parser.add_argument('--probe-target', type=str, action='append',
+                        dest='probe_targets', default=None,
+                        help='a connectivity probe target (host:port, '
+                             'dns://host or http://host/path), repeatable')
+    parser.add_argument('--segment-period', type=str,
+                        default=DEFAULT_SETTINGS.get('segment_period'),
+                        choices=storage.SEGMENT_PERIOD_LIST,
+                        help='the period of each log segment (segmented storage)')
+    parser.add_argument('--archive-after', type=int,
+                        default=DEFAULT_SETTINGS.get('archive_after'),
+                        help='compress log segments older than this many days '
+                             '(0 to never compress)')
+    parser.add_argument('--expire-after', type=int,
+                        default=DEFAULT_SETTINGS.get('expire_after'),
+                        help='delete log segments older than this many days '
+                             '(0 to keep forever)')
+    parser.add_argument('--aggregator', type=str,
+                        default=DEFAULT_SETTINGS.get('aggregator'),
+                        help='push every SpeedTest to the fleet aggregator at '
+                             'this URL (e.g. http://host:5000)')
+    parser.add_argument('--agent', type=str,
+                        default=DEFAULT_SETTINGS.get('agent'),
+                        help='the name of this agent in the fleet (defaults '
+                             'to the host name)')
+    parser.add_argument('--fleet', action='store_true',
+                        default=DEFAULT_SETTINGS.get('fleet'),
+                        help='aggregate the SpeedTests pushed by fleet agents')
+    parser.add_argument('--fleet-token', type=str,
+                        default=DEFAULT_SETTINGS.get('fleet_token'),
+                        help='a shared secret required to push to (or '
+                             'sent to) the aggregator')
+    parser.add_argument('--headless', '--no-web', action='store_true',
+                        default=DEFAULT_SETTINGS.get('headless'),
+                        help='only log SpeedTests, without the web interface '
+                             'or opening a browser')
+    parser.add_argument('-t', '--target', type=str, action='append',
+                        dest='targets', default=None,
+                        help='a measurement target (name[,source=<interface '
+                             'or IP>][,server=<id>][,interval=<seconds>]), '
+                             'repeatable')
+    parser.add_argument('--target-concurrency', type=int,
+                        default=DEFAULT_SETTINGS.get('target_concurrency'),
+                        help='how many targets are measured at the same time '
+                             '(1 when they share a bottleneck)')
     parser.add_argument('-v', '--version', action='version', version=version)
-    settings_dict = dict(parser.parse_args()._get_kwargs())
+    settings_dict = dict(parser.parse_args(argv)._get_kwargs())
+    if settings_dict.get('probe_targets') is None:
+        settings_dict['probe_targets'] = DEFAULT_SETTINGS.get('probe_targets')
+    if settings_dict.get('targets') is None:
+        settings_dict['targets'] = DEFAULT_SETTINGS.get('targets')
+    return settings_dict
+
+
+def configure_command_argparser(command, argv):
+    """ Parse the arguments of ``intercheck import`` or ``intercheck export``,
+    see :mod:`intercheck.transfer`.
+    """
+    parser = argparse.ArgumentParser(prog='intercheck %s' % (command, ))
+    if command == 'import':
+        parser.add_argument('input', type=str, nargs='+',
+                            help='the CSV, JSON or JSON Lines files to import '
+                                 '(optionally .gz, - for standard input)')
+    else:
+        parser.add_argument('output', type=str,
+                            help='the CSV, JSON or JSON Lines file to export '
+                                 'to (optionally .gz, - for standard output)')
+    parser.add_argument('-f', '--format', type=str, default=None,
+                        choices=transfer.FORMAT_LIST,
+                        help='the file format, instead of the extension')
+    parser.add_argument('--from', type=transfer.parse_time, default=None,
+                        dest='start',
+                        help='only the SpeedTests at or after this time (a '
+                             'timestamp or a local YYYY-MM-DD[THH:MM[:SS]])')
+    parser.add_argument('--to', type=transfer.parse_time, default=None,
+                        dest='end',
+                        help='only the SpeedTests before this time')
+    parser.add_argument('-s', '--storage', type=str, default=None,
+                        choices=sorted(storage.STORAGE_BACKENDS.keys()),
+                        help='the storage engine (defaults to the storage '
+                             'setting)')
+    parser.add_argument('--agent', type=str, default=None,
+                        help='the log of this fleet agent, on an aggregator')
+    parser.add_argument('--target', type=str, default=None,
+                        help='the log of this measurement target')
+    settings_dict = dict(parser.parse_args(argv)._get_kwargs())
+    settings_dict['command'] = command
     return settings_dict
 
 
@@ -85,6 +355,7 @@ def decode_from_json(json_str):
 
 
 def clear_force(**kwargs):
+    FORCE_TRIGGER.clear()
     force_filepath = get_force_filepath(**kwargs)
     delete_file(force_filepath)
 
@@ -103,14 +374,95 @@ def delete_file(filepath):
         pass
 
 
-def download_file(filepath):
-    content = open(filepath, 'r').read()
-    filename = os.path.basename(filepath)
+def download_file(filepath, filename=None, etag=None, compress=False):
+    """ Stream a file in chunks, with conditional and ``Range`` request support.
+
+    Args:
+        filepath (str): the file to send
+        filename (str): the name of the download, defaults to the file's name
+        etag (str): the entity tag of the file's content, if known
+        compress (bool): gzip the response on the fly if the client accepts it
+            and did not ask for a byte range
+
+    Returns:
+        response (flask.Response)
+    """
+    import flask
+    if filename is None:
+        filename = os.path.basename(filepath)
+    request = flask.request
+    length = os.path.getsize(filepath)
+    # Use a byte range, if a single satisfiable range is requested
+    byte_range = request.range
+    if_range = request.headers.get('If-Range', None)
+    if etag is not None and if_range is not None and if_range.strip('"') != etag:
+        byte_range = None
+    if byte_range is not None and len(byte_range.ranges) != 1:
+        byte_range = None
+    compress = compress and byte_range is None and accepts_gzip()
+    if etag is not None and compress:
+        etag = '%s-gzip' % (etag, )
+    # Check if the client already has this version
+    if etag is not None and request.if_none_match.contains(etag):
+        response = flask.Response(status=304)
+        response.set_etag(etag)
+        return response
+    offset, stop = 0, length
+    if byte_range is not None:
+        range_tuple = byte_range.range_for_length(length)
+        if range_tuple is None:
+            response = flask.Response(status=416)
+            response.headers['Content-Range'] = 'bytes */%d' % (length, )
+            return response
+        offset, stop = range_tuple
+    # Stream the file (or range)
+    chunk_iter = iter_file(open(filepath, 'rb'), offset, stop - offset)
+    response = download_stream(chunk_iter, filename, compress=compress)
+    response.headers['Accept-Ranges'] = 'bytes'
+    if not compress:
+        response.headers['Content-Length'] = str(stop - offset)
+    if byte_range is not None:
+        response.status_code = 206
+        args = (offset, stop - 1, length, )
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % args
+    if etag is not None:
+        response.set_etag(etag)
+    return response
+
+
+def download_log(extension, start=None, end=None, compress=True, **kwargs):
+    """ Stream the SpeedTest log as a CSV (``.csv``) or JSON (``.json``) file.
+
+    The full log is served from a snapshot that is only rewritten when the
+    storage sequence changes, so it supports ``Range`` and conditional
+    requests.  A time-range export (``start`` and/or ``end``) is streamed
+    straight from the storage index instead.
+    """
+    storage_ = get_storage(**kwargs)
+    filename = 'log%s' % (extension, )
+    if start is None and end is None:
+        export_filepath, sequence = export_log(storage_, extension, **kwargs)
+        etag = 'log%s-%d' % (extension, sequence, )
+        return download_file(export_filepath, filename=filename, etag=etag,
+                             compress=compress)
+    chunk_iter = iter_export(storage_, extension, start=start, end=end)
+    compress = compress and accepts_gzip()
+    return download_stream(chunk_iter, filename, compress=compress)
+
+
+def download_stream(chunk_iter, filename, compress=False):
+    import flask
     extension = os.path.splitext(filename)[1]
-    response = flask.make_response(content)
+    if compress:
+        chunk_iter = iter_gzip(chunk_iter)
+    mimetype = MIMETYPE_DICT.get(extension, 'text/plain')
+    response = flask.Response(chunk_iter, mimetype=mimetype,
+                              direct_passthrough=True)
     content_disposition = 'attachment; filename=%s' % (filename, )
     response.headers['Content-Disposition'] = content_disposition
-    response.mimetype = 'text/%s' % (extension, )
+    response.headers['Vary'] = 'Accept-Encoding'
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
     return response
 
 
@@ -124,11 +476,72 @@ def encode_to_json(value_dict, add_version=True):
     return json_str
 
 
-def get_internal_path(ensure=True, **kwargs):
-    internal_path = os.path.expanduser(os.path.join('~', '.intercheck'))
-    internal_path = os.path.abspath(internal_path)
-    if ensure and not os.path.exists(internal_path):
-        os.makedirs(internal_path)
+def export_log(storage_, extension, **kwargs):
+    """ Return ``(filepath, sequence)`` of a snapshot of the full log.
+
+    The snapshot is written by streaming through the storage engine and is
+    reused until the storage sequence changes.
+    """
+    with EXPORT_LOCK:
+        sequence = storage_.sequence()
+        export_filepath = get_export_filepath(extension, sequence, **kwargs)
+        if not os.path.exists(export_filepath):
+            temp_filepath = '%s.tmp' % (export_filepath, )
+            with open(temp_filepath, 'w') as export_file:
+                for chunk in iter_export(storage_, extension):
+                    export_file.write(chunk)
+            os.rename(temp_filepath, export_filepath)
+            # Remove the stale snapshots
+            export_path = os.path.dirname(export_filepath)
+            pattern = os.path.join(export_path, 'log.*%s' % (extension, ))
+            for stale_filepath in glob.glob(pattern):
+                if stale_filepath != export_filepath:
+                    delete_file(stale_filepath)
+    return export_filepath, sequence
+
+
+def get_agent_list(**kwargs):
+    """ Return the names of the fleet agents that have pushed SpeedTests. """
+    internal_path = get_internal_path(**kwargs)
+    agent_path = os.path.join(internal_path, 'agents')
+    if not os.path.isdir(agent_path):
+        return []
+    agent_list = [
+        agent
+        for agent in os.listdir(agent_path)
+        if fleet.AGENT_PATTERN.match(agent) is not None
+    ]
+    return sorted(agent_list)
+
+
+def get_binary_log_filepath(*args, **kwargs):
+    internal_path = get_internal_path(**kwargs)
+    binary_log_filepath = os.path.join(internal_path, 'log.bin')
+    return binary_log_filepath
+
+
+def get_internal_path(ensure=True, agent=None, target=None, **kwargs):
+    """ Return ``~/.intercheck``, ``~/.intercheck/agents/<agent>`` for a fleet
+    agent (see :mod:`intercheck.fleet`) and ``<path>/targets/<target>`` for a
+    measurement target (see :mod:`intercheck.targets`).
+    """
+    # Resolved (and created) once, it is needed for every file Intercheck opens
+    internal_path = INTERNAL_PATH_DICT.get((ensure, agent, target, ), None)
+    if internal_path is None:
+        internal_path = os.path.expanduser(os.path.join('~', '.intercheck'))
+        if agent is not None:
+            fleet.check_agent(agent)
+            internal_path = os.path.join(internal_path, 'agents', agent)
+        if target is not None:
+            targets.check_target(target)
+            internal_path = os.path.join(internal_path, 'targets', target)
+        internal_path = os.path.abspath(internal_path)
+        if not os.path.exists(internal_path):
+            if not ensure:
+                # Not cached until it exists
+                return internal_path
+            os.makedirs(internal_path)
+        INTERNAL_PATH_DICT[(ensure, agent, target, )] = internal_path
     return internal_path
 
 
@@ -138,6 +551,76 @@ def get_csv_log_filepath(**kwargs):
     return csv_log_filepath
 
 
+def get_export_filepath(extension, sequence, **kwargs):
+    internal_path = get_internal_path(**kwargs)
+    export_path = os.path.join(internal_path, 'export')
+    if not os.path.exists(export_path):
+        os.makedirs(export_path)
+    export_filepath = os.path.join(export_path, 'log.%d%s' % (sequence, extension, ))
+    return export_filepath
+
+
+def get_fleet_points(resolution=None, max_points=None, day=30, **kwargs):
+    """ Return the points of every fleet agent combined, see :func:`get_points`.
+
+    Each point merges the rollups of all of the agents for the same bucket:
+    the mean is weighted by the number of values, the minimum and maximum are
+    over all agents.  Raw records are not merged, so the finest resolution is a
+    minute.
+
+    Returns:
+        tuple: ``(point_dict, resolution, agent_list)``
+    """
+    now = time.time()
+    if max_points is None:
+        max_points = POINTS_MAX_POINTS
+    max_points = min(max(int(max_points), 3), POINTS_MAX_POINTS_LIMIT)
+    start = now - 60 * 60 * 24 * day
+    agent_list = get_agent_list(**kwargs)
+    storage_list = [ get_storage(agent=agent, **kwargs) for agent in agent_list ]
+    # Pick the finest resolution that fits (see get_points)
+    if resolution not in storage.RESOLUTION_DICT:
+        oversample_points = max_points * POINTS_OVERSAMPLE
+        earliest = now
+        for storage_ in storage_list:
+            record_iter = storage_.iter_records(start=start)
+            record = next(record_iter, None)
+            record_iter.close()
+            if record is not None:
+                earliest = min(earliest, record['start'])
+        for resolution in storage.RESOLUTION_LIST:
+            points = (now - earliest) / storage.RESOLUTION_DICT[resolution]
+            if points <= oversample_points:
+                break
+    # Merge the rollups of every agent, [count, total, min, max] per bucket
+    merged_dict = { key : {} for key in storage.METRIC_LIST }
+    for storage_ in storage_list:
+        for rollup in storage_.iter_rollups(resolution, start=start):
+            for key in storage.METRIC_LIST:
+                count = rollup['%s_count' % (key, )]
+                if count == 0:
+                    continue
+                value_min = rollup['%s_min' % (key, )]
+                value_max = rollup['%s_max' % (key, )]
+                total = rollup['%s_mean' % (key, )] * count
+                merged = merged_dict[key].get(rollup['start'], None)
+                if merged is None:
+                    merged_dict[key][rollup['start']] = [count, total, value_min, value_max]
+                else:
+                    merged[0] += count
+                    merged[1] += total
+                    merged[2] = min(merged[2], value_min)
+                    merged[3] = max(merged[3], value_max)
+    point_dict = {}
+    for key, bucket_dict in merged_dict.items():
+        point_list = [
+            [bucket, total / count, value_min, value_max]
+            for bucket, (count, total, value_min, value_max) in sorted(bucket_dict.items())
+        ]
+        point_dict[key] = downsample.lttb(point_list, max_points)
+    return point_dict, resolution, agent_list
+
+
 def get_force_filepath(**kwargs):
     internal_path = get_internal_path(**kwargs)
     force_filepath = os.path.join(internal_path, 'force')
@@ -150,21 +633,180 @@ def get_json_log_filepath(*args, **kwargs):
     return csv_log_filepath
 
 
+def get_jsonl_log_filepath(*args, **kwargs):
+    internal_path = get_internal_path(**kwargs)
+    jsonl_log_filepath = os.path.join(internal_path, 'log.jsonl')
+    return jsonl_log_filepath
+
+
+def get_outage_filepath(*args, **kwargs):
+    internal_path = get_internal_path(**kwargs)
+    outage_filepath = os.path.join(internal_path, 'outages.sqlite3')
+    return outage_filepath
+
+
+def get_outage_index(**kwargs):
+    """ Return the (cached) :class:`intercheck.outage.OutageIndex` of the storage.
+
+    Args:
+        **kwargs: arbitrary keyword arguments, passed to
+            :func:`intercheck.utils.get_storage()`
+
+    Returns:
+        outage_index (intercheck.outage.OutageIndex)
+    """
+    storage_ = get_storage(**kwargs)
+    if storage_ not in OUTAGE_INDEX_DICT:
+        outage_filepath = get_outage_filepath(**kwargs)
+        OUTAGE_INDEX_DICT[storage_] = outage.OutageIndex(outage_filepath, storage_)
+    return OUTAGE_INDEX_DICT[storage_]
+
+
+def get_probe_filepath(*args, **kwargs):
+    internal_path = get_internal_path(**kwargs)
+    probe_filepath = os.path.join(internal_path, 'probe.sqlite3')
+    return probe_filepath
+
+
+def get_segment_path(*args, **kwargs):
+    internal_path = get_internal_path(**kwargs)
+    segment_path = os.path.join(internal_path, 'segments')
+    return segment_path
+
+
 def get_settings_filepath(*args, **kwargs):
+    # The fleet agents and measurement targets share the settings
+    kwargs.pop('agent', None)
+    kwargs.pop('target', None)
     internal_path = get_internal_path(**kwargs)
     settings_filepath = os.path.join(internal_path, 'settings.json')
     return settings_filepath
 
 
-def get_stats(day_list=[1, 30], latest=None, **kwargs):
-    now = time.time()
+def get_settings_service(settings_filepath=None, **kwargs):
+    """ Return the (cached) :class:`intercheck.config.SettingsService`. """
+    if settings_filepath is None:
+        settings_filepath = get_settings_filepath(**kwargs)
+    if settings_filepath not in SETTINGS_SERVICE_DICT:
+        service = config.SettingsService(settings_filepath, DEFAULT_SETTINGS)
+        SETTINGS_SERVICE_DICT[settings_filepath] = service
+    return SETTINGS_SERVICE_DICT[settings_filepath]
+
+
+def get_spool_filepath(*args, **kwargs):
+    internal_path = get_internal_path(**kwargs)
+    spool_filepath = os.path.join(internal_path, 'spool.jsonl')
+    return spool_filepath
+
+
+def get_sqlite_log_filepath(*args, **kwargs):
+    internal_path = get_internal_path(**kwargs)
+    sqlite_log_filepath = os.path.join(internal_path, 'log.sqlite3')
+    return sqlite_log_filepath
+
+
+def get_storage(backend=None, **kwargs):
+    """ Return the (cached) storage engine for the SpeedTest log.
+
+    Args:
+        backend (str): the name of the storage engine, one of
+            :data:`intercheck.storage.STORAGE_BACKENDS`.  Defaults to the
+            ``storage`` setting.
+        **kwargs: arbitrary keyword arguments, passed to
+            :func:`intercheck.utils.get_internal_path()`
+
+    Returns:
+        storage (intercheck.storage.Storage)
+    """
+    settings_dict = load_settings(quiet=True, **kwargs)
+    if backend is None:
+        backend = settings_dict.get('storage')
+    if backend not in storage.STORAGE_BACKENDS:
+        print('Unknown storage %r, using %r' % (backend, DEFAULT_SETTINGS['storage'], ))
+        backend = DEFAULT_SETTINGS['storage']
+    internal_path = get_internal_path(**kwargs)
+    storage_key = (backend, internal_path, )
+    if storage_key not in STORAGE_DICT:
+        json_log_filepath = get_json_log_filepath(**kwargs)
+        csv_log_filepath = get_csv_log_filepath(**kwargs)
+        if backend == storage.BinaryStorage.name:
+            binary_log_filepath = get_binary_log_filepath(**kwargs)
+            args = (binary_log_filepath, json_log_filepath, csv_log_filepath, )
+        elif backend == storage.SegmentedStorage.name:
+            segment_path = get_segment_path(**kwargs)
+            args = (segment_path, json_log_filepath, csv_log_filepath,
+                    settings_dict.get('segment_period'),
+                    settings_dict.get('archive_after'),
+                    settings_dict.get('expire_after'), )
+        elif backend == storage.SQLiteStorage.name:
+            sqlite_log_filepath = get_sqlite_log_filepath(**kwargs)
+            args = (sqlite_log_filepath, json_log_filepath, csv_log_filepath, )
+        elif backend == storage.JSONLinesStorage.name:
+            jsonl_log_filepath = get_jsonl_log_filepath(**kwargs)
+            args = (jsonl_log_filepath, json_log_filepath, csv_log_filepath, )
+        else:
+            args = (json_log_filepath, csv_log_filepath, )
+        STORAGE_DICT[storage_key] = storage.STORAGE_BACKENDS[backend](*args)
+    return STORAGE_DICT[storage_key]
+
+
+def reset_storage(**kwargs):
+    """ Forget the cached paths and storage engine of the SpeedTest log, and
+    return a new storage engine (see :func:`get_storage`).
+
+    Used when the storage fails with an IOError or OSError, e.g. because
+    ``~/.intercheck`` was removed while Intercheck is running: the directory is
+    created again and the log is reopened.
+    """
+    INTERNAL_PATH_DICT.clear()
+    internal_path = get_internal_path(**kwargs)
+    for storage_key in list(STORAGE_DICT.keys()):
+        if storage_key[1] == internal_path:
+            storage_ = STORAGE_DICT.pop(storage_key)
+            OUTAGE_INDEX_DICT.pop(storage_, None)
+            try:
+                storage_.close()
+            except Exception:
+                pass
+    return get_storage(**kwargs)
+
+
+def get_target_list(**kwargs):
+    """ Return the names of the measurement targets that have a log. """
+    internal_path = get_internal_path(**kwargs)
+    target_path = os.path.join(internal_path, 'targets')
+    if not os.path.isdir(target_path):
+        return []
+    target_list = [
+        target
+        for target in os.listdir(target_path)
+        if targets.NAME_PATTERN.match(target) is not None
+    ]
+    return sorted(target_list)
+
+
+def use_vectorized(vectorized=None, **kwargs):
+    # The columnar engine is opt-in, with the ``vectorized`` setting
+    if vectorized is None:
+        vectorized = load_settings(quiet=True, **kwargs).get('vectorized')
+    return bool(vectorized) and columnar.available()
+
+
+def get_stats(day_list=[1, 30], latest=None, vectorized=None, now=None,
+              **kwargs):
+    if use_vectorized(vectorized, **kwargs):
+        storage_ = get_storage(**kwargs)
+        return columnar.get_stats(storage_, day_list=day_list, latest=latest,
+                                  now=now)
+    now = time.time() if now is None else now
     latest = -1 if latest is None else int(latest)
     day_seconds = 60 * 60 * 24
-    # Open logs from JSON
-    log = read_from_json_log(**kwargs)
     # Get the desired days
     day_list = sorted(day_list)
     thresh_list = [ now - 60 * 60 * 24 * day for day in day_list ]
+    # Open logs from storage, only the records from the largest window
+    storage_ = get_storage(**kwargs)
+    log = storage_.iter_records(start=max(thresh_list[-1], latest))
     # Keys we want to average over
     key_list = ['ping', 'download', 'upload', 'duration', 'start']
     # Loop through records and get stats
@@ -172,7 +814,7 @@ def get_stats(day_list=[1, 30], latest=None, **kwargs):
     connected = None
     disconnected = False
     start_earliest = None
-    for record in log['log']:
+    for record in log:
         start = record['start']
         if start < latest:
             # Respect a global latest limit, if specified
@@ -221,9 +863,17 @@ def get_stats(day_list=[1, 30], latest=None, **kwargs):
     return stat_dict, record_interval
 
 
-def get_summary_averages(round_values=False, **kwargs):
+def get_summary_averages(round_values=False, day_list=[1, 30], latest=None,
+                         vectorized=None, now=None, **kwargs):
+    if use_vectorized(vectorized, **kwargs):
+        # Averages and deviations straight from the columns, without lists
+        storage_ = get_storage(**kwargs)
+        return columnar.get_summary_averages(storage_, round_values=round_values,
+                                             day_list=day_list, latest=latest,
+                                             now=now)
     # Get stats
-    stat_dict, record_interval = get_stats(**kwargs)
+    stat_dict, record_interval = get_stats(day_list=day_list, latest=latest,
+                                           vectorized=False, now=now, **kwargs)
     # Calculate averages and variances
     for day in stat_dict:
         for key in stat_dict[day]:
@@ -246,34 +896,140 @@ def get_summary_averages(round_values=False, **kwargs):
     return stat_dict, record_interval
 
 
-def get_points(**kwargs):
-    # Get stats
-    stat_dict, record_interval = get_stats(day_list=[30], **kwargs)
-    return stat_dict
+def get_points(latest=None, resolution=None, max_points=None, since=None,
+               day=30, **kwargs):
+    """ Return a bounded series of points for each metric, for the graphs.
 
+    Args:
+        latest (float): only include points at or after this time
+        resolution (str): ``raw`` or one of the rollup resolutions in
+            :data:`intercheck.storage.RESOLUTION_DICT`.  Defaults to the finest
+            resolution with at most :data:`POINTS_OVERSAMPLE` times
+            ``max_points`` points (before downsampling).
+        max_points (int): the maximum number of points per metric, the series
+            are downsampled with :func:`intercheck.downsample.lttb()`.  Defaults
+            to :data:`POINTS_MAX_POINTS`.
+        since (int): a cursor returned by a previous call; if given, only the
+            (raw) records written after it are returned
+        day (int): the number of days of history to include
+        **kwargs: arbitrary keyword arguments, passed to
+            :func:`intercheck.utils.get_storage()`
 
-def load_settings(settings_filepath=None, quiet=False, **kwargs):
-    default_settings = DEFAULT_SETTINGS.copy()
-    if settings_filepath is None:
-        settings_filepath = get_settings_filepath(**kwargs)
-    error = False
+    Returns:
+        tuple: ``(point_dict, resolution, cursor)``, where ``point_dict`` maps
+            each metric to a list of ``[start, mean, min, max]`` points and
+            ``cursor`` is the storage sequence to pass as ``since`` next time
+    """
+    now = time.time()
+    if max_points is None:
+        max_points = POINTS_MAX_POINTS
+    max_points = min(max(int(max_points), 3), POINTS_MAX_POINTS_LIMIT)
+    window_start = now - 60 * 60 * 24 * day
+    start = window_start
+    if latest is not None:
+        start = max(start, float(latest))
+    storage_ = get_storage(**kwargs)
+    cursor = storage_.sequence()
+    # A cursor from the future (e.g. the storage was reset) gets everything
+    if since is not None and since > cursor:
+        since = None
+    # Only the records written after the cursor, if given
+    record_list = None
+    if since is not None:
+        resolution = 'raw'
+        record_list = []
+        for sequence, record in storage_.iter_since(since):
+            cursor = max(cursor, sequence)
+            if record['start'] >= start:
+                record_list.append(record)
+        record_list.sort(key=lambda record: record['start'])
+    # Pick the finest resolution that fits, over the span that has records,
+    # and leave the rest to the downsampling, which keeps the detail
+    if resolution is None:
+        resolution = 'raw'
+        oversample_points = max_points * POINTS_OVERSAMPLE
+        if storage_.count(start=start) > oversample_points:
+            record_iter = storage_.iter_records(start=start)
+            span = now - next(record_iter)['start']
+            record_iter.close()
+            for resolution in storage.RESOLUTION_LIST:
+                if span / storage.RESOLUTION_DICT[resolution] <= oversample_points:
+                    break
+    # Get the points
+    point_dict = { key : [] for key in storage.METRIC_LIST }
+    if resolution == 'raw':
+        if record_list is None:
+            record_list = storage_.iter_records(start=start)
+        for record in record_list:
+            for key in storage.METRIC_LIST:
+                value = record.get(key, None)
+                if value is None:
+                    continue
+                point_dict[key].append([record['start'], value, value, value])
+    else:
+        seconds = storage.RESOLUTION_DICT[resolution]
+        # The rollups of the whole window, which are kept in memory by some
+        # storage engines, then the ones after latest
+        for rollup in storage_.iter_rollups(resolution, start=window_start):
+            if rollup['start'] + seconds <= start:
+                continue
+            for key in storage.METRIC_LIST:
+                value = rollup['%s_mean' % (key, )]
+                if value is None:
+                    continue
+                point = [
+                    rollup['start'],
+                    value,
+                    rollup['%s_min' % (key, )],
+                    rollup['%s_max' % (key, )],
+                ]
+                point_dict[key].append(point)
+    # Downsample, preserving the shape of each series
+    for key in point_dict:
+        point_dict[key] = downsample.lttb(point_dict[key], max_points)
+    return point_dict, resolution, cursor
+
+
+def iter_export(storage_, extension, **kwargs):
+    if extension == '.csv':
+        return storage_.iter_csv(**kwargs)
+    return storage_.iter_json(**kwargs)
+
+
+def iter_file(file_, offset=0, length=None, chunk_size=storage.CHUNK_SIZE):
+    """ Yield ``length`` bytes of an open file from ``offset``, then close it. """
     try:
-        with open(settings_filepath, 'r') as settings_file:
-            settings_json_str = settings_file.read()
-            settings_dict = decode_from_json(settings_json_str)
-    except IOError:
-        error = True
-        settings_dict = {}
-    except simplejson.JSONDecodeError:
-        error = True
-        settings_dict = {}
-    default_settings.update(settings_dict)
-    if error:
-        save_settings(default_settings, settings_filepath, **kwargs)
+        file_.seek(offset)
+        while length is None or length > 0:
+            size = chunk_size if length is None else min(chunk_size, length)
+            chunk = file_.read(size)
+            if not chunk:
+                break
+            if length is not None:
+                length -= len(chunk)
+            yield chunk
+    finally:
+        file_.close()
+
+
+def iter_gzip(chunk_iter, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunk_iter:
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('utf-8')
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def load_settings(settings_filepath=None, quiet=False, **kwargs):
+    service = get_settings_service(settings_filepath, **kwargs)
+    settings_dict = service.get()
     if not quiet:
-        print('Loaded settings: %s' % (settings_filepath, ))
-        print_settings(default_settings)
-    return default_settings
+        print('Loaded settings: %s' % (service.settings_filepath, ))
+        print_settings(settings_dict)
+    return settings_dict
 
 
 def print_settings(settings_dict):
@@ -285,35 +1041,39 @@ def print_settings(settings_dict):
 
 def read_from_json_log(**kwargs):
     json_log_filepath = get_json_log_filepath(**kwargs)
-    try:
-        with open(json_log_filepath, 'r') as json_log:
-            log = simplejson.load(json_log)
-    except IOError:
-        log = {
-            'log' : []
-        }
+    log = storage.read_json_log(json_log_filepath)
     return log
 
 
+def register_settings_listener(listener, settings_filepath=None, **kwargs):
+    """ Call ``listener(settings_dict)`` whenever the settings change. """
+    service = get_settings_service(settings_filepath, **kwargs)
+    service.subscribe(listener)
+
+
+def register_write_listener(listener):
+    """ Call ``listener(storage, record)`` after every :func:`write_to_logs`. """
+    if listener not in WRITE_LISTENER_LIST:
+        WRITE_LISTENER_LIST.append(listener)
+
+
 def save_settings(settings_dict, settings_filepath=None, quiet=False, **kwargs):
-    if settings_filepath is None:
-        settings_filepath = get_settings_filepath(**kwargs)
-    settings_filepath = get_settings_filepath(**kwargs)
-    with open(settings_filepath, 'w') as settings_file:
-        simplejson.dump(settings_dict, settings_file)
+    service = get_settings_service(settings_filepath, **kwargs)
+    service.save(settings_dict)
     if not quiet:
-        print('Saving settings: %s' % (settings_filepath, ))
+        print('Saving settings: %s' % (service.settings_filepath, ))
         print_settings(settings_dict)
 
 
 def set_force(**kwargs):
-    force_filepath = get_force_filepath(**kwargs)
-    with open(force_filepath, 'a'):
-        pass
+    # The trigger is drained by the scheduler, so it cannot be read back
+    FORCE_TRIGGER.set()
     print('Forcing...')
+    return True
 
 
 def template(template_name='index', **kwargs):
+    import flask
     template_ = '%s.html' % (template_name, )
     if 'GLOBAL_DICT' in kwargs:
         raise ValueError('Cannot specify the argument "GLOBAL_DICT" for ' +
@@ -322,39 +1082,63 @@ def template(template_name='index', **kwargs):
     return flask.render_template(template_, **kwargs)
 
 
-def update_settings(*args, **kwargs):
-    save_settings(*args, **kwargs)
-    set_force(**kwargs)
+def update_settings(settings_dict, settings_filepath=None, **kwargs):
+    # Listeners (see register_settings_listener) are notified of the change
+    save_settings(settings_dict, settings_filepath=settings_filepath, **kwargs)
+    bump_generation()
 
 
 def write_to_csv_log(key_list, **kwargs):
     csv_log_filepath = get_csv_log_filepath(**kwargs)
-    if not os.path.exists(csv_log_filepath):
-        with open(csv_log_filepath, 'w') as csv_log:
-            csv_line = ','.join(key_list)
-            csv_log.write('%s\n' % (csv_line, ))
-    with open(csv_log_filepath, 'a') as csv_log:
-        args = [ kwargs.get(key, None) for key in key_list ]
-        args = [ '' if arg is None else '%s' % (arg, ) for arg in args ]
-        csv_line = ','.join(args)
-        csv_log.write('%s\n' % (csv_line, ))
+    storage.write_csv_log(csv_log_filepath, kwargs, key_list=key_list)
 
 
 def write_to_json_log(key_list, **kwargs):
-    log = read_from_json_log(**kwargs)
     json_log_filepath = get_json_log_filepath(**kwargs)
-    with open(json_log_filepath, 'w') as json_log:
-        args = { key : kwargs.get(key, None) for key in key_list }
-        log['log'].append(args)
-        simplejson.dump(log, json_log)
+    storage.write_json_log(json_log_filepath, kwargs, key_list=key_list)
+
+
+def write_to_jsonl_log(key_list, **kwargs):
+    jsonl_log_filepath = get_jsonl_log_filepath(**kwargs)
+    storage.write_jsonl_log(jsonl_log_filepath, kwargs, key_list=key_list)
+
+
+def write_many_to_logs(record_list, key_list=None, **kwargs):
+    """ Write a batch of SpeedTest results, see :func:`write_to_logs`.
+
+    Used by the fleet aggregator for the SpeedTests pushed by an agent (with
+    ``agent=<name>``), the batch is written to storage at once.
+    """
+    if key_list is None:
+        key_list = storage.KEY_LIST
+    record_list = [
+        { key : record.get(key, None) for key in key_list }
+        for record in record_list
+    ]
+    try:
+        storage_ = get_storage(**kwargs)
+        storage_.write_many(record_list)
+    except (IOError, OSError) as error:
+        print('Reopening the SpeedTest log after %r' % (error, ))
+        storage_ = reset_storage(**kwargs)
+        storage_.write_many(record_list)
+    # Open the outage index, if not yet, so the listeners keep it up to date
+    get_outage_index(**kwargs)
+    # Notify any incrementally-maintained views of the new records
+    for record in record_list:
+        for listener in WRITE_LISTENER_LIST:
+            listener(storage_, record)
+    # Then invalidate the cached responses, which are built from those views
+    bump_generation()
 
 
 def write_to_logs(key_list=None, **kwargs):
     """ Write the SpeedTest results to all log files.
 
-    Write the given SpeedTest results dictionary to the logs on disk.
-    Currently, that includes a CSV and a JSON log file.  Eventualy, and for
-    scalability, this functionality will be powered by an SQLite3 database.
+    Write the given SpeedTest results dictionary to the storage engine selected
+    by the ``storage`` setting (see :func:`intercheck.utils.get_storage()`).
+    By default, that is an indexed SQLite3 database; the legacy ``json`` engine
+    writes a CSV and a JSON log file instead.
 
 
     Args:
@@ -362,13 +1146,25 @@ def write_to_logs(key_list=None, **kwargs):
             to the logs from the SpeedTest results.  Defaults to (in order):
                 ``['start', 'duration', 'ping', 'download', 'upload']``
         **kwargs: arbitrary keyword arguments, passed to
-            :func:`intercheck.utils.write_to_csv_log()` and
-            :func:`intercheck.utils.write_to_json_log()`
+            :func:`intercheck.utils.get_storage()`
 
     Returns:
         None
     """
     if key_list is None:
-        key_list = ['start', 'duration', 'ping', 'download', 'upload']
-    write_to_csv_log(key_list, **kwargs)
-    write_to_json_log(key_list, **kwargs)
+        key_list = storage.KEY_LIST
+    record = { key : kwargs.get(key, None) for key in key_list }
+    try:
+        storage_ = get_storage(**kwargs)
+        storage_.write(record)
+    except (IOError, OSError) as error:
+        print('Reopening the SpeedTest log after %r' % (error, ))
+        storage_ = reset_storage(**kwargs)
+        storage_.write(record)
+    # Open the outage index, if not yet, so the listeners keep it up to date
+    get_outage_index(**kwargs)
+    # Notify any incrementally-maintained views of the new record
+    for listener in WRITE_LISTENER_LIST:
+        listener(storage_, record)
+    # Then invalidate the cached responses, which are built from those views
+    bump_generation()
@@ -14,13 +14,17 @@ setup(
     packages=['intercheck'],
     install_requires=[
         'Flask >= 0.10.1',
+        'futures >= 3.0.5; python_version < "3"',
         'requests >=2.9.1',
         'simplejson >= 3.8.1',
-        'speedtest-cli >= 0.3.4',
+        'speedtest-cli >= 2.0.0',
         'tornado >= 4.3',
         'Sphinx >= 1.3.6',
         'sphinxcontrib-napoleon >= 0.5.0',
     ],
+    extras_require={
+        'numpy' : ['numpy >= 1.8'],
+    },
     entry_points={
         'console_scripts' : [
             'intercheck = intercheck:start',